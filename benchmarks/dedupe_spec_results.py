@@ -0,0 +1,54 @@
+"""
+Benchmark deduplicating :class:`.spec.Paths` -style results with
+:func:`onice_conversion.utils._gather_list_of_dicts` and
+:func:`onice_conversion.utils._recursive_dedupe_dicts`
+
+Makes ``n`` parsed path results like those from ``'{subject_id}/{session_id}/trial_{trial}.mat'``
+(with a nested ``Subject[...]`` field and an array value, as you'd get from a ``spec.Mat`` ),
+and times dedupe at a few sizes to check that it scales linearly::
+
+    python benchmarks/dedupe_spec_results.py --n 100000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from onice_conversion.utils import _gather_list_of_dicts, _recursive_dedupe_dicts
+
+
+def make_results(n:int, n_subjects:int=20, n_sessions:int=500) -> list:
+    rng = np.random.default_rng(0)
+    calibrations = [rng.random(64) for _ in range(n_subjects)]
+    results = []
+    for i in range(n):
+        subject = i % n_subjects
+        results.append({
+            'session_id': f'{(i // n_subjects) % n_sessions:04d}',
+            'trial': str(i),
+            'Subject': {'subject_id': f'mouse_{subject:02d}', 'species': 'Mus musculus'},
+            # fresh copy, so equal arrays are equal by content and not identity
+            'calibration': calibrations[subject].copy()
+        })
+    return results
+
+def bench(n:int) -> float:
+    results = make_results(n)
+    start = time.perf_counter()
+    deduped = _recursive_dedupe_dicts(_gather_list_of_dicts(results), raise_on_dupes=False)
+    elapsed = time.perf_counter() - start
+
+    assert len(deduped['trial']) == n
+    assert len(deduped['Subject']['subject_id']) == min(n, 20)
+    assert len(deduped['calibration']) == min(n, 20)
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=100000, help='number of parsed path results')
+    args = parser.parse_args()
+
+    for n in (args.n // 4, args.n // 2, args.n, args.n * 2):
+        elapsed = bench(n)
+        print(f'{n:>8d} results: {elapsed:.3f}s ({elapsed / n * 1e6:.2f} us/result)')
@@ -0,0 +1,67 @@
+"""
+Benchmark writing many streams with :class:`onice_conversion.pipeline.PipelinedWriter`
+against a plain sequential :class:`pynwb.NWBHDF5IO` write with the same chunking and compression.
+
+Mimics the smear example: six position series sampled at 80 Hz (made by column-slicing one
+frame parameter array) plus a sniff signal at 800 Hz::
+
+    python benchmarks/pipelined_write.py --frames 2000000 --readers 4
+"""
+import argparse
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBFile, NWBHDF5IO, TimeSeries
+from pynwb.behavior import Position
+
+from onice_conversion.pipeline import PipelinedWriter
+
+CHUNK_ROWS = 131072
+
+
+def build(frame_params:np.ndarray, sniff:np.ndarray, pipeline:PipelinedWriter=None) -> NWBFile:
+    def wrap(name, data):
+        if pipeline is not None:
+            return pipeline.add_stream(name, data, chunks=(CHUNK_ROWS,))
+        return H5DataIO(data, chunks=(CHUNK_ROWS,), compression='gzip', compression_opts=4, shuffle=True)
+
+    nwbfile = NWBFile(session_description='benchmark', identifier='benchmark',
+                      session_start_time=datetime.now(timezone.utc))
+    tracking = Position()
+    for i, name in enumerate(('nose x', 'nose y', 'head x', 'head y', 'body x', 'body y')):
+        tracking.create_spatial_series(name=name, data=wrap(name, frame_params[:, i]),
+                                       rate=80., reference_frame='session start')
+    behavior = nwbfile.create_processing_module('behavior', 'tracking')
+    behavior.add(tracking)
+    nwbfile.add_acquisition(TimeSeries(name='sniff_signal', data=wrap('sniff', sniff), unit='V', rate=800.))
+    return nwbfile
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=2000000, help='number of video frames')
+    parser.add_argument('--readers', type=int, default=4, help='number of reader threads')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frame_params = np.cumsum(rng.normal(size=(args.frames, 8)), axis=0)
+    sniff = rng.normal(size=args.frames * 10)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        with NWBHDF5IO(str(Path(tmpdir) / 'sequential.nwb'), mode='w') as io:
+            io.write(build(frame_params, sniff))
+        sequential = time.perf_counter() - start
+
+        pipeline = PipelinedWriter(n_readers=args.readers)
+        start = time.perf_counter()
+        pipeline.write(build(frame_params, sniff, pipeline), Path(tmpdir) / 'pipelined.nwb')
+        pipelined = time.perf_counter() - start
+
+    n_bytes = frame_params[:, :6].nbytes + sniff.nbytes
+    print(f'sequential: {sequential:.2f}s ({n_bytes / sequential / 1e6:.1f} MB/s)')
+    print(f'pipelined:  {pipelined:.2f}s ({n_bytes / pipelined / 1e6:.1f} MB/s), {pipeline.stats}')
@@ -6,4 +6,10 @@ try:
 except:
     pass
 
-from onice_conversion.nwbconverter import NWBConverter
\ No newline at end of file
+def __getattr__(name):
+    # imported lazily, so that commands that don't need pynwb
+    # (eg. the client of a warm :mod:`.service` ) start quickly
+    if name == 'NWBConverter':
+        from onice_conversion.nwbconverter import NWBConverter
+        return NWBConverter
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
\ No newline at end of file
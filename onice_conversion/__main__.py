@@ -0,0 +1,149 @@
+"""
+Command line interface, ``onice_conversion`` or ``python -m onice_conversion``
+
+Run ``onice_conversion -h`` for the list of commands
+"""
+import argparse
+import json
+import sys
+import typing
+
+
+def _add(args):
+    from onice_conversion.batch import Session
+    from onice_conversion.jobqueue import JobQueue
+
+    with open(args.sessions, 'r') as f:
+        sessions = [Session.from_dict(session) for session in json.load(f)]
+    with JobQueue(args.queue) as queue:
+        added = queue.add(sessions, cost_model=args.cost_model, replace=args.replace)
+    print(f'added {added} of {len(sessions)} sessions to {args.queue}')
+
+def _worker(args):
+    from onice_conversion.jobqueue import JobQueue
+
+    with JobQueue(args.queue, stale_after=args.stale_after, max_attempts=args.max_attempts) as queue:
+        results = queue.work(worker=args.name, wait=args.wait)
+    failed = [name for name, (_, error) in results.items() if error is not None]
+    print(f'converted {len(results) - len(failed)} sessions, {len(failed)} failed')
+
+def _status(args):
+    from onice_conversion.jobqueue import JobQueue
+
+    with JobQueue(args.queue) as queue:
+        print(', '.join(f'{status}: {count}' for status, count in queue.status().items()))
+        if args.verbose:
+            for job in queue.jobs():
+                print(f"  {job['name']}: {job['status']}"
+                      + (f" ({job['worker']})" if job['worker'] else '')
+                      + (f", attempt {job['attempts']}" if job['attempts'] else '')
+                      + (f", {job['elapsed']:.1f}s" if job['elapsed'] is not None else ''))
+                if job['error'] and job['status'] == 'failed':
+                    print('    ' + job['error'].strip().splitlines()[-1])
+
+def _retry(args):
+    from onice_conversion.jobqueue import JobQueue
+
+    with JobQueue(args.queue) as queue:
+        print(f'requeued {queue.retry(args.names or None)} failed sessions')
+
+def _watch(args):
+    from onice_conversion.jobqueue import JobQueue
+    from onice_conversion.watch import Watcher
+
+    with open(args.template, 'r') as f:
+        template = json.load(f)
+    with JobQueue(args.queue) as queue:
+        with Watcher(args.root, args.pattern, queue, template, quiet=args.quiet,
+                     poll_interval=args.poll_interval, polling=args.polling,
+                     cost_model=args.cost_model) as watcher:
+            queued = watcher.run()
+    print(f'queued {queued} sessions')
+
+def _serve(args):
+    from onice_conversion.service import Service
+
+    Service(args.socket, n_workers=args.workers, preload=args.preload, max_requests=args.max_requests).serve()
+
+def _submit(args):
+    from onice_conversion.service import submit, request
+
+    if args.stop:
+        request(args.socket, {'command': 'stop'}, timeout=args.timeout)
+        print(f'stopping the service on {args.socket}')
+        return
+
+    with open(args.sessions, 'r') as f:
+        sessions = json.load(f)
+    responses = submit(args.socket, sessions, n_jobs=args.jobs, timeout=args.timeout)
+    for response in responses:
+        if response['ok']:
+            print(f"{response['name']} done in {response['elapsed']:.1f}s (worker {response['worker']})")
+        else:
+            print(f"{response.get('name')} failed:\n{response['error']}")
+    if not all(response['ok'] for response in responses):
+        return 1
+
+
+def main(argv:typing.Optional[typing.List[str]]=None):
+    parser = argparse.ArgumentParser(prog='onice_conversion', description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add = commands.add_parser('add', help='add sessions to a job queue')
+    add.add_argument('queue', help='path of the queue database, created if needed')
+    add.add_argument('sessions', help='JSON file with a list of sessions, see onice_conversion.batch.Session.to_dict')
+    add.add_argument('--cost-model', default=None, help='JSON file of a batch.CostModel, to claim the largest sessions first')
+    add.add_argument('--replace', action='store_true', help='replace sessions that are already in the queue')
+    add.set_defaults(func=_add)
+
+    worker = commands.add_parser('worker', help='claim and convert sessions from a job queue until it is empty')
+    worker.add_argument('queue', help='path of the queue database')
+    worker.add_argument('--name', default=None, help='worker id, default hostname:pid')
+    worker.add_argument('--wait', action='store_true', help='keep polling while other workers have sessions running')
+    worker.add_argument('--stale-after', type=float, default=120, help='seconds without a heartbeat before a session is requeued')
+    worker.add_argument('--max-attempts', type=int, default=3, help='times a session may be tried before it fails')
+    worker.set_defaults(func=_worker)
+
+    status = commands.add_parser('status', help='show the progress of a job queue')
+    status.add_argument('queue', help='path of the queue database')
+    status.add_argument('-v', '--verbose', action='store_true', help='list each session')
+    status.set_defaults(func=_status)
+
+    retry = commands.add_parser('retry', help='requeue failed sessions')
+    retry.add_argument('queue', help='path of the queue database')
+    retry.add_argument('names', nargs='*', help='sessions to retry, default all failed sessions')
+    retry.set_defaults(func=_retry)
+
+    watch = commands.add_parser('watch', help='watch a directory and add new sessions to a job queue once they stop changing')
+    watch.add_argument('root', help='directory to watch')
+    watch.add_argument('queue', help='path of the queue database, created if needed')
+    watch.add_argument('--pattern', required=True, help="spec.Path format of session folders relative to root, eg. '{subject_id}/{session_id}'")
+    watch.add_argument('--template', required=True, help='JSON file with a session template, see onice_conversion.watch.SessionTemplate')
+    watch.add_argument('--quiet', type=float, default=60, help='seconds a session folder must go unchanged before it is queued')
+    watch.add_argument('--poll-interval', type=float, default=10, help='seconds between checks when polling')
+    watch.add_argument('--polling', action='store_true', help='poll even if inotify is available')
+    watch.add_argument('--cost-model', default=None, help='JSON file of a batch.CostModel, to claim the largest sessions first')
+    watch.set_defaults(func=_watch)
+
+    serve = commands.add_parser('serve', help='run a warm conversion service on a unix socket')
+    serve.add_argument('socket', help='path of the unix socket to listen on')
+    serve.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    serve.add_argument('--preload', nargs='*', default=[], help='extra modules to import before forking, eg. your converters')
+    serve.add_argument('--max-requests', type=int, default=None, help='replace workers after this many requests')
+    serve.set_defaults(func=_serve)
+
+    submit = commands.add_parser('submit', help='convert sessions with a running service')
+    submit.add_argument('socket', help='path of the service\'s unix socket')
+    what = submit.add_mutually_exclusive_group(required=True)
+    what.add_argument('sessions', nargs='?', help='JSON file with a session or a list of sessions, see onice_conversion.batch.Session.to_dict')
+    what.add_argument('--stop', action='store_true', help='stop the service instead')
+    submit.add_argument('--jobs', type=int, default=1, help='how many sessions to convert at once')
+    submit.add_argument('--timeout', type=float, default=None, help='seconds to wait for each session')
+    submit.set_defaults(func=_submit)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
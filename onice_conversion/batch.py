@@ -0,0 +1,343 @@
+"""
+Convert many sessions at once.
+
+A :class:`.Session` describes one conversion (which converter, its source data, and
+where to write it). Before running a batch, :func:`.plan` estimates how long each session
+will take with a :class:`.CostModel` -- from the size of each interface's source files,
+at a rate per interface that's calibrated by the timings of previous runs -- and
+:func:`.run_batch` then dispatches the sessions largest-first to a pool of workers,
+so a few huge sessions don't end up running alone at the end::
+
+    sessions = [Session(f'{subject}_{session}', 'my_lab.conversion:LabConverter',
+                        source_data={...}, nwbfile_path=f'nwb/{subject}_{session}.nwb')
+                for subject, session in ...]
+    results = run_batch(sessions, n_workers=8, cost_model='batch_timings.json')
+"""
+import heapq
+import importlib
+import json
+import time
+import traceback
+import typing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from onice_conversion.memory import source_file_size, format_size
+
+
+class Session(object):
+    """
+    One conversion in a batch
+
+    Args:
+        name (str): unique name of the session
+        converter (str, type): :class:`.NWBConverter` subclass, or its import path
+            as ``'module.submodule:ClassName'``
+        source_data (dict): source data for the converter, ``{interface name: {params}}``
+        nwbfile_path (str): where to write the NWB file
+        metadata (dict): metadata to update the converter's :meth:`get_metadata` with
+        conversion_options (dict): passed to :meth:`.NWBConverter.run_conversion`
+        converter_kwargs (dict): other kwargs for the converter, eg. ``{'memory_budget': '4GB'}``
+        spec (dict, list): Optional. Spec (or list of specs) as given by :meth:`.BaseSpec.to_dict` ,
+            parsed against ``base_dir`` for metadata (which ``metadata`` takes precedence over)
+        base_dir (str): directory to parse ``spec`` against
+        merge_policy (str): what to do when specs set the same metadata to different values,
+            ``'last'`` , ``'first'`` , ``'error'`` , or ``'replace'`` , see :mod:`.spec.merge`
+    """
+
+    def __init__(self, name:str,
+                 converter:typing.Union[str, type],
+                 source_data:dict,
+                 nwbfile_path:typing.Union[str, Path],
+                 metadata:typing.Optional[dict]=None,
+                 conversion_options:typing.Optional[dict]=None,
+                 converter_kwargs:typing.Optional[dict]=None,
+                 spec:typing.Optional[typing.Union[dict, typing.List[dict]]]=None,
+                 base_dir:typing.Optional[typing.Union[str, Path]]=None,
+                 merge_policy:str='last'):
+        if spec is not None and base_dir is None:
+            raise ValueError('Need a base_dir to parse the spec against')
+        self.name = name
+        if not isinstance(converter, str):
+            converter = f'{converter.__module__}:{converter.__name__}'
+        self.converter = converter
+        self.source_data = source_data
+        self.nwbfile_path = str(nwbfile_path)
+        self.metadata = metadata if metadata is not None else {}
+        self.conversion_options = conversion_options if conversion_options is not None else {}
+        self.converter_kwargs = converter_kwargs if converter_kwargs is not None else {}
+        if isinstance(spec, dict):
+            spec = [spec]
+        self.spec = spec
+        self.base_dir = str(base_dir) if base_dir is not None else None
+        self.merge_policy = merge_policy
+
+    def converter_class(self) -> type:
+        """Import the converter class"""
+        module, name = self.converter.split(':')
+        return getattr(importlib.import_module(module), name)
+
+    def run(self) -> float:
+        """
+        Run the conversion
+
+        Returns:
+            float: seconds it took
+        """
+        from nwb_conversion_tools.json_schema_utils import dict_deep_update
+
+        start_time = time.time()
+        converter = self.converter_class()(self.source_data, **self.converter_kwargs)
+        metadata = converter.get_metadata()
+        if self.spec is not None:
+            from onice_conversion.spec import from_dict
+            from onice_conversion.validation import spec_sources
+            spec_metadata = converter.parse_spec([from_dict(spec_dict) for spec_dict in self.spec],
+                                                 Path(self.base_dir), policy=self.merge_policy)
+            metadata = dict_deep_update(metadata, spec_metadata)
+            # values given directly aren't from any spec
+            spec_sources(None, self.metadata, converter.metadata_sources)
+        metadata = dict_deep_update(metadata, self.metadata)
+        converter.run_conversion(metadata=metadata, save_to_file=True, nwbfile_path=self.nwbfile_path,
+                                 overwrite=True, conversion_options=self.conversion_options)
+        return time.time() - start_time
+
+    def to_dict(self) -> dict:
+        """JSON-able description of the session, to reconstitute with :meth:`.from_dict`"""
+        return {
+            'name': self.name,
+            'converter': self.converter,
+            'source_data': self.source_data,
+            'nwbfile_path': self.nwbfile_path,
+            'metadata': self.metadata,
+            'conversion_options': self.conversion_options,
+            'converter_kwargs': self.converter_kwargs,
+            'spec': self.spec,
+            'base_dir': self.base_dir,
+            'merge_policy': self.merge_policy
+        }
+
+    @classmethod
+    def from_dict(cls, session_dict:dict) -> 'Session':
+        return cls(**session_dict)
+
+    def __repr__(self) -> str:
+        return f'Session({self.name})'
+
+
+class SessionEstimate(object):
+    """
+    Predicted cost of a session
+
+    Attributes:
+        session (:class:`.Session`): the session
+        interfaces (dict): ``{interface name: (bytes, seconds)}``
+    """
+
+    def __init__(self, session:Session, interfaces:typing.Dict[str, typing.Tuple[int, float]]):
+        self.session = session
+        self.interfaces = interfaces
+
+    @property
+    def bytes(self) -> int:
+        return sum(n_bytes for n_bytes, _ in self.interfaces.values())
+
+    @property
+    def seconds(self) -> float:
+        return sum(seconds for _, seconds in self.interfaces.values())
+
+
+class CostModel(object):
+    """
+    Predict how long an interface will take to convert from the size of its source files.
+
+    Each interface class gets a fixed overhead and a throughput (bytes/second), starting
+    from :attr:`.DEFAULT_OVERHEAD` and :attr:`.DEFAULT_RATE` , and calibrated by :meth:`.update`
+    with the actual timings of sessions as they finish.
+
+    Args:
+        path (str, :class:`pathlib.Path`): Optional. JSON file to load calibration from and :meth:`.save` it to.
+    """
+
+    DEFAULT_RATE = 50e6
+    """bytes per second if we haven't seen an interface before"""
+    DEFAULT_OVERHEAD = 5.0
+    """seconds per interface regardless of size, eg. for imports and opening files"""
+    SMOOTHING = 0.3
+    """how much each new timing moves the calibration"""
+
+    def __init__(self, path:typing.Optional[typing.Union[str, Path]]=None):
+        self.path = Path(path) if path is not None else None
+        # interface class name: {'rate': bytes/second, 'overhead': seconds}
+        self.interfaces = {} # type: typing.Dict[str, typing.Dict[str, float]]
+        if self.path is not None and self.path.exists():
+            with open(self.path, 'r') as f:
+                self.interfaces = json.load(f)
+
+    @staticmethod
+    def _name(interface_class:type) -> str:
+        return f'{interface_class.__module__}.{interface_class.__name__}'
+
+    def predict(self, interface_class:type, n_bytes:int) -> float:
+        """Predicted seconds to convert ``n_bytes`` with some interface class"""
+        params = self.interfaces.get(self._name(interface_class), {})
+        return params.get('overhead', self.DEFAULT_OVERHEAD) + n_bytes / params.get('rate', self.DEFAULT_RATE)
+
+    def estimate(self, session:Session) -> SessionEstimate:
+        """
+        Estimate the bytes and seconds of each interface in a session, without instantiating anything,
+        from the sizes of the files in its source data (see :func:`.memory.source_file_size` )
+        """
+        interface_classes = session.converter_class().data_interface_classes
+        interfaces = {}
+        for name, source_data in session.source_data.items():
+            interface_class = interface_classes[name]
+            try:
+                n_bytes = source_file_size(interface_class, source_data)
+            except OSError:
+                n_bytes = 0
+            interfaces[name] = (n_bytes, self.predict(interface_class, n_bytes))
+        return SessionEstimate(session, interfaces)
+
+    def update(self, estimate:SessionEstimate, elapsed:float):
+        """
+        Calibrate with the actual time a session took.
+
+        We can only time whole sessions, so every interface in the session has its rate and
+        overhead nudged (by :attr:`.SMOOTHING` ) towards what would have predicted ``elapsed`` .
+        """
+        if estimate.seconds <= 0:
+            return
+        ratio = elapsed / estimate.seconds
+        interface_classes = estimate.session.converter_class().data_interface_classes
+        for name in estimate.interfaces:
+            key = self._name(interface_classes[name])
+            params = self.interfaces.setdefault(key, {'rate': self.DEFAULT_RATE, 'overhead': self.DEFAULT_OVERHEAD})
+            scale = 1 + self.SMOOTHING * (ratio - 1)
+            params['rate'] /= scale
+            params['overhead'] *= scale
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                json.dump(self.interfaces, f, indent=2)
+
+
+class Plan(object):
+    """
+    Sessions in the order they'll be dispatched (largest first), and the predicted
+    assignment of them to workers.
+
+    Attributes:
+        estimates (list): :class:`.SessionEstimate` s, largest first
+        workers (list): list of the estimates each worker is predicted to run
+        makespan (float): predicted seconds until the whole batch is done
+    """
+
+    def __init__(self, estimates:typing.List[SessionEstimate], n_workers:int):
+        self.estimates = sorted(estimates, key=lambda estimate: estimate.seconds, reverse=True)
+        self.workers = [[] for _ in range(n_workers)] # type: typing.List[typing.List[SessionEstimate]]
+
+        # each session goes to whichever worker frees up first
+        loads = [(0.0, i) for i in range(n_workers)]
+        for estimate in self.estimates:
+            load, worker = heapq.heappop(loads)
+            self.workers[worker].append(estimate)
+            heapq.heappush(loads, (load + estimate.seconds, worker))
+        self.makespan = max(load for load, _ in loads) if len(loads) > 0 else 0.0
+
+    def __str__(self) -> str:
+        total = sum(estimate.seconds for estimate in self.estimates)
+        lines = [f'{len(self.estimates)} sessions, {format_size(sum(e.bytes for e in self.estimates))}, '
+                 f'{_format_duration(total)} of work on {len(self.workers)} workers',
+                 f'predicted makespan: {_format_duration(self.makespan)}']
+        for i, worker in enumerate(self.workers):
+            lines.append(f'  worker {i}: {len(worker)} sessions, {_format_duration(sum(e.seconds for e in worker))}')
+        return '\n'.join(lines)
+
+
+def _format_duration(seconds:float) -> str:
+    hours, seconds = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{hours}h{minutes:02d}m{seconds:02d}s'
+
+
+def plan(sessions:typing.List[Session], n_workers:int,
+         cost_model:typing.Optional[CostModel]=None) -> Plan:
+    """
+    Estimate each session and plan their largest-first dispatch to ``n_workers`` workers
+
+    Returns:
+        :class:`.Plan`
+    """
+    if cost_model is None:
+        cost_model = CostModel()
+    return Plan([cost_model.estimate(session) for session in sessions], n_workers)
+
+
+def _run_session(session_dict:dict) -> typing.Tuple[str, float, typing.Optional[str]]:
+    """Worker function: run a session, returning (name, elapsed, traceback if it failed)"""
+    session = Session.from_dict(session_dict)
+    start_time = time.time()
+    try:
+        return session.name, session.run(), None
+    except Exception:
+        return session.name, time.time() - start_time, traceback.format_exc()
+
+
+def run_batch(sessions:typing.List[Session],
+              n_workers:int=4,
+              cost_model:typing.Optional[typing.Union[str, Path, CostModel]]=None,
+              dry_run:bool=False,
+              share_files:bool=False) -> typing.Dict[str, typing.Tuple[float, typing.Optional[str]]]:
+    """
+    Convert a batch of sessions in parallel, largest first.
+
+    Prints the :class:`.Plan` (including its predicted makespan) before starting, and
+    calibrates and saves the ``cost_model`` with each session's timing as it finishes.
+
+    Args:
+        sessions (list): :class:`.Session` s to convert
+        n_workers (int): number of worker processes
+        cost_model (str, :class:`pathlib.Path`, :class:`.CostModel`): the cost model or the path of its JSON file
+        dry_run (bool): only print the plan
+        share_files (bool): load each file that specs read (eg. a shared animal notebook) once,
+            and share its arrays between the workers, see :mod:`.spec.shared`
+
+    Returns:
+        dict of ``{session name: (seconds, traceback or None if it succeeded)}``
+    """
+    if not isinstance(cost_model, CostModel):
+        cost_model = CostModel(cost_model)
+
+    batch_plan = plan(sessions, n_workers, cost_model)
+    print(batch_plan)
+    if dry_run:
+        return {}
+
+    estimates = {estimate.session.name: estimate for estimate in batch_plan.estimates}
+    results = {}
+    shared = None
+    executor_kwargs = {}
+    if share_files:
+        from onice_conversion.spec.shared import SharedFileCache
+        shared = SharedFileCache()
+        executor_kwargs = {'initializer': SharedFileCache.install, 'initargs': (shared,)}
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, **executor_kwargs) as executor:
+            # submitted largest first, and the executor hands them out in order as workers free up
+            futures = [executor.submit(_run_session, estimate.session.to_dict()) for estimate in batch_plan.estimates]
+            for future in as_completed(futures):
+                name, elapsed, error = future.result()
+                results[name] = (elapsed, error)
+                if error is None:
+                    cost_model.update(estimates[name], elapsed)
+                    cost_model.save()
+                else:
+                    print(f'{name} failed:\n{error}')
+    finally:
+        if shared is not None:
+            shared.close()
+
+    return results
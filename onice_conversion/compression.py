@@ -0,0 +1,363 @@
+"""
+Read gzip, bz2, and xz compressed source files without decompressing them to disk first.
+
+Compressed files are detected by their extension (or their magic bytes), and read through
+a :class:`.DecompressedFile` , a seekable file object that decompresses as it's read::
+
+    with open_decompressed('notes.json.gz', 'r') as f:
+        notes = json.load(f)
+
+which external file specs (:mod:`.spec.external_file` ) and data sources
+(:class:`.datasource.RawBinarySource` , :class:`.datasource.MatSource` ) use to read compressed
+files like uncompressed ones.
+
+Compressed streams can only be decompressed from the start, so to read from the middle of
+a file, a :class:`.DecompressedFile` keeps checkpoints as it goes (a :class:`.DecompressionIndex` ):
+every :data:`.CHECKPOINT_SPAN` bytes of gzip output, a copy of the decompressor's state, and
+the start of every compressed member (or bz2/xz stream -- their decompressors can't be copied,
+but eg. files compressed with ``pigz`` , ``pbzip2`` or ``xz -T`` are made of many). Seeking
+resumes from the nearest checkpoint before the target rather than from the start of the file.
+Indices are kept for the last :data:`.MAX_INDICES` files (by path, size, and mtime), so
+readers that open the same file again, eg. chunked reads of a :class:`.datasource.RawBinarySource` ,
+reuse them.
+"""
+import bisect
+import bz2
+import io
+import lzma
+import os
+import threading
+import typing
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+FORMATS = {
+    'gzip': (b'\x1f\x8b', ('.gz', '.gzip')),
+    'bz2': (b'BZh', ('.bz2',)),
+    'xz': (b'\xfd7zXZ\x00', ('.xz', '.lzma'))
+} # type: typing.Dict[str, typing.Tuple[bytes, typing.Tuple[str, ...]]]
+"""``{format: (magic bytes, extensions)}`` of the compression formats we can read"""
+
+CHECKPOINT_SPAN = 2**22
+"""Bytes of decompressed gzip data between checkpoints"""
+
+READ_SIZE = 2**16
+"""Bytes of compressed data read at a time"""
+
+MAX_INDICES = 32
+"""Number of files to keep :class:`.DecompressionIndex` es for"""
+
+HEAD_SIZE = 2**10
+"""Bytes at the start of a file that have to decompress for it to be detected as compressed by its magic bytes"""
+
+
+def detect_compression(path:typing.Union[str, Path]) -> typing.Optional[str]:
+    """
+    Which compression format a file is in, by its extension, or if it doesn't have one of
+    theirs, by its magic bytes.
+
+    A raw binary can start with a format's magic bytes by chance (eg. an int16 sample of ``0x8b1f`` ),
+    so the start of the file also has to decompress without errors to count as compressed.
+
+    Returns:
+        ``'gzip'`` , ``'bz2'`` , ``'xz'`` , or None if it doesn't look compressed
+    """
+    suffix = Path(path).suffix.lower()
+    for compression, (_, extensions) in FORMATS.items():
+        if suffix in extensions:
+            return compression
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(HEAD_SIZE)
+    except OSError:
+        return None
+    for compression, (magic, _) in FORMATS.items():
+        if head.startswith(magic) and _decompresses(compression, head):
+            return compression
+    return None
+
+def _decompresses(compression:str, head:bytes) -> bool:
+    """Whether the start of a file is a valid start of a compressed stream"""
+    try:
+        _Member(compression).decompressor.decompress(head)
+    except (OSError, EOFError, ValueError, zlib.error, lzma.LZMAError):
+        return False
+    return True
+
+
+def compressed_path(path:typing.Union[str, Path]) -> Path:
+    """
+    A path, or if it doesn't exist, a compressed version of it that does,
+    eg. ``notes.json.gz`` for ``notes.json`` . The path itself if neither exists.
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    for _, extensions in FORMATS.values():
+        for extension in extensions:
+            candidate = path.with_name(path.name + extension)
+            if candidate.exists():
+                return candidate
+    return path
+
+
+def open_decompressed(path:typing.Union[str, Path], mode:str='rb',
+                      encoding:typing.Optional[str]=None,
+                      errors:typing.Optional[str]=None) -> typing.IO:
+    """
+    Open a file for reading like :func:`open` , decompressing it if it's compressed
+
+    Args:
+        path (str, :class:`pathlib.Path`): the file
+        mode (str): ``'rb'`` or ``'r'``
+        encoding (str): for text mode
+        errors (str): for text mode
+
+    Returns:
+        a buffered (and for text mode, decoding) :class:`.DecompressedFile` if it's compressed,
+        otherwise the opened file
+    """
+    if mode not in ('r', 'rb'):
+        raise ValueError(f'Can only open files for reading, not {mode}')
+    compression = detect_compression(path)
+    if compression is None:
+        return open(path, mode, encoding=encoding, errors=errors) if mode == 'r' else open(path, mode)
+    reader = io.BufferedReader(DecompressedFile(path, compression), buffer_size=READ_SIZE)
+    if mode == 'rb':
+        return reader
+    return io.TextIOWrapper(reader, encoding=encoding, errors=errors)
+
+
+class _Checkpoint(typing.NamedTuple):
+    position: int
+    """position in the decompressed data"""
+    offset: int
+    """where to resume reading compressed data"""
+    state: typing.Any
+    """a decompressor to copy to resume from, or None to start a new member at ``offset``"""
+
+
+class DecompressionIndex(object):
+    """
+    Checkpoints to resume decompressing a file from, see module docs.
+    Shared by every :class:`.DecompressedFile` reading the same file, in any thread.
+
+    Attributes:
+        checkpoints (list): of ``(decompressed position, compressed offset, decompressor state)``
+        size (int): size of the decompressed data, once it's been read to the end
+    """
+
+    def __init__(self, span:int=CHECKPOINT_SPAN):
+        self.span = span
+        self.checkpoints = [_Checkpoint(0, 0, None)] # type: typing.List[_Checkpoint]
+        self._positions = [0]
+        self.size = None # type: typing.Optional[int]
+        self._lock = threading.Lock()
+
+    def add(self, position:int, offset:int, state:typing.Any=None):
+        # readers go forward from a checkpoint, so anything before the last one is already covered
+        with self._lock:
+            if position > self._positions[-1]:
+                self.checkpoints.append(_Checkpoint(position, offset, state))
+                self._positions.append(position)
+
+    def find(self, position:int) -> _Checkpoint:
+        """The last checkpoint at or before a position"""
+        return self.checkpoints[bisect.bisect_right(self._positions, position) - 1]
+
+
+_indices = OrderedDict() # type: OrderedDict[tuple, DecompressionIndex]
+_indices_lock = threading.Lock()
+
+def get_index(path:typing.Union[str, Path], compression:str, span:int=CHECKPOINT_SPAN) -> DecompressionIndex:
+    """
+    The :class:`.DecompressionIndex` for a file, made if we don't have one for its current size and mtime
+    """
+    stat = os.stat(path)
+    key = (str(Path(path).absolute()), stat.st_size, stat.st_mtime_ns, compression, span)
+    with _indices_lock:
+        index = _indices.get(key)
+        if index is None:
+            index = _indices[key] = DecompressionIndex(span)
+            while len(_indices) > MAX_INDICES:
+                _indices.popitem(last=False)
+        else:
+            _indices.move_to_end(key)
+    return index
+
+
+class _Member(object):
+    """Decompressor for one gzip member or bz2/xz stream"""
+
+    def __init__(self, compression:str, state:typing.Any=None):
+        self.compression = compression
+        if state is not None:
+            self.decompressor = state.copy()
+        elif compression == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif compression == 'bz2':
+            self.decompressor = bz2.BZ2Decompressor()
+        else:
+            self.decompressor = lzma.LZMADecompressor()
+        # zlib hands back input it couldn't use yet, rather than keeping it
+        self.tail = b''
+
+    @property
+    def copyable(self) -> bool:
+        return self.compression == 'gzip'
+
+    @property
+    def eof(self) -> bool:
+        return self.decompressor.eof
+
+    @property
+    def unused_data(self) -> bytes:
+        return self.decompressor.unused_data
+
+    def decompress(self, raw:typing.BinaryIO, max_length:int) -> bytes:
+        """Up to ``max_length`` bytes, reading input from ``raw`` as needed. Empty at the end of the member."""
+        while not self.decompressor.eof:
+            if self.compression == 'gzip':
+                data = self.tail or raw.read(READ_SIZE)
+                if not data:
+                    raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+                out = self.decompressor.decompress(data, max_length)
+                self.tail = self.decompressor.unconsumed_tail
+            else:
+                data = b''
+                if self.decompressor.needs_input:
+                    data = raw.read(READ_SIZE)
+                    if not data:
+                        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+                out = self.decompressor.decompress(data, max_length)
+            if out:
+                return out
+        return b''
+
+
+class DecompressedFile(io.RawIOBase):
+    """
+    Seekable, read-only file object of the decompressed contents of a compressed file, see module docs.
+
+    Usually used through :func:`.open_decompressed` , which buffers it.
+    Like other file objects, one shouldn't be read from more than one thread at a time,
+    open one for each instead (they share the file's :class:`.DecompressionIndex` ).
+
+    Args:
+        path (str, :class:`pathlib.Path`): the compressed file
+        compression (str): its format, detected if None
+        span (int): bytes of decompressed gzip data between checkpoints
+    """
+
+    def __init__(self, path:typing.Union[str, Path], compression:typing.Optional[str]=None, span:int=CHECKPOINT_SPAN):
+        super(DecompressedFile, self).__init__()
+        self.path = Path(path)
+        self.compression = compression if compression is not None else detect_compression(self.path)
+        if self.compression not in FORMATS:
+            raise ValueError(f'{self.path} is not compressed in a format we can read: {tuple(FORMATS)}')
+        self.index = get_index(self.path, self.compression, span)
+        self._raw = open(self.path, 'rb')
+        self._magic = FORMATS[self.compression][0]
+        self._position = 0
+        # where the decompressor is, which is behind self._position after a seek until the next read
+        self._member = None # type: typing.Optional[_Member]
+        self._decompressed = 0
+        self._restore(self.index.checkpoints[0])
+
+    @property
+    def size(self) -> int:
+        """Size of the decompressed data, which has to be read to the end once to know"""
+        if self.index.size is None:
+            self._advance(float('inf'))
+        return self.index.size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self._position = position
+        return position
+
+    def readinto(self, buffer) -> int:
+        """Fill ``buffer`` , unless the file ends first"""
+        self._advance(self._position)
+        view = memoryview(buffer).cast('B')
+        n_read = 0
+        while n_read < len(view) and self._decompressed == self._position:
+            data = self._read(len(view) - n_read)
+            if not data:
+                break
+            view[n_read:n_read + len(data)] = data
+            n_read += len(data)
+            self._position += len(data)
+        return n_read
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super(DecompressedFile, self).close()
+
+    def _restore(self, checkpoint:_Checkpoint):
+        self._raw.seek(checkpoint.offset)
+        self._member = _Member(self.compression, checkpoint.state)
+        self._decompressed = checkpoint.position
+
+    def _advance(self, position:typing.Union[int, float]):
+        """Move the decompressor to a position (or the end of the file, if that's before it)"""
+        if position == self._decompressed:
+            return
+        checkpoint = self.index.find(position)
+        if position < self._decompressed or checkpoint.position > self._decompressed:
+            self._restore(checkpoint)
+        while self._decompressed < position:
+            if not self._read(int(min(position - self._decompressed, READ_SIZE * 16))):
+                break
+
+    def _read(self, n:int) -> bytes:
+        """Decompress up to ``n`` bytes at the decompressor's position, adding checkpoints as we pass them"""
+        while self._member is not None:
+            next_checkpoint = (self._decompressed // self.index.span + 1) * self.index.span
+            out = self._member.decompress(self._raw, min(n, next_checkpoint - self._decompressed))
+            if out:
+                self._decompressed += len(out)
+                if self._decompressed == next_checkpoint and self._member.copyable:
+                    self.index.add(self._decompressed, self._raw.tell() - len(self._member.tail),
+                                   self._member.decompressor.copy())
+                return out
+
+            # end of the member, is there another one?
+            rest = self._member.unused_data
+            while True:
+                # skip padding (xz streams can have some between them)
+                rest = rest.lstrip(b'\x00')
+                if len(rest) >= len(self._magic):
+                    break
+                more = self._raw.read(READ_SIZE)
+                if not more:
+                    break
+                rest += more
+            if not rest.startswith(self._magic):
+                self.index.size = self._decompressed
+                self._member = None
+                return b''
+            start = self._raw.tell() - len(rest)
+            self.index.add(self._decompressed, start)
+            self._restore(_Checkpoint(self._decompressed, start, None))
+        return b''
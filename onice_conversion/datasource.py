@@ -0,0 +1,528 @@
+"""
+Hand array data from source files to NWB containers without copying it.
+
+Arrays loaded with :func:`scipy.io.loadmat` , :func:`numpy.fromfile` or :func:`numpy.genfromtxt`
+are copies of the file in memory, and then slicing out a column (eg. ``frame_params[:, 0]``)
+makes a non-contiguous view that gets copied again when it's written. Instead,
+a :class:`.DataSource` :
+
+* memory-maps the data where it is in the file, for raw binaries (:class:`.RawBinarySource` )
+  and numeric variables in uncompressed ``.mat`` files (:class:`.MatSource` ),
+* gives columns as strided views (:meth:`.DataSource.column` ) rather than copies
+  (matlab arrays are column-major, so their columns are contiguous anyway!),
+* and reads contiguous blocks of rows for writing (:meth:`.DataSource.read` ), only copying
+  when the view isn't contiguous already.
+
+Compressed (gzip, bz2, xz) raw binaries can't be memory-mapped, so their rows are
+decompressed as they're read instead (:class:`.DecompressedArray` , see :mod:`.compression` ),
+and compressed ``.mat`` files are loaded through the decompressor.
+
+Sources can be used as the ``source`` of a :meth:`.PipelinedWriter.add_stream` , or wrapped
+in a :class:`.SourceChunkIterator` to use as the data of any container.
+
+To check how much is being copied, use :func:`.track_copies` ::
+
+    with track_copies() as copies:
+        sniff = RawBinarySource('sniff.bin', dtype='float')
+        nwbfile.add_acquisition(TimeSeries(name='sniff_signal', data=H5DataIO(SourceChunkIterator(sniff)), ...))
+        io.write(nwbfile)
+    print(copies)
+"""
+import contextlib
+import struct
+import threading
+import typing
+from pathlib import Path
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+from onice_conversion.compression import DecompressedFile, detect_compression, open_decompressed
+
+
+class CopyCounter(object):
+    """
+    Count of the copies made by data sources while :func:`.track_copies` is active
+
+    Attributes:
+        copies (int): number of times array data was copied
+        bytes (int): total bytes copied
+    """
+
+    def __init__(self):
+        self.copies = 0
+        self.bytes = 0
+
+    def count(self, array:np.ndarray):
+        self.copies += 1
+        self.bytes += array.nbytes
+
+    def __str__(self) -> str:
+        return f'{self.copies} copies, {self.bytes / 1e6:.1f} MB'
+
+
+_copy_counter = None # type: typing.Optional[CopyCounter]
+
+@contextlib.contextmanager
+def track_copies() -> typing.Iterator[CopyCounter]:
+    """
+    Debug mode: count every copy of array data made by data sources inside the ``with`` block
+
+    Yields:
+        :class:`.CopyCounter`
+    """
+    global _copy_counter
+    previous = _copy_counter
+    _copy_counter = CopyCounter()
+    try:
+        yield _copy_counter
+    finally:
+        _copy_counter = previous
+
+def _copied(array:np.ndarray) -> np.ndarray:
+    """Record that ``array`` is a copy, if we're tracking copies"""
+    if _copy_counter is not None:
+        _copy_counter.count(array)
+    return array
+
+
+class DataSource(object):
+    """
+    An array in a file (or memory) that can be read without copying.
+
+    Subclasses set :attr:`.array` to an array or memmap of the data, and it's
+    only ever sliced into views until it is :meth:`.read`
+    """
+
+    def __init__(self):
+        self.array = None # type: typing.Optional[np.ndarray]
+
+    @property
+    def shape(self) -> typing.Tuple[int, ...]:
+        return self.array.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.array.dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, item) -> np.ndarray:
+        """Slicing gives views, not copies"""
+        return self.array[item]
+
+    def column(self, index:int) -> 'DataSource':
+        """
+        A (possibly strided) view of one column, eg. ``source.column(0)`` rather than ``frame_params[:, 0]``
+
+        Returns:
+            :class:`.ArraySource` of the view
+        """
+        return ArraySource(self.array[:, index], copy=False)
+
+    def read(self, start:int, stop:int) -> np.ndarray:
+        """
+        Read rows ``start:stop`` as a contiguous array.
+
+        A view of the source if it's contiguous already, otherwise a copy (which is counted by :func:`.track_copies` )
+        """
+        block = self.array[start:stop]
+        if block.flags.c_contiguous:
+            return block
+        return _copied(np.ascontiguousarray(block))
+
+    def chunks(self, rows:int) -> typing.Iterator[typing.Tuple[int, np.ndarray]]:
+        """
+        Iterate over contiguous blocks of ``rows`` rows
+
+        Yields:
+            tuple of (start row, :meth:`.read` block)
+        """
+        for start in range(0, self.shape[0], rows):
+            yield start, self.read(start, min(start + rows, self.shape[0]))
+
+
+class ArraySource(DataSource):
+    """
+    An array that's already in memory, eg. from :func:`numpy.genfromtxt`
+
+    Args:
+        array (:class:`numpy.ndarray`): The array
+        order (str): If ``'F'`` , store the array column-major (one copy, now) so that all of
+            its :meth:`.column` s are contiguous, rather than copying each block of each column later.
+        copy (bool): Whether ``array`` was copied to make it (ie. whether to count it with :func:`.track_copies` )
+    """
+
+    def __init__(self, array:np.ndarray, order:str='K', copy:bool=False):
+        super(ArraySource, self).__init__()
+        array = np.asarray(array)
+        if order == 'F' and not array.flags.f_contiguous:
+            array = _copied(np.asfortranarray(array))
+        elif copy:
+            _copied(array)
+        self.array = array
+
+
+class RawBinarySource(DataSource):
+    """
+    A raw binary file, memory-mapped, eg. in place of ``np.fromfile('sniff.bin', dtype='float')``
+
+    If the file is compressed (see :func:`.compression.detect_compression` ), its rows are
+    decompressed when they're read, see :class:`.DecompressedArray`
+
+    Args:
+        path (str, :class:`pathlib.Path`): The file
+        dtype: numpy dtype of the data
+        offset (int): bytes to skip at the start of the file (eg. a header)
+        shape (tuple): shape of the data. If None, a 1D array of everything after ``offset`` .
+            Use ``-1`` for the first dimension to fill the file, eg. ``(-1, 8)`` for 8 interleaved channels
+        order (str): ``'C'`` for row-major, ``'F'`` for column-major
+    """
+
+    def __init__(self, path:typing.Union[str, Path], dtype='float',
+                 offset:int=0,
+                 shape:typing.Optional[typing.Tuple[int, ...]]=None,
+                 order:str='C'):
+        super(RawBinarySource, self).__init__()
+        self.path = Path(path)
+        self.compression = detect_compression(self.path)
+        dtype = np.dtype(dtype)
+
+        if self.compression is not None:
+            decompressed = DecompressedFile(self.path, self.compression)
+
+        if shape is None or shape[0] == -1:
+            # only decompress the whole file to find its size if we have to
+            size = decompressed.size if self.compression is not None else self.path.stat().st_size
+            row_size = int(np.prod(shape[1:], dtype=int)) if shape is not None else 1
+            n_rows = (size - offset) // (dtype.itemsize * row_size)
+            shape = (n_rows,) + (tuple(shape[1:]) if shape is not None else ())
+
+        if self.compression is None:
+            self.array = np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=tuple(shape), order=order)
+        elif order == 'C':
+            self.array = DecompressedArray(decompressed, dtype, offset, tuple(shape))
+        else:
+            # columns are contiguous, not rows, so there's no reading it a block of rows at a time
+            self.array = DecompressedArray(decompressed, dtype, offset, tuple(shape[::-1])).read(0, shape[-1]).T
+
+    def column(self, index:int) -> 'DataSource':
+        """
+        A (possibly strided) view of one column, see :meth:`.DataSource.column` .
+        For compressed files, a source that reads just that column from blocks of rows as they're read.
+        """
+        if not isinstance(self.array, DecompressedArray):
+            return super(RawBinarySource, self).column(index)
+        column = DataSource()
+        column.array = self.array.column(index)
+        return column
+
+
+class DecompressedArray(object):
+    """
+    Enough of an array for a :class:`.DataSource` over a row-major array in a compressed file:
+    slicing it decompresses (and copies, counted by :func:`.track_copies` ) only the rows needed,
+    from the nearest checkpoint of the :class:`.compression.DecompressedFile` , rather than from the
+    start of the file.
+
+    It can be read from many threads at once (eg. the readers of a :class:`.PipelinedWriter` ),
+    each read uses its own :class:`.compression.DecompressedFile` .
+
+    Args:
+        file (:class:`.compression.DecompressedFile`): the decompressed file
+        dtype: numpy dtype of the data
+        offset (int): bytes before the data in the decompressed file
+        shape (tuple): shape of the data
+        columns: index into each row, for :meth:`.column`
+    """
+
+    def __init__(self, file:DecompressedFile, dtype, offset:int, shape:typing.Tuple[int, ...],
+                 columns:typing.Optional[tuple]=None, readers:typing.Optional['_ReaderPool']=None):
+        self.file = file
+        self._readers = readers if readers is not None else _ReaderPool(file)
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self._shape = shape
+        self._row_bytes = self.dtype.itemsize * int(np.prod(shape[1:], dtype=int))
+        self._columns = columns
+
+    @property
+    def shape(self) -> typing.Tuple[int, ...]:
+        if self._columns is None:
+            return self._shape
+        return (self._shape[0],) + np.empty(self._shape[1:], dtype=np.uint8)[self._columns].shape
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __len__(self) -> int:
+        return self._shape[0]
+
+    def column(self, index:int) -> 'DecompressedArray':
+        """The same rows, but only one column of each"""
+        if self._columns is not None:
+            raise ValueError('Already a column')
+        return DecompressedArray(self.file, self.dtype, self.offset, self._shape, columns=(index,), readers=self._readers)
+
+    def read(self, start:int, stop:int) -> np.ndarray:
+        """Decompress rows ``start:stop``"""
+        stop = max(start, min(stop, self._shape[0]))
+        buffer = bytearray((stop - start) * self._row_bytes)
+        position = self.offset + start * self._row_bytes
+        with self._readers.reader(position) as reader:
+            reader.seek(position)
+            n_read = reader.readinto(buffer)
+        if n_read < len(buffer):
+            raise EOFError(f'{self.file.path} ended before row {stop}')
+        rows = np.frombuffer(buffer, dtype=self.dtype).reshape((stop - start,) + self._shape[1:])
+        if self._columns is not None:
+            rows = np.ascontiguousarray(rows[(slice(None),) + self._columns])
+        return _copied(rows)
+
+    def __getitem__(self, item) -> np.ndarray:
+        if not isinstance(item, tuple):
+            item = (item,)
+        rows, rest = item[0], item[1:]
+        n_rows = self._shape[0]
+        if isinstance(rows, (int, np.integer)):
+            row = int(rows) + n_rows if rows < 0 else int(rows)
+            if not 0 <= row < n_rows:
+                raise IndexError(f'Row {rows} is out of bounds for {n_rows} rows')
+            return self.read(row, row + 1)[0][rest]
+        if isinstance(rows, slice):
+            selected = range(*rows.indices(n_rows))
+            if len(selected) == 0:
+                return self.read(0, 0)[(slice(None),) + rest]
+            first, last = min(selected), max(selected)
+            block = self.read(first, last + 1)
+            return block[(slice(selected.start - first, None, selected.step),) + rest]
+        # arrays of indices or a mask
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.nonzero(rows)[0]
+        rows = np.where(rows < 0, rows + n_rows, rows)
+        if rows.size == 0:
+            return self.read(0, 0)[(rows,) + rest]
+        first = int(rows.min())
+        return self.read(first, int(rows.max()) + 1)[(rows - first,) + rest]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        array = self.read(0, self._shape[0])
+        return array.astype(dtype) if dtype is not None else array
+
+
+class _ReaderPool(object):
+    """
+    Idle :class:`.compression.DecompressedFile` s of one file, so threads can read it at once.
+    A read takes the reader that stopped closest before where it starts, so sequential reads
+    keep decompressing where the last one left off, and opens another if they're all in use.
+    """
+
+    def __init__(self, file:DecompressedFile):
+        self.path = file.path
+        self.compression = file.compression
+        self.span = file.index.span
+        # (position it was left at, reader)
+        self._idle = [(file.tell(), file)] # type: typing.List[typing.Tuple[int, DecompressedFile]]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def reader(self, position:int) -> typing.Iterator[DecompressedFile]:
+        with self._lock:
+            before = [idle for idle in self._idle if idle[0] <= position]
+            if len(before) > 0:
+                idle = max(before, key=lambda idle: idle[0])
+            elif len(self._idle) > 0:
+                idle = self._idle[-1]
+            else:
+                idle = None
+            if idle is not None:
+                self._idle.remove(idle)
+        reader = idle[1] if idle is not None else DecompressedFile(self.path, self.compression, self.span)
+        try:
+            yield reader
+        finally:
+            with self._lock:
+                self._idle.append((reader.tell(), reader))
+
+
+# --------------------------------------------------
+# .mat files
+# --------------------------------------------------
+
+_MAT_CLASSES = {6: 'f8', 7: 'f4', 8: 'i1', 9: 'u1', 10: 'i2', 11: 'u2', 12: 'i4', 13: 'u4', 14: 'i8', 15: 'u8'}
+"""numeric mxCLASS codes to numpy dtypes"""
+
+_MAT_TYPES = {1: 'i1', 2: 'u1', 3: 'i2', 4: 'u2', 5: 'i4', 6: 'u4', 7: 'f4', 9: 'f8', 12: 'i8', 13: 'u8'}
+"""numeric miTYPE codes to numpy dtypes"""
+
+_MI_MATRIX, _MI_COMPRESSED = 14, 15
+
+
+def find_mat_variable(path:typing.Union[str, Path], variable:str) -> typing.Optional[typing.Tuple[int, np.dtype, tuple]]:
+    """
+    Find where a numeric variable's data is in an uncompressed v5 ``.mat`` file
+
+    Walks the top-level data elements, reading only their tags and headers.
+
+    Args:
+        path (str, :class:`pathlib.Path`): the ``.mat`` file
+        variable (str): name of the variable
+
+    Returns:
+        tuple of (byte offset, dtype, shape) of the (column-major) data if it can be memory-mapped,
+        or None if it can't: it isn't there, or is compressed, complex, sparse, not numeric,
+        or stored as a different type than its class (matlab does that to save space).
+    """
+    with open(path, 'rb') as f:
+        header = f.read(128)
+        if len(header) < 128 or header[126:128] not in (b'IM', b'MI'):
+            # v4 or not a mat file (v7.3 files are hdf5, and have 'MATLAB 7.3' in their header)
+            return None
+        endian = '<' if header[126:128] == b'IM' else '>'
+
+        def read_tag():
+            raw = f.read(8)
+            if len(raw) < 8:
+                return None
+            mi_type, n_bytes = struct.unpack(endian + 'II', raw)
+            if mi_type >> 16:
+                # small data element: type and size packed in the first 4 bytes, data in the next 4
+                n_bytes, mi_type = mi_type >> 16, mi_type & 0xffff
+                f.seek(-4, 1)
+                return mi_type, n_bytes, f.tell(), 4
+            return mi_type, n_bytes, f.tell(), n_bytes + (-n_bytes % 8)
+
+        position = 128
+        while True:
+            f.seek(position)
+            tag = read_tag()
+            if tag is None:
+                return None
+            mi_type, n_bytes, data_start, _ = tag
+            position = data_start + n_bytes + (0 if mi_type == _MI_COMPRESSED else -n_bytes % 8)
+            if mi_type != _MI_MATRIX:
+                continue
+
+            # array flags
+            _, _, flags_start, flags_size = read_tag()
+            flags = struct.unpack(endian + 'I', f.read(4))[0]
+            f.seek(flags_start + flags_size)
+            # dimensions
+            _, dims_bytes, dims_start, dims_size = read_tag()
+            dims = struct.unpack(endian + 'i' * (dims_bytes // 4), f.read(dims_bytes))
+            f.seek(dims_start + dims_size)
+            # name
+            _, name_bytes, name_start, name_size = read_tag()
+            name = f.read(name_bytes).decode('ascii', errors='replace')
+            f.seek(name_start + name_size)
+            if name != variable:
+                continue
+
+            mx_class, is_complex = flags & 0xff, flags & 0x800
+            if mx_class not in _MAT_CLASSES or is_complex:
+                return None
+            real_type, real_bytes, real_start, _ = read_tag()
+            if _MAT_TYPES.get(real_type) != _MAT_CLASSES[mx_class]:
+                return None
+            dtype = np.dtype(endian + _MAT_TYPES[real_type])
+            if real_bytes != int(np.prod(dims, dtype=int)) * dtype.itemsize:
+                return None
+            return real_start, dtype, tuple(dims)
+
+
+class MatSource(DataSource):
+    """
+    A numeric variable in a ``.mat`` file, memory-mapped where it sits in the file if we can
+    (see :func:`.find_mat_variable` ), or loaded with :func:`scipy.io.loadmat` (and counted as a copy) otherwise,
+    eg. if the file is compressed (see :mod:`.compression` ).
+
+    Matlab arrays are column-major, so the columns of a memory-mapped 2D variable are contiguous.
+
+    Args:
+        path (str, :class:`pathlib.Path`): the ``.mat`` file
+        variable (str): name of the variable
+        squeeze (bool): drop singleton dimensions, eg. to make a ``(n, 1)`` vector ``(n,)``
+    """
+
+    def __init__(self, path:typing.Union[str, Path], variable:str, squeeze:bool=True):
+        super(MatSource, self).__init__()
+        self.path = Path(path)
+        self.variable = variable
+
+        compressed = detect_compression(self.path) is not None
+        location = find_mat_variable(self.path, variable) if not compressed else None
+        if location is not None:
+            offset, dtype, shape = location
+            array = np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F')
+            self.mapped = True
+        else:
+            from scipy.io import loadmat
+            with open_decompressed(self.path, 'rb') as f:
+                array = _copied(loadmat(f, variable_names=[variable])[variable])
+            self.mapped = False
+
+        self.array = array.squeeze() if squeeze else array
+
+
+# --------------------------------------------------
+# writing
+# --------------------------------------------------
+
+def read_block(source, start:int, stop:int) -> np.ndarray:
+    """
+    Read rows ``start:stop`` of any source as a contiguous array,
+    using :meth:`.DataSource.read` for data sources.
+    """
+    if isinstance(source, DataSource):
+        return source.read(start, stop)
+    return np.ascontiguousarray(source[start:stop])
+
+
+class SourceChunkIterator(AbstractDataChunkIterator):
+    """
+    Write a :class:`.DataSource` with hdmf, in contiguous blocks of rows read straight from the source.
+
+    Use as the data of a container, or wrapped in a :class:`hdmf.backends.hdf5.H5DataIO` to compress it::
+
+        TimeSeries(name='sniff_signal', data=H5DataIO(SourceChunkIterator(sniff), compression='gzip'), ...)
+
+    Args:
+        source (:class:`.DataSource`): the source to write
+        buffer_rows (int): rows per block. If None, about 1MB of rows
+    """
+
+    def __init__(self, source:DataSource, buffer_rows:typing.Optional[int]=None):
+        self.source = source
+        if buffer_rows is None:
+            row_bytes = max(1, int(np.prod(source.shape[1:], dtype=int)) * source.dtype.itemsize)
+            buffer_rows = max(1, 2**20 // row_bytes)
+        self.buffer_rows = buffer_rows
+        self._chunks = None # type: typing.Optional[typing.Iterator]
+
+    def __iter__(self):
+        self._chunks = self.source.chunks(self.buffer_rows)
+        return self
+
+    def __next__(self) -> DataChunk:
+        if self._chunks is None:
+            iter(self)
+        start, block = next(self._chunks)
+        selection = (slice(start, start + block.shape[0]),) + tuple(slice(0, dim) for dim in block.shape[1:])
+        return DataChunk(data=block, selection=selection)
+
+    def recommended_chunk_shape(self) -> tuple:
+        return (min(self.buffer_rows, self.source.shape[0]),) + tuple(self.source.shape[1:])
+
+    def recommended_data_shape(self) -> tuple:
+        return tuple(self.source.shape)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.source.dtype
+
+    @property
+    def maxshape(self) -> tuple:
+        return tuple(self.source.shape)
@@ -0,0 +1,714 @@
+"""
+Find which interfaces can open which files -- the machinery behind :meth:`.NWBConverter.hail_mary`
+
+Trying every interface on every file is expensive, so results can be kept in a
+:class:`.DiscoveryCache` : every attempt (hit or miss) is stored along with the
+size and mtime of the path, and on the next scan only new or modified paths are tried again.
+
+If you only want to know which interface opens some folder, use ``ranked=True`` with
+``max_hits_per_path`` or ``max_hits_per_type`` and/or a ``time_budget`` in :func:`.discover` --
+attempts are ordered by how likely they are to work (see :func:`.score_attempt` )
+and discovery stops as soon as enough hits are found.
+
+To scan a large archive without keeping every extractor (and its open files, memmaps,
+and sometimes its data) alive, use ``probe=True`` : each instance is reduced to a few
+:func:`.summarize` d properties and closed immediately, and is only instantiated
+again if the hit's :attr:`.Hit.instance` is used.
+
+Trees with thousands of nearly identical files (per-trial ``.mat`` files, per-channel
+``.continuous`` files) can be scanned with ``sample=n`` : paths are grouped by their
+:func:`.path_pattern` -- digit runs collapsed, extension kept, so ``trial_0001.mat`` and
+``trial_0002.mat`` are both ``trial_#.mat`` -- only ``n`` representatives of each group are
+tried, and their hits are extrapolated to the rest of the group (as hits with
+:attr:`.Hit.extrapolated` set). ``verify=k`` also tries ``k`` random other members of each
+group with hits, and if any of them disagree, or the representatives disagree with each other,
+every member of the group is tried. The cost of discovery then scales with the number
+of distinct file patterns rather than the number of files.
+"""
+import io
+import itertools
+import json
+import mmap
+import random
+import re
+import sqlite3
+import time
+import typing
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from onice_conversion.utils import _package_version
+
+
+class Hit(object):
+    """
+    An interface that instantiated successfully with some path.
+
+    Iterates like the ``(interface, path, param, instance)`` tuples that
+    :meth:`.NWBConverter.hail_mary` used to return, where ``instance`` is the instance
+    we have (None for cached or probed hits, until :attr:`.instance` is used).
+
+    Hits that were served from a :class:`.DiscoveryCache` or found with ``probe=True``
+    don't have an instance yet -- it's created on first access of :attr:`.instance` ,
+    and can be released again with :meth:`.close`
+
+    Args:
+        interface: The interface class
+        path (:class:`pathlib.Path`): path relative to ``base_dir``
+        param (str): The source data parameter the path was passed as
+        instance: The instantiated interface, if we have it
+        base_dir (:class:`pathlib.Path`): The directory ``path`` is relative to
+        cached (bool): Whether this hit came from the cache
+        score (float): How likely we thought this hit was, if discovery was ranked
+        summary (dict): Lightweight properties of the instance, see :func:`.summarize`
+        extrapolated (bool): Whether this hit wasn't tried, but inferred from other paths
+            with the same :func:`.path_pattern` when sampling
+    """
+
+    def __init__(self, interface, path:Path, param:str,
+                 instance:typing.Optional[typing.Any]=None,
+                 base_dir:typing.Optional[Path]=None,
+                 cached:bool=False,
+                 score:typing.Optional[float]=None,
+                 summary:typing.Optional[dict]=None,
+                 extrapolated:bool=False):
+        self.interface = interface
+        self.path = Path(path)
+        self.param = param
+        self.base_dir = Path(base_dir) if base_dir is not None else None
+        self.cached = cached
+        self.score = score
+        self.summary = summary if summary is not None else {}
+        self.extrapolated = extrapolated
+        self._instance = instance
+
+    @property
+    def instance(self):
+        """The instantiated interface, instantiating it if we haven't yet"""
+        if self._instance is None:
+            self._instance = self.interface(**{self.param: str(self.base_dir / self.path)})
+        return self._instance
+
+    def close(self):
+        """Close and drop the instance, if we have one. It's recreated if :attr:`.instance` is used again"""
+        if self._instance is not None:
+            close_instance(self._instance)
+            self._instance = None
+
+    def __iter__(self):
+        # don't instantiate just to unpack, the instance is None if we don't have one yet
+        return iter((self.interface, self.path, self.param, self._instance))
+
+    def __repr__(self) -> str:
+        summary = ''.join(f', {key}={value}' for key, value in self.summary.items())
+        return f'Hit({self.interface.__name__}, {self.path}, {self.param}{summary})'
+
+
+# --------------------------------------------------
+# Probing
+# --------------------------------------------------
+
+_EXTRACTOR_ATTRS = ('recording_extractor', 'sorting_extractor', 'imaging_extractor', 'segmentation_extractor')
+
+_SUMMARIES = {
+    'recording_extractor': (
+        ('n_channels', lambda x: x.get_num_channels()),
+        ('n_frames', lambda x: x.get_num_frames()),
+        ('sampling_frequency', lambda x: x.get_sampling_frequency()),
+    ),
+    'sorting_extractor': (
+        ('n_units', lambda x: len(x.get_unit_ids())),
+        ('sampling_frequency', lambda x: x.get_sampling_frequency()),
+    ),
+    'imaging_extractor': (
+        ('n_frames', lambda x: x.get_num_frames()),
+        ('image_size', lambda x: tuple(int(dim) for dim in x.get_image_size())),
+        ('sampling_frequency', lambda x: x.get_sampling_frequency()),
+    ),
+    'segmentation_extractor': (
+        ('n_rois', lambda x: x.get_num_rois()),
+        ('image_size', lambda x: tuple(int(dim) for dim in x.get_image_size())),
+    )
+}
+
+def summarize(instance) -> dict:
+    """
+    A few cheap properties of an instantiated interface, eg. the number of channels,
+    frames, and duration of a recording, to describe a hit without keeping it open.
+
+    Properties the extractor can't give are left out.
+
+    Returns:
+        dict, JSON-serializable
+    """
+    summary = {}
+    for attr, getters in _SUMMARIES.items():
+        extractor = getattr(instance, attr, None)
+        if extractor is None:
+            continue
+        for key, getter in getters:
+            try:
+                value = getter(extractor)
+            except Exception:
+                continue
+            summary[key] = value.item() if hasattr(value, 'item') else value
+
+    if 'n_frames' in summary and summary.get('sampling_frequency'):
+        summary['duration'] = summary['n_frames'] / summary['sampling_frequency']
+    return summary
+
+def close_instance(instance):
+    """
+    Close the files that an interface and its extractors hold open.
+
+    Extractors don't have a common ``close`` method, so we close any open files, mmaps,
+    and h5py objects that are attributes of the interface or its extractors (or in lists of them),
+    and drop them along with any ``np.memmap`` s -- a memmap's ``_mmap`` can't be closed while
+    the array is alive, so it's released when its last reference is.
+    The instance shouldn't be used afterwards.
+    """
+    owners = [instance] + [getattr(instance, attr) for attr in _EXTRACTOR_ATTRS
+                           if getattr(instance, attr, None) is not None]
+    for owner in owners:
+        attrs = getattr(owner, '__dict__', {})
+        for name, value in list(attrs.items()):
+            values = value if isinstance(value, (list, tuple)) else (value,)
+            released = [_release(item) for item in values]
+            if any(released):
+                attrs[name] = None
+
+def _release(value) -> bool:
+    """Close a file, mmap, or h5py object, returning whether it was one"""
+    if isinstance(value, np.memmap) or isinstance(getattr(value, '_mmap', None), mmap.mmap):
+        value = value._mmap
+        if value is None:
+            return True
+    elif not (isinstance(value, (io.IOBase, mmap.mmap)) or
+              (type(value).__module__.startswith('h5py') and hasattr(value, 'close'))):
+        return False
+    try:
+        value.close()
+    except Exception:
+        # eg. BufferError closing the mmap under a live memmap
+        pass
+    return True
+
+
+class DiscoveryResult(list):
+    """
+    List of :class:`.Hit` s, with some stats about how we got them
+
+    Attributes:
+        attempts (int): how many (interface, path, parameter) combinations were considered
+        cached (int): how many of those attempts were answered by the cache
+        elapsed (float): seconds the discovery took
+        complete (bool): False if discovery ran out of its time budget before
+            trying everything it wanted to
+        clusters (int): how many path patterns there were, when sampling
+        extrapolated (int): how many of the hits were extrapolated rather than tried, when sampling
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DiscoveryResult, self).__init__(*args, **kwargs)
+        self.attempts = 0
+        self.cached = 0
+        self.elapsed = 0.0
+        self.complete = True
+        self.clusters = 0
+        self.extrapolated = 0
+
+
+class DiscoveryCache(object):
+    """
+    Persistent record of which interfaces did and didn't instantiate with which paths.
+
+    Stored in a sqlite database, one row per ``(interface, interface version, path, param)``
+    along with the size and mtime the path had when it was tried, so a result is only
+    reused if the path hasn't changed since. Since directories' mtimes only change when
+    entries are added or removed, edits to files *within* a directory don't invalidate
+    results for that directory.
+
+    Can be used as a context manager, otherwise call :meth:`.close` when done to save results.
+
+    Args:
+        path (str, :class:`pathlib.Path`): Location of the cache database, created if it doesn't exist
+    """
+
+    def __init__(self, path:typing.Union[str, Path]):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(str(self.path))
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS attempts ('
+            'interface TEXT, version TEXT, path TEXT, param TEXT, '
+            'size INTEGER, mtime INTEGER, hit INTEGER, summary TEXT, '
+            'PRIMARY KEY (interface, version, path, param))'
+        )
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(attempts)')]
+        if 'summary' not in columns:
+            # caches made before we kept summaries
+            with self._conn:
+                self._conn.execute('ALTER TABLE attempts ADD COLUMN summary TEXT')
+        self._rows = None # type: typing.Optional[typing.Dict[tuple, tuple]]
+        self._stats = defaultdict(lambda: [0, 0]) # type: typing.Dict[tuple, typing.List[int]]
+        self._pending = []
+        self._invalid = [] # type: typing.List[typing.Tuple[str]]
+
+    @staticmethod
+    def _interface_key(interface) -> typing.Tuple[str, str]:
+        return '.'.join((interface.__module__, interface.__name__)), _package_version(interface)
+
+    def _load(self):
+        # read all the rows at once, a scan looks up most of them anyway
+        self._rows = {
+            (interface, version, path, param): (size, mtime, bool(hit), summary)
+            for interface, version, path, param, size, mtime, hit, summary
+            in self._conn.execute('SELECT interface, version, path, param, size, mtime, hit, summary FROM attempts')
+        }
+        self._stats.clear()
+        for (interface, _, path, _), (_, _, hit, _) in self._rows.items():
+            stats = self._stats[(interface, path_kind(path))]
+            stats[0] += hit
+            stats[1] += 1
+
+    def hit_stats(self, interface, kind:str) -> typing.Tuple[int, int]:
+        """
+        How often an interface has worked for paths of some kind (see :func:`.path_kind` )
+
+        Returns:
+            tuple of (hits, attempts)
+        """
+        if self._rows is None:
+            self._load()
+        stats = self._stats.get((self._interface_key(interface)[0], kind), (0, 0))
+        return stats[0], stats[1]
+
+    def lookup(self, interface, path:Path, param:str, stat=None) -> typing.Optional[bool]:
+        """
+        Whether ``interface(**{param: path})`` worked last time, if the path hasn't changed since
+
+        Args:
+            interface: interface class
+            path (:class:`pathlib.Path`): absolute path
+            param (str): source data parameter
+            stat (:class:`os.stat_result`): stat of the path, if we already have it
+
+        Returns:
+            bool if we have a result, None otherwise (including if the path can't be stat'd)
+        """
+        if self._rows is None:
+            self._load()
+        if stat is None:
+            try:
+                stat = path.stat()
+            except OSError:
+                return None
+
+        row = self._rows.get((*self._interface_key(interface), str(path), param))
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return row[2]
+
+    def summary(self, interface, path:Path, param:str) -> typing.Optional[dict]:
+        """The :func:`.summarize` d properties stored with a hit, if any"""
+        if self._rows is None:
+            self._load()
+        row = self._rows.get((*self._interface_key(interface), str(path), param))
+        if row is None or row[3] is None:
+            return None
+        return json.loads(row[3])
+
+    def store(self, interface, path:Path, param:str, hit:bool, stat=None,
+              summary:typing.Optional[dict]=None):
+        """
+        Store the result of an attempt, see :meth:`.lookup` for args, and
+        optionally the hit's ``summary`` . Saved to disk on :meth:`.commit`
+
+        If the path can't be stat'd (eg. it's been deleted, or is a broken symlink),
+        it's :meth:`.invalidate` d instead.
+        """
+        if self._rows is None:
+            self._load()
+        if stat is None:
+            try:
+                stat = path.stat()
+            except OSError:
+                self.invalidate(path)
+                return
+
+        key = (*self._interface_key(interface), str(path), param)
+        previous = self._rows.get(key)
+        stats = self._stats[(key[0], path_kind(path))]
+        if previous is not None:
+            stats[0] -= previous[2]
+            stats[1] -= 1
+        stats[0] += hit
+        stats[1] += 1
+        summary = json.dumps(summary) if summary is not None else None
+        self._rows[key] = (stat.st_size, stat.st_mtime_ns, hit, summary)
+        self._pending.append((*key, stat.st_size, stat.st_mtime_ns, int(hit), summary))
+
+    def invalidate(self, path:Path):
+        """
+        Forget every result for a path, eg. because it no longer exists. Saved to disk on :meth:`.commit`
+        """
+        if self._rows is None:
+            self._load()
+        path = str(path)
+        for key in [key for key in self._rows if key[2] == path]:
+            _, _, hit, _ = self._rows.pop(key)
+            stats = self._stats[(key[0], path_kind(path))]
+            stats[0] -= hit
+            stats[1] -= 1
+        # drop it from stores not yet written, too
+        self._pending = [row for row in self._pending if row[2] != path]
+        self._invalid.append((path,))
+
+    def commit(self):
+        """Write stored results to the database"""
+        if len(self._invalid) > 0:
+            with self._conn:
+                self._conn.executemany('DELETE FROM attempts WHERE path = ?', self._invalid)
+            self._invalid = []
+        if len(self._pending) > 0:
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO attempts (interface, version, path, param, size, mtime, hit, summary) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self._pending)
+            self._pending = []
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+    def __enter__(self) -> 'DiscoveryCache':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# --------------------------------------------------
+# Ranking heuristics
+# --------------------------------------------------
+
+EXTENSION_HINTS = {
+    'spikeglx': ('.bin', '.meta'),
+    'openephys': ('', '.continuous', '.dat'),
+    'neuroscope': ('.dat', '.xml', '.eeg', '.lfp'),
+    'blackrock': ('.ns1', '.ns2', '.ns3', '.ns4', '.ns5', '.ns6', '.nev'),
+    'intan': ('.rhd', '.rhs'),
+    'axona': ('.bin', '.set'),
+    'neuralynx': ('', '.ncs'),
+    'spikegadgets': ('.rec',),
+    'plexon': ('.plx', '.pl2'),
+    'ced': ('.smr', '.smrx'),
+    'mcsraw': ('.raw',),
+    'phy': ('',),
+    'kilosort': ('',),
+    'suite2p': ('',),
+    'tiff': ('.tif', '.tiff'),
+    'hdf5': ('.h5', '.hdf5'),
+    'caiman': ('.hdf5', '.h5'),
+    'sbx': ('.sbx', '.mat'),
+    'movie': ('.avi', '.mp4', '.mov'),
+    'nwb': ('.nwb',),
+    'mat': ('.mat',),
+}
+"""
+Substrings of (lowercased) interface names and the extensions that interface is likely to open.
+``''`` stands for directories (or other paths without an extension).
+"""
+
+def path_kind(path:typing.Union[str, Path]) -> str:
+    """
+    The "kind" of a path that ranking statistics are kept for: its lowercased extension,
+    or ``''`` for directories and files without one
+    """
+    return Path(path).suffix.lower()
+
+def _expected_kind(param:str) -> typing.Optional[str]:
+    param = param.lower()
+    if 'folder' in param or 'dir' in param:
+        return 'dir'
+    elif 'file' in param:
+        return 'file'
+    else:
+        return None
+
+def score_attempt(interface, path:Path, param:str, is_dir:bool,
+                  cache:typing.Optional[DiscoveryCache]=None) -> float:
+    """
+    How likely ``interface(**{param: path})`` is to work, as a number between 0 and 1.
+
+    Starts with a prior from some heuristics:
+
+    * whether the parameter name asks for a file or a folder, and ``path`` is one,
+    * whether the extension is one :data:`.EXTENSION_HINTS` associates with the interface,
+    * whether the interface's name appears in the path
+
+    and then if a ``cache`` is given, combines it with how often the interface has worked
+    on paths with the same extension before (with the prior counting as two attempts)
+
+    Returns:
+        float
+    """
+    prior = 0.5
+    expected = _expected_kind(param)
+    if expected is not None:
+        prior = 0.9 if (expected == 'dir') == is_dir else 0.05
+
+    name = re.sub(r'(recording|sorting|imaging|segmentation|extractor|interface)', '', interface.__name__.lower())
+    kind = path_kind(path)
+    for hint, extensions in EXTENSION_HINTS.items():
+        if hint in name:
+            prior = min(1.0, prior * 1.5) if kind in extensions else prior * 0.5
+            break
+    if len(name) > 2 and name in str(path).lower():
+        prior = min(1.0, prior * 1.5)
+
+    if cache is None:
+        return prior
+
+    hits, attempts = cache.hit_stats(interface, kind)
+    return (hits + 2 * prior) / (attempts + 2)
+
+def _interface_type(interface) -> str:
+    return getattr(interface, 'interface_type', interface.__name__)
+
+# --------------------------------------------------
+# Sampling
+# --------------------------------------------------
+
+def path_pattern(path:Path, base_dir:Path) -> str:
+    """
+    The pattern that groups nearly identical paths when sampling: the path relative to
+    ``base_dir`` with runs of digits collapsed to ``#`` , except in the extension,
+    and a trailing ``/`` for directories. Eg. ``'sub-#/ses-#/trial_#.mat'``
+    """
+    relative = path.relative_to(base_dir)
+    if len(relative.parts) == 0:
+        return '/'
+    parts = [re.sub(r'\d+', '#', part) for part in relative.parts[:-1]]
+    parts.append(re.sub(r'\d+', '#', relative.stem) + relative.suffix if relative.suffix
+                 else re.sub(r'\d+', '#', relative.name))
+    return '/'.join(parts) + ('/' if path.is_dir() else '')
+
+def cluster_paths(paths:typing.Iterable[Path], base_dir:Path) -> typing.Dict[str, typing.List[Path]]:
+    """
+    Group paths by their :func:`.path_pattern`
+
+    Returns:
+        dict of ``{pattern: sorted list of paths}``
+    """
+    clusters = defaultdict(list)
+    for path in paths:
+        clusters[path_pattern(path, base_dir)].append(path)
+    return {pattern: sorted(members) for pattern, members in clusters.items()}
+
+def _representatives(members:typing.List[Path], n:int) -> typing.List[Path]:
+    """Evenly spaced members, always including the first"""
+    if len(members) <= n:
+        return list(members)
+    step = len(members) / n
+    return [members[int(i * step)] for i in range(n)]
+
+
+def _attempt(interface, path:Path, req_param:str, base_dir:Path, result:DiscoveryResult,
+             cache:typing.Optional[DiscoveryCache], stats:dict, probe:bool,
+             score:typing.Optional[float]=None) -> typing.Optional[Hit]:
+    """Try (or look up) one interface with one path"""
+    result.attempts += 1
+    if cache is not None:
+        if path not in stats:
+            try:
+                stats[path] = path.stat()
+            except OSError:
+                # deleted since we listed it, or a broken symlink
+                stats[path] = None
+                cache.invalidate(path)
+        if stats[path] is None:
+            return None
+        cached = cache.lookup(interface, path, req_param, stats[path])
+        if cached is not None:
+            result.cached += 1
+            if not cached:
+                return None
+            return Hit(interface, path.relative_to(base_dir), req_param,
+                       base_dir=base_dir, cached=True, score=score,
+                       summary=cache.summary(interface, path, req_param))
+
+    hit = None
+    try:
+        instance = interface(**{req_param: str(path)})
+        summary = summarize(instance)
+        if probe:
+            close_instance(instance)
+            instance = None
+        hit = Hit(interface, path.relative_to(base_dir), req_param, instance,
+                  base_dir=base_dir, score=score, summary=summary)
+    except:
+        pass
+
+    if cache is not None:
+        cache.store(interface, path, req_param, hit is not None, stats[path],
+                    summary=hit.summary if hit is not None else None)
+    return hit
+
+
+def discover(interfaces:typing.List[type],
+             base_dir:Path,
+             cache:typing.Optional[DiscoveryCache]=None,
+             progress:bool=True,
+             ranked:bool=False,
+             max_hits_per_path:typing.Optional[int]=None,
+             max_hits_per_type:typing.Optional[int]=None,
+             time_budget:typing.Optional[float]=None,
+             probe:bool=False,
+             sample:typing.Optional[int]=None,
+             verify:int=0,
+             seed:typing.Optional[int]=0) -> DiscoveryResult:
+    """
+    Try every interface with every path beneath ``base_dir`` (including ``base_dir`` itself),
+    passing the path as each of the interface's required source data parameters.
+
+    Args:
+        interfaces (list): interface classes to try
+        base_dir (:class:`pathlib.Path`): directory to search
+        cache (:class:`.DiscoveryCache`): if given, skip attempts that were already
+            made with unchanged paths, and store the new ones
+        progress (bool): show progress bars
+        ranked (bool): try the most likely attempts first (see :func:`.score_attempt` ),
+            and return hits sorted by score
+        max_hits_per_path (int): stop trying a path once this many interfaces have opened it
+        max_hits_per_type (int): stop trying interfaces of a type (eg. ``'RecordingInterface'`` )
+            once they've had this many hits
+        time_budget (float): stop after this many seconds, returning what we've found so far.
+            :attr:`.DiscoveryResult.complete` will be ``False`` if we ran out of time.
+        probe (bool): don't keep instances: record their :func:`.summarize` d properties and
+            :func:`.close_instance` them right away. Hits are reinstantiated on demand.
+        sample (int): only try this many representatives of each group of paths with the same
+            :func:`.path_pattern` , and extrapolate their hits to the rest of the group. See module docs.
+        verify (int): when sampling, also try this many random other members of each group that had hits
+        seed (int): seed for choosing which members to verify
+
+    Returns:
+        :class:`.DiscoveryResult`
+    """
+    start_time = time.time()
+    base_dir = Path(base_dir).absolute()
+    result = DiscoveryResult()
+
+    # create iterator to go over all files and interfaces...
+    all_paths = itertools.chain((base_dir,), base_dir.glob("**/[!\.]*"))
+    clusters = {}
+    if sample is not None:
+        clusters = cluster_paths(all_paths, base_dir)
+        result.clusters = len(clusters)
+        all_paths = [path for members in clusters.values() for path in _representatives(members, sample)]
+
+    everything = ((interface, path, req_param)
+                  for interface, path in itertools.product(interfaces, all_paths)
+                  for req_param in interface.get_source_schema().get('required', []))
+
+    scores = {}
+    if ranked:
+        everything = list(everything)
+        for interface, path, req_param in everything:
+            scores[(interface, path, req_param)] = score_attempt(interface, path, req_param, path.is_dir(), cache)
+        everything.sort(key=lambda attempt: scores[attempt], reverse=True)
+
+    path_hits = defaultdict(int)
+    type_hits = defaultdict(int)
+    stats = {}
+    tried = {} # type: typing.Dict[typing.Tuple[type, Path, str], bool]
+
+    hit_bar = tqdm(position=1, desc="Hits", disable=not progress)
+    for interface, path, req_param in tqdm(everything, position=0, disable=not progress):
+        if time_budget is not None and time.time() - start_time > time_budget:
+            result.complete = False
+            break
+        if max_hits_per_path is not None and path_hits[path] >= max_hits_per_path:
+            continue
+        if max_hits_per_type is not None and type_hits[_interface_type(interface)] >= max_hits_per_type:
+            continue
+
+        hit = _attempt(interface, path, req_param, base_dir, result, cache, stats, probe,
+                       score=scores.get((interface, path, req_param)))
+        tried[(interface, path, req_param)] = hit is not None
+        if hit is not None:
+            result.append(hit)
+            path_hits[path] += 1
+            type_hits[_interface_type(interface)] += 1
+            hit_bar.update()
+
+    if sample is not None and result.complete:
+        _extrapolate(clusters, sample, verify, random.Random(seed), tried, base_dir, result,
+                     cache, stats, probe, start_time, time_budget, path_hits, max_hits_per_path)
+
+    if cache is not None:
+        cache.commit()
+
+    if ranked:
+        result.sort(key=lambda hit: hit.score if hit.score is not None else 0, reverse=True)
+
+    result.elapsed = time.time() - start_time
+    return result
+
+
+def _extrapolate(clusters:typing.Dict[str, typing.List[Path]], sample:int, verify:int, rng:random.Random,
+                 tried:dict, base_dir:Path, result:DiscoveryResult, cache, stats:dict, probe:bool,
+                 start_time:float, time_budget:typing.Optional[float],
+                 path_hits:dict, max_hits_per_path:typing.Optional[int]):
+    """Spread the representatives' hits to the rest of their clusters, checking them if asked"""
+    hits = {(hit.interface, hit.param, base_dir / hit.path): hit for hit in result}
+    by_path = defaultdict(list)
+    for interface, path, req_param in tried:
+        by_path[path].append((interface, req_param))
+
+    for pattern, members in clusters.items():
+        representatives = _representatives(members, sample)
+        chosen = set(representatives)
+        rest = [path for path in members if path not in chosen]
+        if len(rest) == 0:
+            continue
+        # each interface/param that opened at least one representative
+        outcomes = defaultdict(list)
+        for path in representatives:
+            for interface, req_param in by_path[path]:
+                outcomes[(interface, req_param)].append(tried[(interface, path, req_param)])
+
+        for (interface, req_param), opened in outcomes.items():
+            if not any(opened):
+                continue
+            agree = all(opened)
+            if agree and verify > 0:
+                for path in rng.sample(rest, min(verify, len(rest))):
+                    hit = _attempt(interface, path, req_param, base_dir, result, cache, stats, probe)
+                    if hit is None:
+                        agree = False
+                        break
+                    hits[(interface, req_param, path)] = hit
+                    result.append(hit)
+
+            for path in rest:
+                if (interface, req_param, path) in hits:
+                    continue
+                if max_hits_per_path is not None and path_hits[path] >= max_hits_per_path:
+                    continue
+                if agree:
+                    hit = Hit(interface, path.relative_to(base_dir), req_param, base_dir=base_dir, extrapolated=True)
+                    result.extrapolated += 1
+                else:
+                    # the cluster isn't uniform for this interface, so try every member
+                    if time_budget is not None and time.time() - start_time > time_budget:
+                        result.complete = False
+                        return
+                    hit = _attempt(interface, path, req_param, base_dir, result, cache, stats, probe)
+                    if hit is None:
+                        continue
+                hits[(interface, req_param, path)] = hit
+                result.append(hit)
+                path_hits[path] += 1
@@ -0,0 +1,10 @@
+"""
+Data interfaces for data that nwb-conversion-tools doesn't have interfaces for.
+
+Use them in an :class:`.NWBConverter` like any other interface::
+
+    class SmearConverter(NWBConverter):
+        data_interface_classes = {'Tracking': PositionInterface}
+"""
+
+from onice_conversion.interfaces.position import PositionInterface, add_keypoints
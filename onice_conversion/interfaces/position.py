@@ -0,0 +1,192 @@
+"""
+Keypoint (pose) tracking, from a table with one row per frame.
+
+Writing one :class:`pynwb.behavior.SpatialSeries` per keypoint, each with its own copy
+of the frame timestamps, writes the same timestamps once per keypoint. Instead,
+:func:`.add_keypoints` writes them once:
+
+* ``layout='linked'`` (default) -- one ``SpatialSeries`` per keypoint in a
+  :class:`pynwb.behavior.Position` , where the first stores the timestamps and the others
+  link to them.
+* ``layout='single'`` -- one :class:`pynwb.TimeSeries` with two columns per keypoint in a
+  :class:`pynwb.behavior.BehavioralTimeSeries` (a ``SpatialSeries`` may only have up to three columns).
+
+And if the frames are regular (see :meth:`.timebase.TimeBase.regular` ), no timestamps are
+written at all, just a ``starting_time`` and ``rate`` .
+"""
+import typing
+from pathlib import Path
+
+import numpy as np
+from nwb_conversion_tools.basedatainterface import BaseDataInterface
+from pynwb import NWBFile, TimeSeries
+from pynwb.behavior import Position, SpatialSeries, BehavioralTimeSeries
+
+from onice_conversion.datasource import ArraySource
+from onice_conversion.timebase import TimeBase, TOLERANCE
+
+
+def add_keypoints(nwbfile:NWBFile,
+                  data:np.ndarray,
+                  timestamps:np.ndarray,
+                  keypoints:typing.List[str],
+                  layout:str='linked',
+                  name:str='Position',
+                  reference_frame:str='unknown',
+                  unit:str='pixels',
+                  module_name:str='behavior',
+                  tolerance:typing.Optional[float]=TOLERANCE,
+                  pipeline=None) -> typing.Union[Position, BehavioralTimeSeries]:
+    """
+    Add keypoint tracking to an NWB file, writing the timestamps only once.
+
+    Args:
+        nwbfile (:class:`pynwb.NWBFile`): file to add to
+        data (:class:`numpy.ndarray`): positions, shape ``(frames, keypoints, 2)``
+        timestamps (:class:`numpy.ndarray`): time of each frame, in seconds
+        keypoints (list): name of each keypoint
+        layout (str): ``'linked'`` or ``'single'`` , see module docs
+        name (str): name of the container
+        reference_frame (str): description of the coordinates' origin
+        unit (str): unit of the coordinates
+        module_name (str): processing module to add the container to, created if needed
+        tolerance (float): if the timestamps are regular to within this many frame periods,
+            store a ``starting_time`` and ``rate`` instead. None to always store timestamps.
+        pipeline (:class:`.pipeline.PipelinedWriter`): if given, add the data as streams of the pipeline
+
+    Returns:
+        the :class:`pynwb.behavior.Position` or :class:`pynwb.behavior.BehavioralTimeSeries` that was added
+    """
+    if layout not in ('linked', 'single'):
+        raise ValueError(f"layout must be 'linked' or 'single', got {layout}")
+    data = np.asarray(data)
+    if data.ndim != 3 or data.shape[1] != len(keypoints):
+        raise ValueError(f'data should have shape (frames, {len(keypoints)} keypoints, coordinates), got {data.shape}')
+    if data.shape[0] != len(timestamps):
+        raise ValueError(f'{data.shape[0]} frames of data but {len(timestamps)} timestamps')
+
+    time_kwargs = {'timestamps': np.asarray(timestamps, dtype=np.float64)}
+    if tolerance is not None:
+        timebase = TimeBase(tolerance=tolerance)
+        timebase.add(name, timestamps=timestamps)
+        time_kwargs = timebase.time_kwargs(name)
+
+    def _data(stream_name:str, array:np.ndarray):
+        if pipeline is None:
+            return array
+        return pipeline.add_stream(stream_name, ArraySource(array))
+
+    if module_name in nwbfile.processing:
+        module = nwbfile.processing[module_name]
+    else:
+        module = nwbfile.create_processing_module(name=module_name, description='behavioral data')
+    if name in module.data_interfaces:
+        raise ValueError(f'{module_name} already has a container named {name}')
+
+    if layout == 'linked':
+        container = Position(name=name)
+        first = None
+        for i, keypoint in enumerate(keypoints):
+            if first is None or 'timestamps' not in time_kwargs:
+                series_time = time_kwargs
+            else:
+                # link to the first series' timestamps rather than writing them again
+                series_time = {'timestamps': first}
+            series = SpatialSeries(name=keypoint, data=_data(f'{name}.{keypoint}', data[:, i, :]),
+                                   reference_frame=reference_frame, unit=unit, **series_time)
+            container.add_spatial_series(series)
+            first = series if first is None else first
+    else:
+        container = BehavioralTimeSeries(name=name)
+        columns = [f'{keypoint}_{axis}' for keypoint in keypoints for axis in 'xyz'[:data.shape[2]]]
+        container.add_timeseries(TimeSeries(
+            name='keypoints', data=_data(name, data.reshape(data.shape[0], -1)), unit=unit,
+            description=f"reference frame: {reference_frame}. columns: {', '.join(columns)}",
+            **time_kwargs))
+
+    module.add(container)
+    return container
+
+
+class PositionInterface(BaseDataInterface):
+    """
+    Keypoint tracking from a table with one row per frame, eg. the smear
+    example's ``frame_params_wITI.txt`` ::
+
+        PositionInterface(file_path='frame_params_wITI.txt', keypoints=['nose', 'head', 'body'],
+                          timestamps_column=7, timestamps_scale=1e-3)
+
+    Args:
+        file_path (str): a delimited text file, or a ``.npy`` file
+        keypoints (list): name of each keypoint
+        keypoint_columns (list): index of the x column of each keypoint, the y column follows it.
+            Default is consecutive x, y pairs starting from the first column.
+        timestamps_column (int): index of the column with the time of each frame
+        timestamps_scale (float): multiply timestamps by this to get seconds, eg. ``1e-3`` for milliseconds
+        delimiter (str): for text files
+    """
+
+    def __init__(self, file_path:str, keypoints:list,
+                 keypoint_columns:typing.Optional[list]=None,
+                 timestamps_column:int=-1,
+                 timestamps_scale:float=1.0,
+                 delimiter:str=','):
+        super(PositionInterface, self).__init__(
+            file_path=file_path, keypoints=keypoints, keypoint_columns=keypoint_columns,
+            timestamps_column=timestamps_column, timestamps_scale=timestamps_scale, delimiter=delimiter)
+        if keypoint_columns is None:
+            keypoint_columns = [i * 2 for i in range(len(keypoints))]
+        if len(keypoint_columns) != len(keypoints):
+            raise ValueError('Need one keypoint column for each keypoint')
+        self.keypoints = keypoints
+        self.keypoint_columns = keypoint_columns
+        self.timestamps_column = timestamps_column
+        self.timestamps_scale = timestamps_scale
+        self._table = None # type: typing.Optional[np.ndarray]
+
+        # fail on instantiation rather than conversion if the file isn't a table with enough columns
+        n_columns = self.table.shape[1] if self.table.ndim == 2 else 0
+        needed = max(max(keypoint_columns) + 2, timestamps_column + 1 if timestamps_column >= 0 else -timestamps_column)
+        if n_columns < needed:
+            raise ValueError(f'{file_path} has {n_columns} columns, need at least {needed}')
+
+    @property
+    def table(self) -> np.ndarray:
+        """The whole file, one row per frame"""
+        if self._table is None:
+            path = Path(self.source_data['file_path'])
+            if path.suffix == '.npy':
+                self._table = np.load(str(path), mmap_mode='r')
+            else:
+                self._table = np.genfromtxt(str(path), delimiter=self.source_data['delimiter'])
+        return self._table
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.table[:, self.timestamps_column] * self.timestamps_scale
+
+    @property
+    def data(self) -> np.ndarray:
+        """Positions, shape ``(frames, keypoints, 2)``"""
+        return np.stack([self.table[:, column:column + 2] for column in self.keypoint_columns], axis=1)
+
+    def get_metadata(self) -> dict:
+        return {'Behavior': {'Position': {'name': 'Position', 'reference_frame': 'unknown', 'unit': 'pixels'}}}
+
+    def run_conversion(self, nwbfile:NWBFile, metadata:dict,
+                       layout:str='linked',
+                       tolerance:typing.Optional[float]=TOLERANCE):
+        """
+        Add the tracking with :func:`.add_keypoints`
+
+        Args:
+            nwbfile (:class:`pynwb.NWBFile`): file to add to
+            metadata (dict): uses ``metadata['Behavior']['Position']`` for the ``name`` ,
+                ``reference_frame`` , and ``unit``
+            layout (str): ``'linked'`` or ``'single'``
+            tolerance (float): see :func:`.add_keypoints`
+        """
+        position_metadata = dict(self.get_metadata()['Behavior']['Position'])
+        position_metadata.update(metadata.get('Behavior', {}).get('Position', {}))
+        add_keypoints(nwbfile, self.data, self.timestamps, self.keypoints, layout=layout,
+                      tolerance=tolerance, pipeline=getattr(self, 'pipeline', None), **position_metadata)
@@ -0,0 +1,346 @@
+"""
+A queue of conversions on a shared filesystem.
+
+For when there are several machines that can see the same storage, but there's
+no scheduler or broker to hand out work. A :class:`.JobQueue` is a SQLite database
+(eg. next to the data) that holds :class:`.batch.Session` s, and any number of
+workers on any machine that can see it claim sessions from it one at a time::
+
+    # once, from anywhere
+    queue = JobQueue('/mnt/lab/conversion_queue.db')
+    queue.add(sessions)
+
+    # on each node, as many times as you like
+    $ onice_conversion worker /mnt/lab/conversion_queue.db
+
+    # see how it's going
+    $ onice_conversion status /mnt/lab/conversion_queue.db
+
+Each claim happens in a single write transaction, so two workers can't claim the same session.
+Sessions are claimed largest first, using the estimates of a :class:`.batch.CostModel` when
+they were added. Workers heartbeat while they convert, and a session whose worker
+has stopped heartbeating for :attr:`.JobQueue.stale_after` seconds (because it crashed,
+or its node went down) is put back in the queue for someone else, up to
+:attr:`.JobQueue.max_attempts` times. Workers write each file to a temporary path next to it,
+and only move it into place if the session is still theirs when they finish, so a worker that
+was only slow (and was requeued) can't clobber the file of the worker that took over.
+
+.. note::
+
+    Stale heartbeats are judged by the clock of the worker that's claiming, so the clocks
+    of the nodes should roughly agree (to well within ``stale_after`` ). SQLite's locking
+    relies on the filesystem's ``fcntl`` locks, which NFSv4 and most cluster filesystems
+    support, but some old NFS mounts don't.
+"""
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import typing
+from pathlib import Path
+
+from onice_conversion.batch import Session, CostModel
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    session TEXT NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed REAL,
+    heartbeat REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    elapsed REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority);
+"""
+
+STATUSES = ('pending', 'running', 'done', 'failed')
+
+
+class JobQueue(object):
+    """
+    A queue of :class:`.batch.Session` s in a SQLite database on a shared filesystem.
+    See the module docs for an overview.
+
+    Args:
+        path (str, :class:`pathlib.Path`): the database, created if it doesn't exist
+        stale_after (float): seconds without a heartbeat before a running session is requeued
+        max_attempts (int): how many times a session may be claimed before it's marked failed
+        timeout (float): seconds to wait for another process's lock on the database
+    """
+
+    def __init__(self, path:typing.Union[str, Path],
+                 stale_after:float=120,
+                 max_attempts:int=3,
+                 timeout:float=60):
+        self.path = Path(path)
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self._conn = self._connect()
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # autocommit mode, so we control transactions with explicit BEGIN IMMEDIATE.
+        # the default rollback journal rather than WAL, since WAL needs shared memory
+        # that doesn't work across machines
+        conn = sqlite3.connect(str(self.path), timeout=self.timeout, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        return conn
+
+    def add(self, sessions:typing.Iterable[Session],
+            cost_model:typing.Optional[typing.Union[str, Path, CostModel]]=None,
+            replace:bool=False) -> int:
+        """
+        Add sessions to the queue.
+
+        Args:
+            sessions: :class:`.batch.Session` s
+            cost_model (str, :class:`pathlib.Path`, :class:`.batch.CostModel`): to estimate
+                each session's cost so the largest are claimed first
+            replace (bool): replace sessions with the same name (resetting them to pending),
+                otherwise they're skipped
+
+        Returns:
+            int: number of sessions added
+        """
+        if not isinstance(cost_model, CostModel):
+            cost_model = CostModel(cost_model)
+
+        rows = []
+        for session in sessions:
+            try:
+                priority = cost_model.estimate(session).seconds
+            except Exception:
+                priority = 0
+            rows.append((session.name, json.dumps(session.to_dict()), priority))
+
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(f'{verb} INTO jobs (name, session, priority) VALUES (?, ?, ?)', rows)
+            return conn.total_changes - before
+
+    def claim(self, worker:str) -> typing.Optional[Session]:
+        """
+        Atomically claim the largest pending session, first requeueing any whose worker has gone stale.
+
+        Args:
+            worker (str): id of the claiming worker
+
+        Returns:
+            :class:`.batch.Session` , or None if there's nothing left to claim
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._requeue_stale(conn, now)
+            row = conn.execute(
+                "SELECT name, session FROM jobs WHERE status = 'pending' ORDER BY priority DESC LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, claimed = ?, heartbeat = ?, "
+                "attempts = attempts + 1, error = NULL WHERE name = ?",
+                (worker, now, now, row[0]))
+        return Session.from_dict(json.loads(row[1]))
+
+    def _requeue_stale(self, conn:sqlite3.Connection, now:float):
+        cutoff = now - self.stale_after
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'worker ' || worker || ' stopped responding (attempt ' || attempts || ')' "
+            "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?", (cutoff, self.max_attempts))
+        conn.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL "
+            "WHERE status = 'running' AND heartbeat < ?", (cutoff,))
+
+    def heartbeat(self, name:str, worker:str) -> bool:
+        """
+        Tell the queue ``worker`` is still working on ``name``
+
+        Returns:
+            bool: False if the session is no longer ours (eg. we were too slow and it was requeued)
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE name = ? AND worker = ? AND status = 'running'",
+                (time.time(), name, worker))
+            return cursor.rowcount > 0
+
+    def finish(self, name:str, worker:str, elapsed:float, error:typing.Optional[str]=None):
+        """
+        Mark a session as done, or put it back in the queue if it failed
+        and has attempts left.
+        """
+        with self._transaction() as conn:
+            if error is None:
+                status = 'done'
+            else:
+                attempts, = conn.execute("SELECT attempts FROM jobs WHERE name = ?", (name,)).fetchone()
+                status = 'failed' if attempts >= self.max_attempts else 'pending'
+            conn.execute(
+                "UPDATE jobs SET status = ?, elapsed = ?, error = ?, "
+                "worker = CASE WHEN ? = 'pending' THEN NULL ELSE worker END "
+                "WHERE name = ? AND worker = ?",
+                (status, elapsed, error, status, name, worker))
+
+    def retry(self, names:typing.Optional[typing.List[str]]=None) -> int:
+        """
+        Put failed sessions back in the queue with their attempts reset
+
+        Args:
+            names (list): sessions to retry, or all failed sessions if None
+
+        Returns:
+            int: number of sessions requeued
+        """
+        with self._transaction() as conn:
+            if names is None:
+                cursor = conn.execute("UPDATE jobs SET status = 'pending', attempts = 0, worker = NULL WHERE status = 'failed'")
+            else:
+                cursor = conn.executemany(
+                    "UPDATE jobs SET status = 'pending', attempts = 0, worker = NULL WHERE name = ? AND status = 'failed'",
+                    [(name,) for name in names])
+            return cursor.rowcount
+
+    def status(self) -> typing.Dict[str, int]:
+        """Number of sessions with each status"""
+        counts = dict(self._conn.execute("SELECT status, count(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    def jobs(self, status:typing.Optional[str]=None) -> typing.List[dict]:
+        """Rows of the queue as dicts, optionally only those with some ``status``"""
+        query = "SELECT name, status, worker, attempts, priority, elapsed, error FROM jobs"
+        params = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            params = (status,)
+        cursor = self._conn.execute(query + " ORDER BY priority DESC", params)
+        keys = [column[0] for column in cursor.description]
+        return [dict(zip(keys, row)) for row in cursor.fetchall()]
+
+    def work(self, worker:typing.Optional[str]=None,
+             wait:bool=False, poll:float=10) -> typing.Dict[str, typing.Tuple[float, typing.Optional[str]]]:
+        """
+        Claim and convert sessions until the queue is empty.
+
+        A background thread heartbeats every ``stale_after / 4`` seconds with its own connection
+        to the database while each session converts. Each file is written to a temporary path
+        alongside it, and moved into place only if we still hold the claim on its session when
+        it's done -- otherwise it's discarded, since another worker has taken the session over.
+
+        Args:
+            worker (str): id of this worker, default ``'hostname:pid'``
+            wait (bool): rather than stopping when nothing is pending, keep polling while
+                other workers still have sessions running (which might be requeued)
+            poll (float): seconds between polls when ``wait``
+
+        Returns:
+            dict of ``{session name: (seconds, traceback or None if it succeeded)}`` for the sessions we ran
+        """
+        if worker is None:
+            worker = f'{socket.gethostname()}:{os.getpid()}'
+
+        results = {}
+        while True:
+            session = self.claim(worker)
+            if session is None:
+                if wait and self.status()['running'] > 0:
+                    time.sleep(poll)
+                    continue
+                break
+
+            print(f'[{worker}] converting {session.name}')
+            nwbfile_path = Path(session.nwbfile_path)
+            session.nwbfile_path = str(_partial_path(nwbfile_path, worker))
+            stop = threading.Event()
+            beater = threading.Thread(target=self._heartbeat, args=(session.name, worker, stop), daemon=True)
+            beater.start()
+            start_time = time.time()
+            error = None
+            try:
+                session.run()
+            except Exception:
+                error = traceback.format_exc()
+            finally:
+                stop.set()
+                beater.join()
+            elapsed = time.time() - start_time
+
+            # heartbeating once more also keeps the claim from going stale while we move the file
+            if not self.heartbeat(session.name, worker):
+                _remove(session.nwbfile_path)
+                error = f'lost our claim on {session.name} while converting it, discarded {session.nwbfile_path}'
+                results[session.name] = (elapsed, error)
+                print(f'[{worker}] {error}')
+                continue
+
+            if error is None:
+                os.replace(session.nwbfile_path, nwbfile_path)
+            else:
+                _remove(session.nwbfile_path)
+            self.finish(session.name, worker, elapsed, error)
+            results[session.name] = (elapsed, error)
+            print(f'[{worker}] {session.name} ' + ('done' if error is None else f'failed:\n{error}') + f' in {elapsed:.1f}s')
+
+        return results
+
+    def _heartbeat(self, name:str, worker:str, stop:threading.Event):
+        queue = JobQueue(self.path, stale_after=self.stale_after, max_attempts=self.max_attempts, timeout=self.timeout)
+        try:
+            while not stop.wait(self.stale_after / 4):
+                if not queue.heartbeat(name, worker):
+                    print(f'[{worker}] lost our claim on {name}, another worker may be redoing it. '
+                          f'Our file will be discarded')
+                    break
+        finally:
+            queue.close()
+
+    def _transaction(self) -> '_Transaction':
+        return _Transaction(self._conn)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self) -> 'JobQueue':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _partial_path(nwbfile_path:Path, worker:str) -> Path:
+    """Where ``worker`` writes ``nwbfile_path`` until it's done, on the same filesystem so it can be moved atomically"""
+    worker = re.sub(r'[^\w.-]', '_', worker)
+    return nwbfile_path.with_name(f'.{nwbfile_path.name}.{worker}.partial')
+
+
+def _remove(path:typing.Union[str, Path]):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class _Transaction(object):
+    """
+    ``BEGIN IMMEDIATE`` takes the database's write lock before reading,
+    so select-then-update (eg. claiming) can't race with another process
+    """
+
+    def __init__(self, conn:sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
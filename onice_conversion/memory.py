@@ -0,0 +1,343 @@
+"""
+Keep a conversion under a memory budget.
+
+Used by :class:`.NWBConverter` when it is given a ``memory_budget`` --
+before the conversion we estimate how big each interface's data is, switch
+the ones that wouldn't fit to iterator-based chunked writes, and then watch
+the resident set size of the process while the conversion runs so we can bail
+out with a :class:`~.utils.MemoryBudgetError` (between steps of the conversion,
+see :meth:`.RSSMonitor.check` ) rather than getting OOM-killed.
+"""
+import os
+import re
+import sys
+import threading
+import typing
+from pathlib import Path
+
+import numpy as np
+
+from onice_conversion.utils import MemoryBudgetError
+
+BUFFER_FRACTION = 0.25
+"""
+Fraction of the memory budget given to the buffer of each chunked write
+"""
+
+CACHE_FRACTION = 0.1
+"""
+Fraction of the memory budget that :attr:`.BaseExternalFileSpec.loaded_files` may use
+"""
+
+_UNITS = {
+    '': 1, 'b': 1,
+    'k': 1000, 'kb': 1000, 'm': 1000**2, 'mb': 1000**2,
+    'g': 1000**3, 'gb': 1000**3, 't': 1000**4, 'tb': 1000**4,
+    'kib': 1024, 'mib': 1024**2, 'gib': 1024**3, 'tib': 1024**4
+}
+
+def parse_size(size: typing.Union[int, float, str]) -> int:
+    """
+    Parse a human-readable size like ``'4 GB'`` or ``'512MiB'`` into a number of bytes.
+
+    Numbers are passed through as bytes.
+
+    Parameters
+    ----------
+    size : int, float, or str
+
+    Returns
+    -------
+    int: number of bytes
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    match = re.fullmatch(r'\s*([\d.]+)\s*([a-zA-Z]*)\s*', str(size))
+    if match is None or match.group(2).lower() not in _UNITS:
+        raise ValueError(f'Could not parse size {size}, use something like "4 GB" or "512MiB"')
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+def format_size(n_bytes: typing.Optional[int]) -> str:
+    """Format a number of bytes for humans"""
+    if n_bytes is None:
+        return '?'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n_bytes) < 1000:
+            return f'{n_bytes:.1f} {unit}' if unit != 'B' else f'{n_bytes} B'
+        n_bytes /= 1000
+    return f'{n_bytes:.1f} TB'
+
+def current_rss() -> int:
+    """
+    Current resident set size of this process in bytes.
+
+    Reads ``/proc/self/statm`` where it exists, otherwise uses :mod:`psutil` if it's installed,
+    and falls back to the (peak!) ``ru_maxrss`` from :mod:`resource`.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class RSSMonitor(object):
+    """
+    Poll the resident set size in a background thread, keeping track of the peak.
+
+    If a ``budget`` is given and the RSS goes over it, set :attr:`.exceeded` , which
+    the thread doing the work looks at with :meth:`.check` whenever it's safe to stop.
+
+    Use as a context manager::
+
+        with RSSMonitor(budget=parse_size('4GB')) as monitor:
+            for step in steps:
+                monitor.check()
+                step()
+        print(monitor.peak)
+    """
+
+    def __init__(self, budget: typing.Optional[int] = None, interval: float = 0.1):
+        self.budget = budget
+        self.interval = interval
+        self.peak = current_rss()
+        self.exceeded = False
+        self._stop = threading.Event()
+        self._thread = None # type: typing.Optional[threading.Thread]
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            self.peak = max(self.peak, rss)
+            if self.budget is not None and rss > self.budget:
+                self.exceeded = True
+
+    def check(self):
+        """
+        Raise a :class:`~.utils.MemoryBudgetError` if the RSS has gone over the budget
+        """
+        if self.exceeded:
+            raise MemoryBudgetError(f'RSS reached {format_size(self.peak)}, over the budget of {format_size(self.budget)}')
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.peak = max(self.peak, current_rss())
+
+    def __enter__(self) -> 'RSSMonitor':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class MemoryReport(object):
+    """
+    What we estimated and decided for each interface, and what actually happened.
+
+    ``str(report)`` gives the table that's put in a :class:`~.utils.MemoryBudgetError`
+    """
+
+    def __init__(self, budget: int, baseline: int):
+        self.budget = budget
+        self.baseline = baseline
+        self.peak = None # type: typing.Optional[int]
+        # interface name: (estimated bytes, decision)
+        self.interfaces = {} # type: typing.Dict[str, typing.Tuple[typing.Optional[int], str]]
+        self.problems = [] # type: typing.List[str]
+
+    def __str__(self) -> str:
+        lines = [
+            f'memory budget: {format_size(self.budget)}',
+            f'baseline RSS:  {format_size(self.baseline)}',
+            f'peak RSS:      {format_size(self.peak)}'
+        ]
+        if len(self.interfaces) > 0:
+            lines.append('interfaces:')
+            lines.extend([f'  {name}: {format_size(size)} -> {decision}'
+                          for name, (size, decision) in self.interfaces.items()])
+        if len(self.problems) > 0:
+            lines.append('problems:')
+            lines.extend([f'  {problem}' for problem in self.problems])
+        return '\n'.join(lines)
+
+
+def source_file_size(interface, source_data:typing.Optional[dict]=None) -> int:
+    """
+    Total size on disk of the files and folders in an interface's ``source_data``
+
+    Uses the source schema to find which parameters are paths (``format`` of
+    ``'file'`` or ``'directory'``, or names ending in ``_path`` or ``_paths``).
+
+    Parameters
+    ----------
+    interface : an interface, or an interface class if ``source_data`` is given
+    source_data : dict
+        source data to use rather than the interface's own, so we can estimate
+        without instantiating the interface.
+    """
+    try:
+        properties = interface.get_source_schema().get('properties', {})
+    except Exception:
+        properties = {}
+
+    if source_data is None:
+        source_data = getattr(interface, 'source_data', {})
+
+    total = 0
+    for name, value in source_data.items():
+        prop = properties.get(name, {})
+        if prop.get('format') not in ('file', 'directory') and \
+                not (name.endswith('_path') or name.endswith('_paths')):
+            continue
+
+        values = value if isinstance(value, (list, tuple)) else (value,)
+        for path in values:
+            path = Path(path)
+            if path.is_file():
+                total += path.stat().st_size
+            elif path.is_dir():
+                total += sum(sub.stat().st_size for sub in path.glob('**/*') if sub.is_file())
+    return total
+
+def estimate_interface_size(interface) -> typing.Optional[int]:
+    """
+    Estimate how many bytes of data an interface will write.
+
+    Asks the extractor if there is one (recording and imaging extractors know
+    their shape and dtype), otherwise uses the size of the source files.
+
+    Returns
+    -------
+    int, or None if we have no idea
+    """
+    try:
+        if hasattr(interface, 'recording_extractor'):
+            recording = interface.recording_extractor
+            return int(recording.get_num_channels() * recording.get_num_frames() *
+                       np.dtype(recording.get_dtype()).itemsize)
+        elif hasattr(interface, 'imaging_extractor'):
+            imaging = interface.imaging_extractor
+            return int(imaging.get_num_frames() * np.prod(imaging.get_image_size()) *
+                       np.dtype(imaging.get_dtype()).itemsize)
+    except Exception:
+        # extractors that don't implement everything, fall through to file sizes
+        pass
+
+    try:
+        return source_file_size(interface)
+    except OSError:
+        return None
+
+def chunking_options(interface, buffer_bytes: int) -> typing.Optional[dict]:
+    """
+    Conversion options that make an interface write its data with an iterator
+    rather than loading it all at once, if it supports that.
+
+    Parameters
+    ----------
+    interface : the data interface
+    buffer_bytes : int
+        how big each buffered chunk may be
+
+    Returns
+    -------
+    dict of conversion options, or None if the interface can't write in chunks
+    """
+    try:
+        properties = interface.get_conversion_options_schema().get('properties', {})
+    except Exception:
+        return None
+
+    if 'iterator_type' in properties:
+        options = {'iterator_type': 'v2'}
+        if 'iterator_opts' in properties:
+            options['iterator_opts'] = {'buffer_gb': buffer_bytes / 1e9}
+        return options
+    elif 'buffer_mb' in properties:
+        return {'buffer_mb': max(1, buffer_bytes // 1000**2)}
+    else:
+        return None
+
+def plan_conversion(interfaces: typing.Dict[str, typing.Any],
+                    budget: int,
+                    conversion_options: typing.Optional[dict] = None) -> typing.Tuple[dict, MemoryReport]:
+    """
+    Decide which interfaces need to be written in chunks to stay under ``budget``.
+
+    Since the NWB file is assembled in memory before it is written, everything
+    that isn't written with an iterator is resident at the same time. So going
+    from largest to smallest, interfaces are kept in memory until they would
+    push the total over what's left of the budget after the baseline RSS,
+    and everything after that is switched to chunked writes.
+
+    Parameters
+    ----------
+    interfaces : dict
+        ``{name: interface}``, eg. :attr:`NWBConverter.data_interface_objects`
+    budget : int
+        memory budget in bytes
+    conversion_options : dict
+        conversion options given by the user, which take precedence over ours
+
+    Returns
+    -------
+    tuple of (updated conversion options, :class:`.MemoryReport`)
+
+    Raises
+    ------
+    :class:`~.utils.MemoryBudgetError` if the budget can't be met
+    """
+    conversion_options = {name: dict(opts) for name, opts in (conversion_options or {}).items()}
+    report = MemoryReport(budget=budget, baseline=current_rss())
+
+    headroom = budget - report.baseline
+    buffer_bytes = int(budget * BUFFER_FRACTION)
+    if headroom <= buffer_bytes:
+        report.problems.append(
+            f'only {format_size(headroom)} left after the baseline RSS, need at least {format_size(buffer_bytes)} to buffer chunked writes')
+
+    sizes = {name: estimate_interface_size(interface) for name, interface in interfaces.items()}
+    in_memory = 0
+    for name in sorted(sizes, key=lambda name: sizes[name] or 0, reverse=True):
+        size = sizes[name]
+        if size is not None and in_memory + size + buffer_bytes <= headroom:
+            in_memory += size
+            report.interfaces[name] = (size, 'in memory')
+            continue
+
+        options = chunking_options(interfaces[name], buffer_bytes)
+        if options is not None:
+            for key, value in options.items():
+                conversion_options.setdefault(name, {}).setdefault(key, value)
+            report.interfaces[name] = (size, 'chunked')
+        elif size is None:
+            report.interfaces[name] = (size, 'in memory (unknown size)')
+        else:
+            report.interfaces[name] = (size, 'in memory')
+            report.problems.append(f'{name} needs ~{format_size(size)} and cannot write in chunks')
+
+    if len(report.problems) > 0:
+        raise MemoryBudgetError('Conversion cannot stay within the memory budget:', report=report)
+
+    return conversion_options, report
@@ -1,29 +1,232 @@
 import typing
 from typing import Optional
-import itertools
 import shutil
 from pathlib import Path
 
-from tqdm import tqdm
-
 from nwb_conversion_tools import NWBConverter as _NWBConverter
 from nwb_conversion_tools.interfaces import list_interfaces
 
-from onice_conversion.spec import BaseSpec
+from onice_conversion.spec import BaseSpec, merge, MergedMetadata
+from onice_conversion.spec.external_file import BaseExternalFileSpec
 from onice_conversion import containers
+from onice_conversion.discovery import discover, DiscoveryCache, DiscoveryResult
+from onice_conversion.pipeline import PipelinedWriter, VerificationReport
+from onice_conversion.batch import CostModel, Session, SessionEstimate
+from onice_conversion.memory import parse_size, plan_conversion, RSSMonitor, MemoryReport, CACHE_FRACTION
+from onice_conversion.utils import MemoryBudgetError, VerificationError, _package_version
+from onice_conversion.validation import get_validator
 
 class NWBConverter(_NWBConverter):
     """
     ONICE extension to :class:`nwb_conversion_tools.NWBConverter`
 
-
-
+    Args:
+        memory_budget (int, str): Optional. Maximum memory the conversion may use, in bytes
+            or as a string like ``'4 GB'`` . Interfaces that would push us over are written
+            in chunks, :attr:`.BaseExternalFileSpec.loaded_files` is bounded, and the run fails
+            with a :class:`~.utils.MemoryBudgetError` rather than exceeding it.
+            See :mod:`onice_conversion.memory`
+        pipeline (:class:`.pipeline.PipelinedWriter`): Optional. Write the file with a pipeline that
+            reads, compresses, and writes streams added to it in parallel. See :mod:`onice_conversion.pipeline` .
+            Only interfaces that call :meth:`.PipelinedWriter.add_stream` for their data
+            (eg. :class:`.interfaces.PositionInterface` ) use it, stock ``nwb_conversion_tools``
+            interfaces are written as usual. The same pipeline is reused for every conversion.
+
+    Attributes:
+        metadata_sources (dict): ``{metadata path: spec}`` , which spec produced each metadata value,
+            so validation errors can point to it. Filled by :meth:`.parse_spec` ,
+            see also :func:`.validation.spec_sources`
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args,
+                 memory_budget:typing.Optional[typing.Union[int, str]]=None,
+                 pipeline:typing.Optional[PipelinedWriter]=None,
+                 **kwargs):
         super(NWBConverter, self).__init__(*args, **kwargs)
         self._base_nwb_metadata = {}
 
+        self.memory_budget = parse_size(memory_budget) if memory_budget is not None else None
+        self.memory_report = None # type: typing.Optional[MemoryReport]
+
+        self.pipeline = pipeline
+        self.verification_report = None # type: typing.Optional[VerificationReport]
+
+        self.metadata_sources = {} # type: typing.Dict[tuple, BaseSpec]
+
+    def run_conversion(self,
+                       metadata:typing.Optional[dict]=None,
+                       save_to_file:bool=True,
+                       nwbfile_path:typing.Optional[str]=None,
+                       overwrite:bool=False,
+                       conversion_options:typing.Optional[dict]=None,
+                       verify:bool=False,
+                       **kwargs):
+        """
+        Run the conversion, see :meth:`nwb_conversion_tools.NWBConverter.run_conversion`
+
+        If we have a :attr:`.memory_budget` , first plan which interfaces need to be
+        written in chunks with :func:`.memory.plan_conversion` , then run while
+        watching the RSS. The plan and the peak RSS are kept in :attr:`.memory_report`
+
+        If we have a :attr:`.pipeline` , it is given to each data interface as its
+        ``pipeline`` attribute so they can use :meth:`.PipelinedWriter.add_stream`
+        for their data, and the file is written with :meth:`.PipelinedWriter.write`
+
+        With ``verify=True`` , the pipeline takes checksums of its streams as it writes them,
+        and then checks the written file against them with :meth:`.PipelinedWriter.verify` .
+        The result is kept in :attr:`.verification_report`
+
+        Without a pipeline, nwb_conversion_tools writes the file in one go, so the RSS can only
+        be checked before it starts: going over the budget while writing is noted in
+        :attr:`.memory_report` 's ``problems`` rather than raised, once the file is written.
+
+        Raises:
+            :class:`~.utils.MemoryBudgetError` if the budget can't be met, with the :attr:`.memory_report`
+                as its ``report``
+            :class:`~.utils.VerificationError` if verifying and the file doesn't match its source data
+        """
+        if verify:
+            if self.pipeline is None or not save_to_file:
+                raise ValueError('Can only verify files written to disk with a pipeline, see onice_conversion.pipeline')
+            self.pipeline.checksums = True
+
+        run_kwargs = dict(metadata=metadata, save_to_file=save_to_file, nwbfile_path=nwbfile_path,
+                          overwrite=overwrite, verify=verify, **kwargs)
+
+        if self.memory_budget is None:
+            return self._run_conversion(conversion_options=conversion_options, **run_kwargs)
+
+        cache_bytes = BaseExternalFileSpec.loaded_files.max_bytes
+        BaseExternalFileSpec.loaded_files.max_bytes = int(self.memory_budget * CACHE_FRACTION)
+        try:
+            conversion_options, self.memory_report = plan_conversion(
+                self.data_interface_objects, self.memory_budget, conversion_options)
+
+            monitor = RSSMonitor(budget=self.memory_budget)
+            try:
+                with monitor:
+                    return self._run_conversion(conversion_options=conversion_options, check=monitor.check, **run_kwargs)
+            except MemoryError as e:
+                self.memory_report.peak = monitor.peak
+                raise MemoryBudgetError(f'Conversion exceeded the memory budget: {e}', report=self.memory_report) from e
+            finally:
+                self.memory_report.peak = monitor.peak
+            if monitor.exceeded:
+                # the file's already written by the time we could notice, so don't throw it away
+                self.memory_report.problems.append('RSS went over the budget while writing')
+        finally:
+            BaseExternalFileSpec.loaded_files.max_bytes = cache_bytes
+
+    def validate_metadata(self, metadata:dict):
+        """
+        Validate metadata against :meth:`.get_metadata_schema` with a compiled validator
+        (see :mod:`onice_conversion.validation` ) that's cached by :meth:`.metadata_schema_key` ,
+        so the schema is only built and compiled once for every session of the same converter.
+
+        Raises:
+            :class:`~.utils.MetadataValidationError` listing every error, and the spec
+            in :attr:`.metadata_sources` that produced each offending value
+        """
+        get_validator(self.metadata_schema_key(), self.get_metadata_schema).validate(
+            metadata, sources=self.metadata_sources)
+        print("Metadata is valid!")
+
+    def parse_spec(self, spec:typing.Union[BaseSpec, typing.Iterable[BaseSpec]],
+                   base_dir:typing.Optional[Path]=None,
+                   metadata:typing.Optional[dict]=None,
+                   policy:str='last') -> MergedMetadata:
+        """
+        Parse one or more specs, merging their metadata with :func:`.spec.merge.merge` , and
+        record which spec set each value in :attr:`.metadata_sources` so :meth:`.validate_metadata`
+        can point to them.
+
+        Args:
+            spec (:class:`.BaseSpec`, list): the spec (or its chain), or a list of them
+            base_dir (:class:`pathlib.Path`): Optional. Where to parse from, default the ``base_dir``
+                given on instantiation
+            metadata (dict): Optional. Other metadata the specs may use, see :meth:`.BaseSpec.parse`
+            policy (str): how to resolve specs that set the same key, see :mod:`.spec.merge`
+
+        Returns:
+            :class:`.spec.merge.MergedMetadata`
+        """
+        if base_dir is None:
+            base_dir = getattr(self, 'base_dir', None)
+            if base_dir is None:
+                raise ValueError("No base_dir passed, and none give on instantiation. Need to know where to go!")
+        specs = [spec] if isinstance(spec, BaseSpec) else spec
+        merged = merge((output for spec in specs for output in spec.outputs(Path(base_dir), metadata)),
+                       policy=policy)
+        self.metadata_sources.update(merged.sources)
+        return merged
+
+    def metadata_schema_key(self) -> typing.Optional[tuple]:
+        """
+        What :meth:`.get_metadata_schema` depends on: the converter, the classes of its
+        interfaces, and the versions of the packages that define them.
+
+        Override to return ``None`` if an interface's schema depends on its source data,
+        then the compiled validator is cached by the contents of the schema instead.
+        """
+        return (
+            '.'.join((type(self).__module__, type(self).__qualname__)),
+            _package_version(_NWBConverter),
+            tuple(sorted(
+                (name, '.'.join((type(interface).__module__, type(interface).__qualname__)), _package_version(type(interface)))
+                for name, interface in self.data_interface_objects.items()))
+        )
+
+    @classmethod
+    def estimate(cls, source_data:dict,
+                 cost_model:typing.Optional[CostModel]=None) -> SessionEstimate:
+        """
+        Dry run: estimate the bytes and seconds each interface will take to convert some
+        ``source_data`` from the sizes of its files, without instantiating anything.
+
+        To plan and run many sessions largest-first, see :func:`.batch.run_batch`
+
+        Args:
+            source_data (dict): as would be given to the converter
+            cost_model (:class:`.batch.CostModel`): Optional. Calibrated by previous runs.
+
+        Returns:
+            :class:`.batch.SessionEstimate`
+        """
+        if cost_model is None:
+            cost_model = CostModel()
+        return cost_model.estimate(Session(cls.__name__, cls, source_data, nwbfile_path=''))
+
+    def _run_conversion(self, save_to_file:bool=True, nwbfile_path:typing.Optional[str]=None,
+                        overwrite:bool=False, verify:bool=False,
+                        check:typing.Optional[typing.Callable[[], None]]=None, **kwargs):
+        """
+        ``check`` is called between steps (and between the pipeline's blocks), and raises to stop
+        the conversion, eg. :meth:`.memory.RSSMonitor.check`
+        """
+        if check is None:
+            check = lambda: None
+
+        check()
+        if self.pipeline is None or not save_to_file:
+            return super(NWBConverter, self).run_conversion(
+                save_to_file=save_to_file, nwbfile_path=nwbfile_path, overwrite=overwrite, **kwargs)
+
+        for interface in self.data_interface_objects.values():
+            interface.pipeline = self.pipeline
+
+        nwbfile = super(NWBConverter, self).run_conversion(save_to_file=False, **kwargs)
+        if nwbfile is None:
+            raise RuntimeError('nwb_conversion_tools did not return the NWBFile when save_to_file=False, cant write it with the pipeline')
+        check()
+        stats = self.pipeline.write(nwbfile, nwbfile_path, overwrite=overwrite, check=check)
+        print(f'NWB file saved at {nwbfile_path}! pipeline: {stats}')
+
+        if verify:
+            self.verification_report = self.pipeline.verify(nwbfile_path)
+            print(self.verification_report)
+            if not self.verification_report.ok:
+                raise VerificationError(f'{nwbfile_path} does not match its source data:\n{self.verification_report}')
+
     def add_container(self,
                       container_name:typing.Optional[str]=None,
                       spec:typing.Optional[BaseSpec]=None,
@@ -69,8 +272,16 @@ class NWBConverter(_NWBConverter):
 
 
     def hail_mary(self, base_dir: Optional[Path] = None,
-                  interface_type: Optional[str] = None
-                  ):
+                  interface_type: Optional[str] = None,
+                  cache: Optional[typing.Union[str, Path, DiscoveryCache]] = None,
+                  ranked: bool = False,
+                  max_hits_per_path: Optional[int] = None,
+                  max_hits_per_type: Optional[int] = None,
+                  time_budget: Optional[float] = None,
+                  probe: bool = False,
+                  sample: Optional[int] = None,
+                  verify: int = 0
+                  ) -> DiscoveryResult:
         """
         Just try every interface on every file and see what instantiates.
 
@@ -78,15 +289,31 @@ class NWBConverter(_NWBConverter):
         ----------
         base_dir : directory to peruse. if none, then the base_dir provided on init is used.
         interface_type : if provided, only try interfaces of this type
+        cache : path to a :class:`.discovery.DiscoveryCache` database (or the cache itself).
+            If provided, results from previous scans are reused for paths whose size and mtime
+            haven't changed, and only new or modified paths are tried.
+        ranked : try the most likely interface/path combinations first, using heuristics and
+            (if a ``cache`` is given) hit statistics from previous runs.
+            See :func:`.discovery.score_attempt`
+        max_hits_per_path : stop trying a path once this many interfaces have opened it
+        max_hits_per_type : stop trying interfaces of a type once this many of them have hit
+        time_budget : give up after this many seconds and return the best hits found so far
+        probe : don't keep every instantiated interface open. Hits only keep a summary
+            (eg. channel count and duration, see :func:`.discovery.summarize` ), and are
+            instantiated again when their ``instance`` is used.
+        sample : for trees with many nearly identical files, only try this many paths of each
+            pattern (eg. ``trial_#.mat`` , see :func:`.discovery.path_pattern` ) and extrapolate
+            their hits to the rest
+        verify : when sampling, also try this many random other paths of each pattern that had hits
 
         Returns
         -------
-        tuple of::
+        :class:`.discovery.DiscoveryResult` , a list of :class:`.discovery.Hit` s that unpack as tuples of::
 
             (interface object,
             path (relative to base_dir),
             parameter key that was used,
-            and the instantiated object itself)
+            and the instantiated object itself, or None until its ``instance`` is used if it was cached or probed)
         """
         if base_dir is None:
             if self.base_dir is None:
@@ -103,10 +330,6 @@ class NWBConverter(_NWBConverter):
 
         interfaces = list_interfaces(interface_type)
 
-        # create iterator to go over all files and interfaces...
-        all_paths = itertools.chain((base_dir,), base_dir.glob("**/[!\.]*"))
-        everything = itertools.product(interfaces, all_paths)
-
         # ----------------------------------------------------------------------- #
         # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! #
         #                                                                         #
@@ -120,24 +343,32 @@ class NWBConverter(_NWBConverter):
         #                 w h a t   i f   i t   w o r k s   ? ? ?                 #
         # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! #
         # ----------------------------------------------------------------------- #
-        hits = []
-        hit_bar = tqdm(position=1, desc="Hits")
-        for interface, path in tqdm(everything, position=0):
-            for req_param in interface.get_source_schema().get('required', []):
-                try:
-                    instance = interface(**{req_param: str(path)})
-                    hits.append((interface, path.relative_to(base_dir), req_param, instance))
-                    hit_bar.update()
-                except:
-                    # print(e, interface, req_param, str(path))
-                    pass
+        discover_kwargs = {
+            'ranked': ranked,
+            'max_hits_per_path': max_hits_per_path,
+            'max_hits_per_type': max_hits_per_type,
+            'time_budget': time_budget,
+            'probe': probe,
+            'sample': sample,
+            'verify': verify
+        }
+        if cache is not None and not isinstance(cache, DiscoveryCache):
+            with DiscoveryCache(cache) as cache:
+                hits = discover(interfaces, base_dir, cache=cache, **discover_kwargs)
+        else:
+            hits = discover(interfaces, base_dir, cache=cache, **discover_kwargs)
 
         emotion = ":)" if len(hits) > 0 else ":("
         hit_string = "\n".join(
-            [f"{interf.interface_type}, {interf.device_name}, {req_param}, {path}" for interf, path, req_param, _ in
-             hits])
-
-        print(f'Found {len(hits)} hits {emotion}\n\n' + hit_string)
+            [f"{hit.interface.interface_type}, {hit.interface.device_name}, {hit.param}, {hit.path}"
+             + (f", {hit.summary}" if len(hit.summary) > 0 else "") for hit in hits])
+        cache_string = f" ({hits.cached} of {hits.attempts} attempts served from cache)" if cache is not None else ""
+        if not hits.complete:
+            cache_string += f" (stopped after {hits.elapsed:.1f}s time budget)"
+        if sample is not None:
+            cache_string += f" ({hits.extrapolated} extrapolated from samples of {hits.clusters} path patterns)"
+
+        print(f'Found {len(hits)} hits {emotion}{cache_string}\n\n' + hit_string)
         return hits
 
 
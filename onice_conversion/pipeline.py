@@ -0,0 +1,477 @@
+"""
+Pipelined writing of large datasets.
+
+Normally every dataset in an NWB file is read, compressed, and written one
+after another on a single thread. Instead, a :class:`.PipelinedWriter` lets you
+use empty placeholders (see :meth:`.PipelinedWriter.add_stream` ) as the data of your
+containers, writes the skeleton of the file, and then fills all the placeholders at once:
+
+* reader threads take blocks of rows from each stream's source (round-robin across streams),
+  and for datasets that use no filter or the ``gzip`` (+ ``shuffle`` ) filters, compress
+  them into HDF5 chunks themselves (:func:`zlib.compress` releases the GIL, so this
+  actually runs in parallel)
+* prepared chunks go through a bounded queue, so reading can't get too far ahead of writing
+* a single writer commits them to the file -- precompressed chunks with
+  :meth:`h5py.h5d.DatasetID.write_direct_chunk` , anything else with a normal write
+  (where HDF5 compresses them itself)
+
+eg. for the position series and sniff signal from the smear example::
+
+    pipeline = PipelinedWriter(n_readers=4)
+    tracking = Position()
+    for i, name in enumerate(('nose', 'head', 'body')):
+        tracking.create_spatial_series(name=name, data=pipeline.add_stream(name, frame_params[:, i*2:i*2+2]),
+                                       timestamps=frame_msec, reference_frame='session start')
+    sniff = TimeSeries(name='sniff_signal', data=pipeline.add_stream('sniff', sniff_signal), unit='V', rate=800.)
+    ...
+    stats = pipeline.write(nwbfile, 'session.nwb')
+
+When an :class:`.NWBConverter` is given a ``pipeline`` , its data interfaces get it as their
+``pipeline`` attribute to add their streams to, and :meth:`.NWBConverter.run_conversion`
+writes the file with it. Only interfaces written to use it (ie. that call
+:meth:`.PipelinedWriter.add_stream` for their data when they have a ``pipeline`` ) benefit --
+the stock ``nwb_conversion_tools`` interfaces don't, and their data is written normally.
+
+With ``checksums=True`` , the reader threads also take a CRC32 of each chunk as they prepare it,
+and :meth:`.PipelinedWriter.verify` checks the written file against them: chunks are read back
+raw (:meth:`h5py.h5d.DatasetID.read_direct_chunk` ), and inflated and checksummed by a pool
+of threads (both release the GIL), rather than reading every dataset back through HDF5's
+filters on one thread. For chunks the pipeline compresses itself, the checksum is of the chunk
+as it's stored before compression (shuffled, and padded at the edges) so it can be checked
+without unshuffling it, otherwise it's of the source data. Mismatched chunks are listed in a
+:class:`.VerificationReport`
+"""
+import itertools
+import queue
+import threading
+import time
+import typing
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBHDF5IO
+
+from onice_conversion.datasource import read_block
+
+CHUNK_BYTES = 2**20
+"""
+Target size of each HDF5 chunk if one isn't given to :meth:`.PipelinedWriter.add_stream`
+"""
+
+
+class Stream(object):
+    """
+    A dataset that will be filled by a :class:`.PipelinedWriter`
+
+    Args:
+        name (str): Name, for reporting
+        source: Anything with ``shape`` and ``dtype`` that can be sliced along its first axis,
+            eg. an array, a memmap, an h5py dataset, or a :class:`.datasource.DataSource`
+        data_io (:class:`hdmf.backends.hdf5.H5DataIO`): the placeholder used in the NWB file
+
+    Attributes:
+        dataset_name (str): path of the dataset in the written file
+        checksums (dict): ``{chunk offset: CRC32}`` of the source data, if the pipeline takes checksums
+    """
+
+    def __init__(self, name:str, source, data_io:H5DataIO):
+        self.name = name
+        self.source = source
+        self.data_io = data_io
+        self.dataset_name = None # type: typing.Optional[str]
+        self.checksums = None # type: typing.Optional[typing.Dict[typing.Tuple[int, ...], int]]
+
+    @property
+    def shape(self) -> typing.Tuple[int, ...]:
+        return tuple(self.source.shape)
+
+    def blocks(self, rows:int) -> typing.List[typing.Tuple[int, int]]:
+        """``(start, stop)`` rows of each block, ``rows`` at a time"""
+        return [(start, min(start + rows, self.shape[0])) for start in range(0, self.shape[0], rows)]
+
+
+class PipelineStats(object):
+    """
+    How a :meth:`.PipelinedWriter.fill` went.
+
+    Attributes:
+        bytes_read (int): uncompressed bytes read from the sources
+        bytes_written (int): bytes committed to the file (compressed, for precompressed chunks)
+        chunks (int): number of chunks written
+        direct_chunks (int): how many of those were precompressed by the reader threads
+        elapsed (float): seconds to fill every stream
+    """
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.chunks = 0
+        self.direct_chunks = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Uncompressed bytes per second"""
+        return self.bytes_read / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f'{self.chunks} chunks ({self.direct_chunks} precompressed), '
+                f'{self.bytes_read / 1e6:.1f} MB read, {self.bytes_written / 1e6:.1f} MB written '
+                f'in {self.elapsed:.2f}s ({self.throughput / 1e6:.1f} MB/s)')
+
+
+class VerificationReport(object):
+    """
+    How a :meth:`.PipelinedWriter.verify` went.
+
+    Attributes:
+        chunks (int): number of chunks checked
+        bytes_checked (int): uncompressed bytes checked
+        mismatches (list): ``(stream name, chunk offset)`` of each chunk that didn't match its source
+        elapsed (float): seconds it took
+    """
+
+    def __init__(self):
+        self.chunks = 0
+        self.bytes_checked = 0
+        self.mismatches = [] # type: typing.List[typing.Tuple[str, typing.Tuple[int, ...]]]
+        self.elapsed = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return len(self.mismatches) == 0
+
+    def __str__(self) -> str:
+        out = (f'verified {self.chunks} chunks, {self.bytes_checked / 1e6:.1f} MB in {self.elapsed:.2f}s: '
+               + ('ok' if self.ok else f'{len(self.mismatches)} mismatched'))
+        for name, offset in self.mismatches[:10]:
+            out += f'\n  {name} chunk at {offset}'
+        if len(self.mismatches) > 10:
+            out += f'\n  ... and {len(self.mismatches) - 10} more'
+        return out
+
+
+class _Sentinel(object):
+    """Passed through the queue when a reader is done (or has failed)"""
+    def __init__(self, error:typing.Optional[BaseException]=None):
+        self.error = error
+
+
+class PipelinedWriter(object):
+    """
+    Fill many datasets at once with overlapped reading, compression, and writing.
+    See the module docs for an overview.
+
+    Args:
+        n_readers (int): Number of threads reading (and compressing) blocks
+        queue_size (int): Maximum number of prepared blocks waiting to be written
+        checksums (bool): Take checksums of the source data while writing, to :meth:`.verify` the file after
+
+    A pipeline can write any number of files, one after another: the streams added since the last
+    write are the ones the next :meth:`.write` fills.
+
+    Attributes:
+        streams (list): streams added for the next write
+        written (list): streams of the last write, until they're :meth:`.verify` 'd
+    """
+
+    def __init__(self, n_readers:int=4, queue_size:int=16, checksums:bool=False):
+        self.n_readers = n_readers
+        self.queue_size = queue_size
+        self.checksums = checksums
+        self.streams = [] # type: typing.List[Stream]
+        self.written = [] # type: typing.List[Stream]
+        self.stats = None # type: typing.Optional[PipelineStats]
+
+    def add_stream(self, name:str, source,
+                   chunks:typing.Optional[typing.Tuple[int, ...]]=None,
+                   compression:typing.Optional[str]='gzip',
+                   compression_opts:typing.Optional[int]=None,
+                   shuffle:bool=True,
+                   **kwargs) -> H5DataIO:
+        """
+        Add a stream to be written by the pipeline.
+
+        Args:
+            name (str): name of the stream, for reporting
+            source: the data, anything with ``shape`` and ``dtype`` that can be sliced along its first axis
+            chunks (tuple): HDF5 chunk shape. If None, chunks of whole rows of about :data:`.CHUNK_BYTES`
+            compression (str): HDF5 compression filter. ``'gzip'`` or ``None`` are compressed by the
+                pipeline, others are left to HDF5
+            compression_opts (int): compression level, defaults to 4 for ``'gzip'`` .
+                Other filters take their own options, eg. none for ``'lzf'``
+            shuffle (bool): use the shuffle filter
+            **kwargs: passed to :class:`hdmf.backends.hdf5.H5DataIO`
+
+        Returns:
+            :class:`hdmf.backends.hdf5.H5DataIO` , an empty placeholder to use as the ``data`` of a container
+        """
+        shape = tuple(source.shape)
+        dtype = np.dtype(source.dtype)
+        if chunks is None:
+            chunks = (min(shape[0], _block_rows(shape, dtype)),) + shape[1:]
+
+        if compression == 'gzip' and compression_opts is None:
+            compression_opts = 4
+        data_io = H5DataIO(shape=shape, dtype=dtype, chunks=chunks, compression=compression,
+                           compression_opts=compression_opts, shuffle=shuffle, **kwargs)
+        self.streams.append(Stream(name, source, data_io))
+        return data_io
+
+    def write(self, nwbfile, nwbfile_path:typing.Union[str, Path], overwrite:bool=False,
+              check:typing.Optional[typing.Callable[[], None]]=None) -> PipelineStats:
+        """
+        Write an NWB file that uses our streams' placeholders, and then fill them with :meth:`.fill`
+
+        Args:
+            nwbfile (:class:`pynwb.NWBFile`): file to write
+            nwbfile_path (str, :class:`pathlib.Path`): where to write it
+            overwrite (bool): overwrite ``nwbfile_path`` if it exists
+            check (callable): Optional. Passed to :meth:`.fill`
+
+        Returns:
+            :class:`.PipelineStats`
+        """
+        if Path(nwbfile_path).exists() and not overwrite:
+            raise FileExistsError(f'{nwbfile_path} already exists, and pipelined writes can only make new files. Use overwrite=True')
+
+        with NWBHDF5IO(str(nwbfile_path), mode='w') as io:
+            io.write(nwbfile)
+            return self.fill(check=check)
+
+    def fill(self, check:typing.Optional[typing.Callable[[], None]]=None) -> PipelineStats:
+        """
+        Fill the datasets of all our streams. They must have just been written
+        (ie. their file is still open) so that their ``data_io.dataset`` is available.
+
+        Afterwards (whether or not it succeeded) the streams are moved to :attr:`.written` ,
+        so the pipeline is ready for the next file.
+
+        Args:
+            check (callable): Optional. Called before writing each block, and raises to stop,
+                eg. :meth:`.memory.RSSMonitor.check`
+
+        Returns:
+            :class:`.PipelineStats` , also kept in :attr:`.stats`
+        """
+        try:
+            return self._fill(check)
+        finally:
+            self.written, self.streams = self.streams, []
+
+    def _fill(self, check:typing.Optional[typing.Callable[[], None]]=None) -> PipelineStats:
+        stats = PipelineStats()
+        start_time = time.time()
+
+        # get everything we need from h5py up front, so reader threads don't need it
+        plans = []
+        for stream in self.streams:
+            dataset = stream.data_io.dataset
+            if dataset is None:
+                raise RuntimeError(f'Stream {stream.name} has no dataset, was it used in the NWB file that was written?')
+            direct = _direct(dataset)
+            stream.dataset_name = dataset.name
+            stream.checksums = {} if self.checksums else None
+            plans.append({
+                'stream': stream,
+                'dataset': dataset,
+                'dtype': dataset.dtype,
+                'chunks': dataset.chunks,
+                'direct': direct,
+                'shuffle': dataset.shuffle,
+                'level': dataset.compression_opts if dataset.compression == 'gzip' else None
+            })
+
+        # interleave blocks of each stream so they all progress together
+        work = queue.Queue()
+        block_lists = [[(plan, block) for block in plan['stream'].blocks(
+                            plan['chunks'][0] if plan['chunks'] else _block_rows(plan['stream'].shape, plan['dtype']))]
+                       for plan in plans]
+        for item in itertools.chain.from_iterable(itertools.zip_longest(*block_lists)):
+            if item is not None:
+                work.put(item)
+
+        prepared = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        readers = [threading.Thread(target=self._read, args=(work, prepared, stop), daemon=True)
+                   for _ in range(self.n_readers)]
+        for reader in readers:
+            reader.start()
+
+        # the calling thread is the one writer
+        finished = 0
+        try:
+            while finished < len(readers):
+                item = prepared.get()
+                if isinstance(item, _Sentinel):
+                    if item.error is not None:
+                        raise item.error
+                    finished += 1
+                    continue
+
+                if check is not None:
+                    check()
+                plan, n_bytes, chunks = item
+                stats.bytes_read += n_bytes
+                for offset, data in chunks:
+                    if plan['direct']:
+                        plan['dataset'].id.write_direct_chunk(offset, data, 0)
+                        stats.direct_chunks += 1
+                        stats.bytes_written += len(data) if isinstance(data, bytes) else data.nbytes
+                    else:
+                        plan['dataset'][offset] = data
+                        stats.bytes_written += data.nbytes
+                    stats.chunks += 1
+        finally:
+            stop.set()
+            # drain so readers blocked on a full queue can exit
+            while any(reader.is_alive() for reader in readers):
+                try:
+                    prepared.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+        stats.elapsed = time.time() - start_time
+        self.stats = stats
+        return stats
+
+    def _read(self, work:queue.Queue, prepared:queue.Queue, stop:threading.Event):
+        """Reader thread: take blocks from ``work`` , prepare their chunks, and put them in ``prepared``"""
+        try:
+            while not stop.is_set():
+                try:
+                    plan, (start, stop_row) = work.get_nowait()
+                except queue.Empty:
+                    break
+                block = np.ascontiguousarray(read_block(plan['stream'].source, start, stop_row), dtype=plan['dtype'])
+                prepared.put((plan, block.nbytes, _prepare_chunks(plan, block, start, plan['stream'].checksums)))
+            prepared.put(_Sentinel())
+        except BaseException as e:
+            prepared.put(_Sentinel(e))
+
+
+    def verify(self, nwbfile_path:typing.Union[str, Path], n_workers:typing.Optional[int]=None) -> VerificationReport:
+        """
+        Check the datasets of the file we've just written against the checksums taken while writing it.
+        Its streams are let go of afterwards.
+
+        Args:
+            nwbfile_path (str, :class:`pathlib.Path`): the written file
+            n_workers (int): threads to check chunks with, default :attr:`.n_readers`
+
+        Returns:
+            :class:`.VerificationReport`
+        """
+        import h5py
+
+        streams = [stream for stream in self.written if stream.checksums is not None]
+        self.written = []
+        if len(streams) == 0:
+            raise RuntimeError('No checksums to verify against, use a PipelinedWriter with checksums=True to write the file')
+
+        report = VerificationReport()
+        start_time = time.time()
+        with h5py.File(str(nwbfile_path), 'r') as h5f:
+            tasks = []
+            for stream in streams:
+                dataset = h5f[stream.dataset_name]
+                check = {
+                    'dataset': dataset,
+                    'direct': _direct(dataset),
+                    'shape': dataset.shape,
+                    'chunks': dataset.chunks,
+                    'gzip': dataset.compression == 'gzip'
+                }
+                tasks.extend((stream.name, check, offset, checksum) for offset, checksum in stream.checksums.items())
+
+            with ThreadPoolExecutor(max_workers=n_workers if n_workers is not None else self.n_readers) as executor:
+                for name, offset, n_bytes, matched in executor.map(lambda task: _check_chunk(*task), tasks):
+                    report.chunks += 1
+                    report.bytes_checked += n_bytes
+                    if not matched:
+                        report.mismatches.append((name, offset))
+
+        report.elapsed = time.time() - start_time
+        return report
+
+
+def _direct(dataset) -> bool:
+    """Whether a dataset's chunks can be written/read raw, filtering them ourselves"""
+    return (dataset.compression in (None, 'gzip') and dataset.chunks is not None and
+            not dataset.fletcher32 and dataset.scaleoffset is None and not dataset.dtype.hasobject)
+
+def _block_rows(shape:typing.Tuple[int, ...], dtype:np.dtype) -> int:
+    """How many rows of an array fit in about :data:`.CHUNK_BYTES`"""
+    row_bytes = max(1, int(np.prod(shape[1:], dtype=int)) * np.dtype(dtype).itemsize)
+    return max(1, CHUNK_BYTES // row_bytes)
+
+def _prepare_chunks(plan:dict, block:np.ndarray, start:int, checksums:typing.Optional[dict]=None) -> list:
+    """
+    Split a block of rows into chunks ready to write.
+
+    For direct writes, each chunk is padded to the full chunk shape, shuffled
+    and deflated like the HDF5 filters would, and returned with its offset.
+    Otherwise blocks are returned with the selection to write them to.
+
+    If given a ``checksums`` dict, the CRC32 of each chunk is added to it (see module docs)
+    """
+    if not plan['direct']:
+        if checksums is not None:
+            checksums.update(_checksums(plan['chunks'], block, start))
+        return [((slice(start, start + block.shape[0]),), block)]
+
+    chunk_shape = plan['chunks']
+    chunks = []
+    # grid of chunks over the non-row dimensions
+    grid = [range(0, dim, chunk_dim) for dim, chunk_dim in zip(block.shape[1:], chunk_shape[1:])]
+    for corner in itertools.product(*grid):
+        selection = (slice(0, block.shape[0]),) + tuple(slice(c, c + size) for c, size in zip(corner, chunk_shape[1:]))
+        chunk = block[selection]
+        if chunk.shape != chunk_shape:
+            # edge chunks are stored full-size
+            padded = np.zeros(chunk_shape, dtype=block.dtype)
+            padded[tuple(slice(0, dim) for dim in chunk.shape)] = chunk
+            chunk = padded
+        data = np.ascontiguousarray(chunk)
+        if plan['shuffle'] and data.dtype.itemsize > 1:
+            data = data.reshape(-1).view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes()
+        if checksums is not None:
+            checksums[(start,) + corner] = zlib.crc32(data)
+        if plan['level'] is not None:
+            data = zlib.compress(data, plan['level'])
+        # otherwise, uncompressed chunks are written straight from the (source) buffer
+        chunks.append(((start,) + corner, data))
+    return chunks
+
+def _checksums(chunk_shape:typing.Optional[typing.Tuple[int, ...]], block:np.ndarray, start:int) -> typing.Dict[tuple, int]:
+    """CRC32 of the source data of each chunk of a block of rows, by chunk offset"""
+    if chunk_shape is None:
+        return {(start,) + (0,) * (block.ndim - 1): zlib.crc32(block)}
+    checksums = {}
+    grid = [range(0, dim, chunk_dim) for dim, chunk_dim in zip(block.shape[1:], chunk_shape[1:])]
+    for corner in itertools.product(*grid):
+        selection = (slice(0, block.shape[0]),) + tuple(slice(c, c + size) for c, size in zip(corner, chunk_shape[1:]))
+        checksums[(start,) + corner] = zlib.crc32(np.ascontiguousarray(block[selection]))
+    return checksums
+
+def _check_chunk(name:str, check:dict, offset:typing.Tuple[int, ...], checksum:int
+                 ) -> typing.Tuple[str, typing.Tuple[int, ...], int, bool]:
+    """Read a chunk back and compare it to its checksum"""
+    if check['direct']:
+        try:
+            filter_mask, data = check['dataset'].id.read_direct_chunk(offset)
+        except Exception:
+            # eg. a chunk that was never written
+            return name, offset, 0, False
+        # inflating and checksumming release the GIL, so this runs in parallel
+        if filter_mask == 0 and check['gzip']:
+            data = zlib.decompress(data)
+        return name, offset, len(data), filter_mask == 0 and zlib.crc32(data) == checksum
+
+    chunk_shape = check['chunks'] if check['chunks'] is not None else check['shape']
+    region = tuple(slice(o, min(o + size, dim)) for o, size, dim in zip(offset, chunk_shape, check['shape']))
+    chunk = np.ascontiguousarray(check['dataset'][region])
+    return name, offset, chunk.nbytes, zlib.crc32(chunk) == checksum
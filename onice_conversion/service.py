@@ -0,0 +1,283 @@
+"""
+A warm conversion service on a Unix socket.
+
+Importing pynwb, nwb-conversion-tools, every extractor library, and scipy takes
+seconds, which is most of the time it takes to convert a small session. A :class:`.Service`
+does all of that once, then forks a pool of workers that inherit the warm imports
+(and keep their own spec caches, eg. :attr:`.BaseExternalFileSpec.loaded_files` , warm between
+requests) and take conversions from a Unix socket::
+
+    $ onice_conversion serve /tmp/onice.sock --workers 8 --preload my_lab.conversion
+
+    $ onice_conversion submit /tmp/onice.sock session.json
+
+Where ``session.json`` holds one or a list of :meth:`.batch.Session.to_dict` s -- a
+converter, its source data, and the output path, optionally with a spec bundle
+(a list of :meth:`.BaseSpec.to_dict` s) and the ``base_dir`` to parse it against.
+
+Requests and responses are single lines of JSON: ``{"command": "convert", "session": {...}}`` ,
+``{"command": "ping"}`` , or ``{"command": "stop"}`` (which shuts the service down).
+Use :func:`.submit` / :func:`.request` to talk to the service from python -- they only
+need the standard library, so clients start quickly.
+"""
+import importlib
+import json
+import os
+import signal
+import socket
+import time
+import traceback
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+PRELOAD = (
+    'numpy',
+    'scipy.io',
+    'h5py',
+    'hdmf',
+    'pynwb',
+    'nwb_conversion_tools',
+    'onice_conversion.nwbconverter',
+    'onice_conversion.spec',
+    'onice_conversion.batch',
+)
+"""
+Modules imported by the service before forking its workers
+"""
+
+
+class Service(object):
+    """
+    Pre-forking conversion server, see module docs.
+
+    Args:
+        socket_path (str, :class:`pathlib.Path`): Unix socket to listen on
+        n_workers (int): number of worker processes
+        preload (list): extra modules to import before forking, eg. the modules with your converters
+        max_requests (int): replace a worker after it's handled this many requests,
+            to bound the memory of long-lived caches. None to never replace them.
+    """
+
+    def __init__(self, socket_path:typing.Union[str, Path],
+                 n_workers:int=4,
+                 preload:typing.Optional[typing.List[str]]=None,
+                 max_requests:typing.Optional[int]=None):
+        self.socket_path = Path(socket_path)
+        self.n_workers = n_workers
+        self.preload = list(PRELOAD) + list(preload if preload is not None else [])
+        self.max_requests = max_requests
+        self.workers = set() # type: typing.Set[int]
+        self._socket = None # type: typing.Optional[socket.socket]
+        self._stopping = False
+
+    def warm(self):
+        """
+        Import :attr:`.preload` , every interface (and so every extractor library),
+        and build the index of container schemas
+        """
+        for module in self.preload:
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                print(f'Could not preload {module}: {e}')
+
+        try:
+            from nwb_conversion_tools.interfaces import list_interfaces
+            list_interfaces()
+        except Exception as e:
+            print(f'Could not preload interfaces: {e}')
+
+        try:
+            from onice_conversion import containers
+            containers.get_container()
+            for container_name in ('NWBFile', 'Subject'):
+                containers.get_container_schema(container_name)
+        except Exception as e:
+            print(f'Could not index containers: {e}')
+
+    def serve(self):
+        """
+        Warm up, fork the workers, and keep the pool full until we get SIGTERM, SIGINT, or a stop request
+        """
+        start_time = time.time()
+        self.warm()
+        print(f'warmed up in {time.time() - start_time:.1f}s')
+
+        if self.socket_path.exists():
+            if _alive(self.socket_path):
+                raise RuntimeError(f'A service is already listening on {self.socket_path}')
+            self.socket_path.unlink()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(str(self.socket_path))
+        self._socket.listen(max(16, self.n_workers * 4))
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGUSR1, self._stop)
+        try:
+            for _ in range(self.n_workers):
+                self._fork()
+            print(f'serving on {self.socket_path} with {self.n_workers} workers')
+
+            while not self._stopping:
+                try:
+                    pid, status = os.wait()
+                except (ChildProcessError, _Stop):
+                    break
+                self.workers.discard(pid)
+                self._fork()
+        except _Stop:
+            pass
+        finally:
+            self._shutdown()
+
+    def _fork(self):
+        pid = os.fork()
+        if pid == 0:
+            # worker: default signals, so the parent can terminate us
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            code = 0
+            try:
+                self._work()
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers.add(pid)
+
+    def _work(self):
+        """Worker loop: take one request per connection"""
+        handled = 0
+        while self.max_requests is None or handled < self.max_requests:
+            connection, _ = self._socket.accept()
+            message = {}
+            with connection:
+                try:
+                    message = json.loads(_read_line(connection))
+                    response = self.handle(message)
+                except Exception:
+                    response = {'ok': False, 'error': traceback.format_exc()}
+                response['worker'] = os.getpid()
+                try:
+                    connection.sendall(json.dumps(response).encode() + b'\n')
+                except OSError:
+                    # client went away
+                    pass
+            handled += 1
+            if message.get('command') == 'stop':
+                os.kill(os.getppid(), signal.SIGUSR1)
+
+    def handle(self, message:dict) -> dict:
+        """Handle a request in a worker, returning the response"""
+        command = message.get('command')
+        if command == 'ping':
+            return {'ok': True}
+        elif command == 'stop':
+            return {'ok': True}
+        elif command == 'convert':
+            from onice_conversion.batch import Session
+            session = Session.from_dict(message['session'])
+            start_time = time.time()
+            try:
+                session.run()
+                error = None
+            except Exception:
+                error = traceback.format_exc()
+            return {'ok': error is None, 'name': session.name, 'elapsed': time.time() - start_time, 'error': error}
+        else:
+            return {'ok': False, 'error': f'Unknown command {command}'}
+
+    def _stop(self, signum, frame):
+        # raise rather than just setting the flag, since os.wait retries when interrupted
+        if not self._stopping:
+            self._stopping = True
+            raise _Stop()
+
+    def _shutdown(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.workers.clear()
+        if self._socket is not None:
+            self._socket.close()
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+
+class _Stop(Exception):
+    """Raised in the service's main loop by signal handlers to stop it"""
+
+
+def _read_line(connection:socket.socket) -> bytes:
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return b''.join(chunks)
+
+def _alive(socket_path:Path) -> bool:
+    """Whether a service is listening on a socket"""
+    try:
+        return request(socket_path, {'command': 'ping'}, timeout=5).get('ok', False)
+    except OSError:
+        return False
+
+
+def request(socket_path:typing.Union[str, Path], message:dict, timeout:typing.Optional[float]=None) -> dict:
+    """
+    Send one request to a :class:`.Service` and wait for its response
+
+    Raises:
+        ConnectionError: if the worker died before responding
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(str(socket_path))
+        connection.sendall(json.dumps(message).encode() + b'\n')
+        response = _read_line(connection)
+    if not response:
+        raise ConnectionError('The service closed the connection without responding, the worker may have crashed')
+    return json.loads(response)
+
+def submit(socket_path:typing.Union[str, Path],
+           sessions:typing.Union[dict, typing.List[dict]],
+           n_jobs:int=1,
+           timeout:typing.Optional[float]=None) -> typing.List[dict]:
+    """
+    Convert sessions with a :class:`.Service`
+
+    Args:
+        socket_path (str, :class:`pathlib.Path`): the service's socket
+        sessions (dict, list): :meth:`.batch.Session.to_dict` s
+        n_jobs (int): how many to have converting at once
+        timeout (float): seconds to wait for each conversion
+
+    Returns:
+        list of responses, ``{'ok': bool, 'name': str, 'elapsed': float, 'error': traceback or None, 'worker': pid}``
+    """
+    if isinstance(sessions, dict):
+        sessions = [sessions]
+
+    def _submit(session:dict) -> dict:
+        try:
+            return request(socket_path, {'command': 'convert', 'session': session}, timeout=timeout)
+        except OSError:
+            return {'ok': False, 'name': session.get('name'), 'error': traceback.format_exc()}
+
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+        return list(executor.map(_submit, sessions))
@@ -10,15 +10,18 @@ If it's embedded within some path name, try :class:`.spec.Path`,
 
 If it's embedded in some .mat file, try :class:`.spec.Mat`
 
+If it's written in some notes or log file, try :class:`.spec.Text`
+
 .. todo::
 
     examples!
 
 """
 
-from onice_conversion.spec.base_spec import BaseSpec, from_dict
+from onice_conversion.spec.base_spec import BaseSpec, SpecSet, from_dict
 from onice_conversion.spec.path import Path, Paths, Glob
-from onice_conversion.spec.external_file import JSON, Mat, YAML
+from onice_conversion.spec.external_file import JSON, Mat, YAML, Text
+from onice_conversion.spec.merge import merge, MergedMetadata
 
 
 def parse_nested_spec(spec, base_dir):
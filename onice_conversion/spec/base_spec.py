@@ -4,8 +4,6 @@ import importlib
 from pathlib import Path
 import re
 
-from nwb_conversion_tools.json_schema_utils import dict_deep_update
-
 from onice_conversion.utils import IntrospectionMixin
 
 class BaseSpec(ABC, IntrospectionMixin):
@@ -23,7 +21,7 @@ class BaseSpec(ABC, IntrospectionMixin):
         retype : Callable (optional)
 
         """
-        self._child = None
+        self._children = None  # type: typing.Optional[SpecSet]
         self._parse_ref = None
         self._parent = None  # type: typing.Optional[BaseSpec]
 
@@ -31,10 +29,10 @@ class BaseSpec(ABC, IntrospectionMixin):
 
         self._init_args = self._get_init_args()
 
-    def parse(self, base_path: Path, metadata: typing.Optional[dict] = None) -> dict:
+    def parse(self, base_path: Path, metadata: typing.Optional[dict] = None, policy: str = 'last') -> 'MergedMetadata':
         """
         Parse all parameters from self and child :meth:`._parse` methods,
-        combining into single dictionary
+        combining into single dictionary with :func:`.spec.merge.merge`
 
         Parameters
         ----------
@@ -42,20 +40,40 @@ class BaseSpec(ABC, IntrospectionMixin):
             The base path we compute the spec'd value from!
         metadata: dict
             other metadata used by the parsing function, usually passed in :meth:`.NWBConverter.run_conversion`
+        policy: str
+            what to do when specs in the chain set the same key to different values,
+            ``'last'`` (later specs win, lists are appended), ``'first'`` , ``'error'`` ,
+            or ``'replace'`` (later specs win, lists too). See :mod:`.spec.merge`
 
         Returns
         -------
+        :class:`.spec.merge.MergedMetadata` , the metadata, which also records which spec set
+        each value and any conflicts
+        """
+        from onice_conversion.spec.merge import merge
+
+        return merge(self.outputs(base_path, metadata), policy=policy)
 
+    def outputs(self, base_path: Path, metadata: typing.Optional[dict] = None) -> typing.Iterator[typing.Tuple['BaseSpec', dict]]:
         """
-        if metadata is None:
-            metadata = {}
-        out = self._parse(base_path, metadata)
+        Parse self and each child separately, eg. to merge several chains of specs at once with
+        :func:`.spec.merge.merge`
 
-        if self._child is not None:
-            for child in self.children():
-                out = dict_deep_update(out, child._parse(base_path, metadata))
+        Parameters
+        ----------
+        base_path: Path
+            The base path we compute the spec'd value from!
+        metadata: dict
+            other metadata used by the parsing function
 
-        return out
+        Returns
+        -------
+        iterator of ``(spec, parsed metadata)`` tuples
+        """
+        if metadata is None:
+            metadata = {}
+        for spec in (self, *self.children()):
+            yield spec, spec._parse(base_path, metadata)
 
     @abstractmethod
     def _parse(self, base_path=None, metadata: typing.Optional[dict] = None) -> dict:
@@ -80,13 +98,9 @@ class BaseSpec(ABC, IntrospectionMixin):
         -------
         tuple of strings
         """
-        specified = list(self._specifies)
-
-        if self._child is not None:
-            for child in self.children():
-                specified.extend(list(child._specifies))
-
-        return tuple(specified)
+        if self._children is None:
+            return tuple(self._specifies)
+        return tuple(self._specifies) + self._children.specifies
 
     @property
     @abstractmethod
@@ -111,35 +125,26 @@ class BaseSpec(ABC, IntrospectionMixin):
 
     def children(self) -> typing.Iterable['BaseSpec']:
         """
-        Generator for iterating over children (added)
+        Iterate over children (added)
 
         Returns
         -------
-
+        iterator of specs, in the order they were added
         """
-        if self._child is None:
-            return
-
-        active_child = self._child
-        yield active_child
-
-        while active_child._child is not None:
-            active_child = active_child._child
-            yield active_child
+        if self._children is None:
+            return iter(())
+        return iter(self._children)
 
     def __add__(self, other: 'BaseSpec'):
         if not issubclass(type(other), BaseSpec):
             raise TypeError('can only add subclasses of BaseSpec')
 
-        if self._child is None:
-            # if we haven't been chained at all yet, claim the child
-            self._child = other
-            self._child.parent = self
-
-        else:
-            # we already have a child,
-            # add it to our child instead (potentially recursively)
-            self._child = self._child + other
+        if self._children is None:
+            self._children = SpecSet()
+        # other's own children are flattened in after it
+        for spec in (other, *other.children()):
+            spec.parent = self
+            self._children.append(spec)
 
         return self
 
@@ -161,21 +166,8 @@ class BaseSpec(ABC, IntrospectionMixin):
         dict of initialization parameters, as described above
         """
 
-        out_dict = {
-            'module': self.__module__,
-            'class': type(self).__name__,
-            'kwargs': self._init_args,
-            'children': []
-        }
-
-        if self._child is not None:
-            for child in self.children():
-                out_dict['children'].append({
-                    'module': child.__module__,
-                    'class': type(child).__name__,
-                    'kwargs': child._init_args
-                })
-
+        out_dict = _spec_dict(self)
+        out_dict['children'] = list(self._children._dicts()) if self._children is not None else []
         return out_dict
 
 
@@ -205,7 +197,151 @@ class BaseSpec(ABC, IntrospectionMixin):
         return result
 
 
-def from_dict(spec_dict: dict) -> BaseSpec:
+class SpecSet(object):
+    """
+    Flat collection of specs, what chaining specs with ``spec_a + spec_b`` builds.
+
+    Appending is constant time, and the fields the specs specify (:attr:`.specifies` )
+    and which specs specify each field (:meth:`.by_field` ) are kept as specs are added,
+    so sets of thousands of (eg. generated) specs are cheap to build and query::
+
+        >>> specs = SpecSet(JSON(path=f'notes/{name}.json', key=name, field=name) for name in names)
+        >>> specs.by_field('weight')
+        (JSON(...),)
+
+    A :class:`.SpecSet` can be used anywhere a chain of specs is, eg. it can be parsed, and its
+    :meth:`.to_dict` can be given to :class:`.batch.Session` or :func:`.from_dict` .
+
+    Parameters
+    ----------
+    specs : iterable
+        of :class:`.BaseSpec` s to start with
+    """
+
+    def __init__(self, specs: typing.Iterable[BaseSpec] = ()):
+        self._specs = []  # type: typing.List[BaseSpec]
+        self._fields = []  # type: typing.List[str]
+        self._index = {}  # type: typing.Dict[str, typing.List[BaseSpec]]
+        self._specifies_cache = None  # type: typing.Optional[typing.Tuple[str, ...]]
+        self._dict_cache = []  # type: typing.List[dict]
+        self.extend(specs)
+
+    def append(self, spec: BaseSpec):
+        """Add a spec (but not its children, see :meth:`.extend` )"""
+        if not issubclass(type(spec), BaseSpec):
+            raise TypeError('can only add subclasses of BaseSpec')
+        self._specs.append(spec)
+        fields = spec._specifies
+        self._fields.extend(fields)
+        for field in fields:
+            self._index.setdefault(field, []).append(spec)
+        self._specifies_cache = None
+
+    def extend(self, specs: typing.Iterable[BaseSpec]):
+        """Add specs, along with the children of any that have them"""
+        for spec in specs:
+            self.append(spec)
+            for child in spec.children():
+                self.append(child)
+
+    @property
+    def specifies(self) -> typing.Tuple[str, ...]:
+        """
+        Which metadata variables are specified by the specs, in order
+
+        Returns
+        -------
+        tuple of strings
+        """
+        if self._specifies_cache is None:
+            self._specifies_cache = tuple(self._fields)
+        return self._specifies_cache
+
+    def by_field(self, field: str) -> typing.Tuple[BaseSpec, ...]:
+        """
+        Specs that specify a metadata variable, in order
+
+        Parameters
+        ----------
+        field : str
+            a name from :attr:`.specifies`
+
+        Returns
+        -------
+        tuple of specs, empty if none do
+        """
+        return tuple(self._index.get(field, ()))
+
+    def parse(self, base_path: Path, metadata: typing.Optional[dict] = None, policy: str = 'last') -> 'MergedMetadata':
+        """
+        Parse every spec and merge their metadata, see :meth:`.BaseSpec.parse`
+        """
+        from onice_conversion.spec.merge import merge
+
+        return merge(self.outputs(base_path, metadata), policy=policy)
+
+    def outputs(self, base_path: Path, metadata: typing.Optional[dict] = None) -> typing.Iterator[typing.Tuple[BaseSpec, dict]]:
+        """
+        Parse each spec separately, see :meth:`.BaseSpec.outputs`
+        """
+        if metadata is None:
+            metadata = {}
+        for spec in self._specs:
+            yield spec, spec._parse(base_path, metadata)
+
+    def children(self) -> typing.Iterator[BaseSpec]:
+        """All the specs, for symmetry with :meth:`.BaseSpec.children`"""
+        return iter(self._specs)
+
+    def to_dict(self) -> dict:
+        """
+        Get a dictionary description of the specs, of the same form as :meth:`.BaseSpec.to_dict`
+        with each spec as a child, so it can be reconstituted with :func:`.from_dict`
+
+        Returns
+        -------
+        dict
+        """
+        out_dict = _spec_dict(self)
+        out_dict['children'] = list(self._dicts())
+        return out_dict
+
+    def _dicts(self) -> typing.List[dict]:
+        """Descriptions of each spec, made once per spec"""
+        for spec in self._specs[len(self._dict_cache):]:
+            self._dict_cache.append(_spec_dict(spec))
+        return self._dict_cache
+
+    def __add__(self, other: typing.Union[BaseSpec, 'SpecSet']) -> 'SpecSet':
+        if isinstance(other, SpecSet):
+            for spec in other:
+                self.append(spec)
+        else:
+            self.extend((other,))
+        return self
+
+    __iadd__ = __add__
+
+    def __iter__(self) -> typing.Iterator[BaseSpec]:
+        return iter(self._specs)
+
+    def __len__(self) -> int:
+        return len(self._specs)
+
+    def __getitem__(self, item):
+        return self._specs[item]
+
+    def __repr__(self) -> str:
+        return f'SpecSet({len(self._specs)} specs, specifying {len(self._index)} fields)'
+
+
+def _spec_dict(spec: typing.Union[BaseSpec, SpecSet]) -> dict:
+    if isinstance(spec, SpecSet):
+        return {'module': spec.__module__, 'class': type(spec).__name__, 'kwargs': {}}
+    return {'module': spec.__module__, 'class': type(spec).__name__, 'kwargs': spec._init_args}
+
+
+def from_dict(spec_dict: dict) -> typing.Union[BaseSpec, SpecSet]:
     """
     Reconstitute a spec object from a dict created by :meth:`.BaseSpec.to_dict`
 
@@ -1,29 +1,169 @@
 """
 Specify metadata that's in a separate, external file from the standard format files
+
+Files can be gzip, bz2, or xz compressed, either given with their extension (eg. ``path='notes.json.gz'`` ),
+or found next to where the uncompressed file would be, see :mod:`.compression`
 """
 import typing
 from pathlib import Path
 from abc import abstractmethod
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from datetime import datetime
 import json
+import mmap
+import re
+import string
 import numpy as np
 from glob import glob
+import itertools
+
+import parse
 
 from scipy.io import loadmat
 from scipy.io.matlab.mio5_params import mat_struct
 import yaml
 
+from onice_conversion.compression import compressed_path, detect_compression, open_decompressed
 from onice_conversion.spec import BaseSpec
-from onice_conversion.utils import AmbiguityError
+from onice_conversion.spec.path import bounded_glob
+from onice_conversion.utils import AmbiguityError, _sizeof
+
+
+class LoadedFileCache(MutableMapping):
+    """
+    Least-recently-used cache of loaded files, optionally bounded by total size
+    and number of files.
+
+    Sizes are estimated with :func:`~.utils._sizeof` when a file is added, and the least
+    recently used files are dropped until we're back under the bounds. A file that's bigger
+    than ``max_bytes`` on its own isn't cached at all.
+
+    Bounds can be changed whenever, eg. :class:`.NWBConverter` sets :attr:`.max_bytes`
+    from its memory budget.
+
+    Files that aren't in the cache are loaded through :attr:`.shared` if it's set, a
+    :class:`.spec.shared.SharedFileCache` that shares loaded files between processes
+    (see :meth:`.load_shared` ). Their arrays live in shared memory rather than ours, so they
+    count as 0 bytes here, and when they're dropped we :meth:`~.SharedFileCache.release` them.
+    """
+
+    def __init__(self, max_bytes:typing.Optional[int]=None, max_items:typing.Optional[int]=None):
+        self._files = OrderedDict() # type: OrderedDict[Path, typing.Any]
+        self._sizes = {} # type: typing.Dict[Path, int]
+        # cache key: key in the shared cache, for files that came from it
+        self._shared_keys = {} # type: typing.Dict[Path, str]
+        self._max_bytes = max_bytes
+        self.max_items = max_items
+        self.shared = None # type: typing.Optional['SharedFileCache']
+
+    @property
+    def max_bytes(self) -> typing.Optional[int]:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes: typing.Optional[int]):
+        self._max_bytes = max_bytes
+        self._evict()
+
+    @property
+    def total_bytes(self) -> int:
+        """Estimated size of everything in the cache"""
+        return sum(self._sizes.values())
+
+    def _evict(self):
+        while len(self._files) > 0 and (
+                (self.max_bytes is not None and self.total_bytes > self.max_bytes) or
+                (self.max_items is not None and len(self._files) > self.max_items)):
+            self._drop(next(iter(self._files)))
+
+    def _drop(self, path:Path):
+        del self._files[path]
+        del self._sizes[path]
+        shared_key = self._shared_keys.pop(path, None)
+        if shared_key is not None and self.shared is not None and shared_key in self.shared.attached:
+            self.shared.release(shared_key)
+
+    def load_shared(self, path:Path, file_path:Path, load:typing.Callable[[Path], typing.Any]) -> typing.Any:
+        """
+        Get a file from :attr:`.shared` (loading and publishing it if no process has yet) and cache it
+
+        Args:
+            path: the cache key
+            file_path (:class:`pathlib.Path`): the file
+            load (callable): loads the file, eg. :meth:`.BaseExternalFileSpec._load_file`
+
+        Returns:
+            the loaded file, with large arrays as read-only views of shared memory
+        """
+        from onice_conversion.spec.shared import _shared_key
+
+        loaded_file = self.shared.get(path, file_path, load)
+        shared_key = _shared_key(path, file_path)
+        if shared_key in self.shared.attached:
+            self._put(path, loaded_file, 0, shared_key)
+        else:
+            # the shared cache gave up waiting and loaded it privately
+            self[path] = loaded_file
+        return loaded_file
+
+    def __getitem__(self, path:Path) -> typing.Any:
+        loaded_file = self._files[path]
+        self._files.move_to_end(path)
+        return loaded_file
+
+    def __setitem__(self, path:Path, loaded_file:typing.Any):
+        self._put(path, loaded_file, _sizeof(loaded_file))
+
+    def _put(self, path:Path, loaded_file:typing.Any, size:int, shared_key:typing.Optional[str]=None):
+        if path in self._files and self._shared_keys.get(path) != shared_key:
+            self._drop(path)
+        if self.max_bytes is not None and size > self.max_bytes:
+            self._files.pop(path, None)
+            self._sizes.pop(path, None)
+            return
+        self._files[path] = loaded_file
+        self._files.move_to_end(path)
+        self._sizes[path] = size
+        if shared_key is not None:
+            self._shared_keys[path] = shared_key
+        self._evict()
+
+    def __delitem__(self, path:Path):
+        self._drop(path)
+
+    def __contains__(self, path) -> bool:
+        return path in self._files
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self) -> int:
+        return len(self._files)
 
 
 class BaseExternalFileSpec(BaseSpec):
+    """
+    Metadata from a file, loaded once and cached in :attr:`.loaded_files` for every spec that needs it.
+
+    .. note::
 
-    loaded_files = {}
+        Loaded files are shared, not copied: between specs through :attr:`.loaded_files` , and, when
+        it has a :class:`.spec.shared.SharedFileCache` , between processes, where large arrays are
+        read-only views of shared memory. Treat whatever a spec returns as read-only -- copy it
+        before modifying it -- and don't hold on to arrays from shared files after the conversion,
+        since they're released when they're dropped from the cache.
+    """
+
+    loaded_files = LoadedFileCache()
 
     def __init__(self, path:Path,
-                 key: str,
-                 field:typing.Union[str, typing.Tuple[str, ...]],
+                 key: typing.Optional[str] = None,
+                 field: typing.Optional[typing.Union[str, typing.Tuple[str, ...]]] = None,
                  cache:bool = True,
+                 fields: typing.Optional[typing.Dict[str, typing.Union[str, typing.Tuple[str, ...]]]] = None,
+                 max_depth: typing.Optional[int] = None,
+                 exclude: typing.Optional[typing.List[str]] = None,
                  *args, **kwargs):
         """
 
@@ -31,11 +171,31 @@ class BaseExternalFileSpec(BaseSpec):
         ----------
         self :
         path : path relative to base_dir that is passed in :meth:`._parse`
-        key :
-        field :
+        key : name of the metadata variable
+        field : field (or tuple of fields, to select successively) within the loaded file
         cache : bool
-            if True, store loaded file in :attr:`.loaded_files` dictionary to prevent
-            re-load if another spec needs it.
+            if True, store loaded file in :attr:`.loaded_files` (a :class:`.LoadedFileCache`)
+            to prevent re-load if another spec needs it.
+        fields : dict
+            instead of ``key`` and ``field`` , get many variables from the file at once with
+            ``{key: field}`` . Keys can be nested like ``'Subject[subject_id]'`` , as in :class:`.spec.Path` .
+            The file is found, loaded, and walked once, and fields that share a prefix, eg.
+            ``('sessionInfo', 'animal', 'weight')`` and ``('sessionInfo', 'animal', 'sex')`` ,
+            only select the prefix once::
+
+                Mat(path='notebook.mat', fields={
+                    'Subject[weight]': ('sessionInfo', 'animal', 'weight'),
+                    'Subject[sex]': ('sessionInfo', 'animal', 'sex'),
+                    'NWBFile[session_description]': ('sessionInfo', 'description')
+                })
+
+        max_depth : int
+            if ``path`` is a glob, only match files at most this many directories deep
+            (counting the file itself), eg. ``'**/notebook.mat'`` with ``max_depth=2`` finds
+            ``notebook.mat`` and ``notes/notebook.mat`` but not ``raw/notes/notebook.mat``
+        exclude : list
+            if ``path`` is a glob, glob patterns of file and directory names to skip, eg.
+            ``['*.continuous']`` . Excluded directories aren't searched.
         kwargs :
 
         Returns
@@ -44,11 +204,22 @@ class BaseExternalFileSpec(BaseSpec):
         """
         super(BaseExternalFileSpec, self).__init__(*args, **kwargs)
 
+        if fields is None:
+            if key is None or field is None:
+                raise ValueError('Need either a key and a field, or a dict of fields')
+            fields = {key: field}
+        elif key is not None or field is not None:
+            raise ValueError('Give either a key and a field, or a dict of fields, not both')
+
         self._loaded_file = None
         self.path = Path(path)
         self.key = key
         self.field = field
+        self.fields = fields
         self.cache = cache
+        self.max_depth = max_depth
+        self.exclude = exclude
+        self._trie = _FieldTrie(fields)
 
     @abstractmethod
     def _load_file(self, path:Path) -> dict:
@@ -72,12 +243,20 @@ class BaseExternalFileSpec(BaseSpec):
         pass
 
     @property
-    def _specifies(self):
-        return tuple(self.key)
+    def _specifies(self) -> typing.Tuple[str, ...]:
+        return tuple(self.fields)
+
+    def _cache_key(self, file_path:Path) -> typing.Hashable:
+        """
+        Key for :attr:`.loaded_files` . Just the path, unless what's loaded
+        depends on more than the file (eg. the patterns of a :class:`.Text` )
+        """
+        return file_path
 
-    def _sub_select(self, loaded_file:dict) -> typing.Any:
+    def _sub_select(self, loaded_file:dict) -> dict:
         """
-        Use :attr:`.field` to select from the loaded_file
+        Use :attr:`.fields` to select from the loaded_file, walking each shared prefix
+        of the fields once
 
         Parameters
         ----------
@@ -85,59 +264,83 @@ class BaseExternalFileSpec(BaseSpec):
 
         Returns
         -------
-
+        dict of ``{key: value}``
+        """
+        # to avoid copying what could potentially be a large dict,
+        # but also avoid modifying the cached one, just index our way down
+        selected = {}
+        stack = [(loaded_file, self._trie)]
+        while stack:
+            sub_select, node = stack.pop()
+            for key in node.keys:
+                selected[key] = self._finish(sub_select)
+            for item, child in node.children.items():
+                stack.append((_select_item(sub_select, item), child))
+
+        return {key: selected[key] for key in self.fields}
+
+    def _finish(self, sub_select:typing.Any) -> typing.Any:
+        """
+        Hook to process each value selected by :meth:`._sub_select`
         """
-        # slice the loaded file to get the value of interest
-        sub_select = {}
-        if isinstance(self.field, (tuple, list)):
-            # to avoid copying what could potentially be a large dict,
-            # but also avoid modifying the cached one, do this sorta awkward shit
-            for i, item in enumerate(self.field):
-                if i == 0:
-                    try:
-                        sub_select = loaded_file[item]
-                    except (KeyError, IndexError):
-                        sub_select = getattr(loaded_file, item)
-                else:
-                    try:
-                        sub_select = sub_select[item]
-                    except (KeyError, IndexError):
-                        sub_select = getattr(sub_select, item)
-        else:
-            # if we just got a string or an int or something give it a shot
-            try:
-                sub_select = loaded_file[self.field]
-            except (KeyError, IndexError):
-                sub_select = getattr(loaded_file, self.field)
-
         return sub_select
 
     def _parse(self, base_path:Path, metadata:typing.Optional[dict]=None) -> dict:
         # get abs path
         base_path = Path(base_path).absolute()
         if '*' in str(self.path):
-            # glob it bby!
-            paths = list(base_path.glob(str(self.path)))
+            # glob it bby! only as far as it takes to find a second match
+            paths = list(itertools.islice(
+                bounded_glob(base_path, str(self.path), max_depth=self.max_depth, exclude=self.exclude), 2))
 
             if len(paths) == 1:
                 file_path = paths[0]
-            elif isinstance(paths, Path):
-                file_path = paths
+            elif len(paths) == 0:
+                raise FileNotFoundError(f'No file matched the glob string {self.path} in {base_path}')
             else:
-                raise AmbiguityError(f'Got multiple paths that matched your glob string: {paths}')
+                raise AmbiguityError(f'Got multiple paths that matched your glob string {self.path}, eg: {paths}')
         else:
-            file_path = (base_path / self.path).absolute()
+            # or a compressed copy of it, eg. notes.json.gz
+            file_path = compressed_path((base_path / self.path).absolute())
 
         # if cache is on, try to retrieve from cache
-        if self.cache and file_path in self.loaded_files.keys():
-            loaded_file = self.loaded_files[file_path]
+        cache_key = self._cache_key(file_path)
+        if self.cache and cache_key in self.loaded_files:
+            loaded_file = self.loaded_files[cache_key]
         else:
-            # otherwise load file
-            loaded_file = self._load_file(file_path)
-            if self.cache:
-                self.loaded_files[file_path] = loaded_file
-
-        return {self.key:self._sub_select(loaded_file)}
+            # otherwise load file, or get it from another process that has
+            if self.cache and self.loaded_files.shared is not None:
+                loaded_file = self.loaded_files.load_shared(cache_key, file_path, self._load_file)
+            else:
+                loaded_file = self._load_file(file_path)
+                if self.cache:
+                    self.loaded_files[cache_key] = loaded_file
+
+        return self._expand_named_fields(self._sub_select(loaded_file))
+
+
+class _FieldTrie(object):
+    """
+    The fields of a spec merged into a tree, so fields with a common prefix share its nodes
+    """
+
+    def __init__(self, fields:typing.Optional[dict]=None):
+        self.children = {} # type: typing.Dict[typing.Hashable, _FieldTrie]
+        self.keys = [] # type: typing.List[str]
+        if fields is not None:
+            for key, field in fields.items():
+                node = self
+                for item in (tuple(field) if isinstance(field, (tuple, list)) else (field,)):
+                    node = node.children.setdefault(item, _FieldTrie())
+                node.keys.append(key)
+
+def _select_item(sub_select:typing.Any, item:typing.Hashable) -> typing.Any:
+    # if we just got a string or an int or something give it a shot,
+    # then try it as an attribute (eg. of a matlab struct)
+    try:
+        return sub_select[item]
+    except (KeyError, IndexError, TypeError):
+        return getattr(sub_select, item)
 
 class JSON(BaseExternalFileSpec):
 
@@ -157,7 +360,7 @@ class JSON(BaseExternalFileSpec):
         super(JSON, self).__init__(*args, **kwargs)
 
     def _load_file(self, path:Path) -> dict:
-        with open(path, 'r') as p:
+        with open_decompressed(path, 'r') as p:
             loaded = json.load(p, object_hook=self.hook)
         return loaded
 
@@ -175,22 +378,20 @@ class Mat(BaseExternalFileSpec):
         super(Mat, self).__init__(*args, **kwargs)
         self.simplified = simplified
 
-    def _sub_select(self, loaded_file:dict) -> typing.Any:
+    def _finish(self, sub_select:typing.Any) -> typing.Any:
         """
-        Calls :meth:`.BaseExternalFileSpec._sub_select`, but then
-        unstacks all `len == 1` numpy arrays so that the
-        `field` arg can be like `('sessionInfo', 'session')`
+        Unstack all `len == 1` numpy arrays selected by :meth:`.BaseExternalFileSpec._sub_select`
+        so that the `field` arg can be like `('sessionInfo', 'session')`
         rather than `('sessionInfo', 'session', 0, 0, 0, 0, 0, 0)`
 
         Parameters
         ----------
-        loaded_file :
+        sub_select :
 
         Returns
         -------
 
         """
-        sub_select = super(Mat, self)._sub_select(loaded_file)
         while isinstance(sub_select, np.ndarray) and np.max(sub_select.shape) == 1:
             sub_select = sub_select[0]
 
@@ -198,14 +399,16 @@ class Mat(BaseExternalFileSpec):
 
     def _load_file(self, path:Path) -> dict:
         if self.simplified:
-            return load_clean_mat(str(path))
+            with open_decompressed(path, 'rb') as f:
+                return load_clean_mat(f)
         else:
-            return loadmat(file_name=str(path))
+            with open_decompressed(path, 'rb') as f:
+                return loadmat(f)
 
 
 class YAML(BaseExternalFileSpec):
     def _load_file(self, path:Path) -> dict:
-        with open(path, 'r') as yfile:
+        with open_decompressed(path, 'r') as yfile:
             return yaml.load(yfile)
 
 
@@ -215,7 +418,7 @@ class YAML(BaseExternalFileSpec):
 # from https://stackoverflow.com/a/29126361/13113166
 # --------------------------------------------------
 
-def load_clean_mat(filename:str) -> dict:
+def load_clean_mat(filename:typing.Union[str, typing.BinaryIO]) -> dict:
     '''
     Load a matlab `.mat` file as python lists, dictionaries, and
     numpy arrays rather than the sort-of hard to work with numpy record arrays.
@@ -223,7 +426,7 @@ def load_clean_mat(filename:str) -> dict:
     Credit to https://stackoverflow.com/a/29126361/13113166
 
     Args:
-        filename (str): filename of .mat to load
+        filename (str): filename of .mat to load, or an open file
 
     Returns:
         dict
@@ -276,4 +479,278 @@ def load_clean_mat(filename:str) -> dict:
                 elem_list.append(sub_elem)
         return elem_list
     data = loadmat(filename, struct_as_record=False, squeeze_me=True)
-    return _check_keys(data)
\ No newline at end of file
+    return _check_keys(data)
+
+
+DATETIME_FORMATS = (
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d, %H:%M:%S',
+    '%Y-%m-%d: %H-%M-%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d_%H-%M-%S',
+    '%Y%m%d_%H%M%S',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %I:%M:%S %p',
+    '%d.%m.%Y %H:%M:%S',
+    '%b %d %Y %H:%M:%S',
+    '%a %b %d %H:%M:%S %Y',
+    '%Y-%m-%d',
+    '%m/%d/%Y',
+)
+"""
+Formats tried (after ISO 8601) when inferring the format of a datetime in :class:`.Text`
+"""
+
+MMAP_THRESHOLD = 2**20
+"""
+Files at least this big (in bytes) are memory-mapped by :class:`.Text` rather than read
+"""
+
+TEXT_BLOCK = 2**23
+"""
+Bytes of a file that :class:`.Text` decodes and searches at a time
+"""
+
+
+class Text(BaseExternalFileSpec):
+
+    _datetime_formats = {} # type: typing.Dict[str, str]
+    """
+    The format that last worked for each datetime field, tried first next time
+    """
+
+    def __init__(self,
+                 patterns:typing.Dict[str, typing.Union[str, typing.Pattern]],
+                 datetimes:typing.Optional[typing.Iterable[str]]=None,
+                 encoding:str='utf-8',
+                 *args, **kwargs):
+        r"""
+        Scan a text file (eg. a ``notes.txt`` ) line by line for values that match patterns.
+
+        Each pattern is either a :mod:`parse` format, which has to match a whole line
+        (without its surrounding whitespace), or a compiled regular expression, which
+        can match anywhere in a line::
+
+            notes = {'Date': 'Date: {}', 'Weight': re.compile(r'weight:?\s*([\d.]+)\s*g', re.I)}
+            Text(path='notes.txt', key='session_start_time', field='Date',
+                 patterns=notes, datetimes=['Date'])
+
+        or several at once, with ``fields={'session_start_time': 'Date', 'Subject[weight]': 'Weight'}`` .
+
+        All patterns are found in the same pass over the file, which is decoded
+        :data:`.TEXT_BLOCK` bytes at a time (memory-mapped if it's at least :data:`.MMAP_THRESHOLD` ,
+        or streamed through the decompressor if it's compressed).
+        Within each block, candidate lines are found by searching the whole block at once
+        (for the longest literal text in a ``parse`` format, or the regex itself),
+        and only those lines are matched. Each pattern stops being searched for after
+        its first match, and the scan stops once all of them have matched.
+
+        The matches are cached in :attr:`.loaded_files` , so specs for other keys that use the
+        same ``patterns`` on the same file don't scan it again.
+
+        A pattern's value is its single field or group, a dict of its named fields or groups
+        if it has more than one, or the whole matching text if it has none.
+
+        Parameters
+        ----------
+        patterns : dict
+            ``{field name: pattern}`` , select from them with ``field``
+        datetimes : list
+            names of fields whose values are datetimes. Their format is inferred from
+            :data:`.DATETIME_FORMATS` , and remembered for the next file.
+        encoding : str
+            encoding of the file, undecodable bytes are replaced
+        args : passed to :class:`.BaseExternalFileSpec`
+        kwargs :
+        """
+        self.patterns = patterns
+        self.datetimes = tuple(datetimes) if datetimes is not None else tuple()
+        self.encoding = encoding
+        super(Text, self).__init__(*args, **kwargs)
+
+        self._matchers = {name: _LineMatcher(pattern) for name, pattern in patterns.items()}
+
+    def _cache_key(self, file_path:Path) -> typing.Hashable:
+        patterns = tuple((name, pattern if isinstance(pattern, str) else (pattern.pattern, pattern.flags))
+                         for name, pattern in self.patterns.items())
+        return file_path, patterns, self.datetimes
+
+    def _load_file(self, path:Path) -> '_TextMatches':
+        found = _TextMatches(path, self.patterns)
+        pending = dict(self._matchers)
+        for text in _text_blocks(path, self.encoding):
+            for name, matcher in tuple(pending.items()):
+                value = matcher.first(text)
+                if value is not None:
+                    found[name] = value
+                    del pending[name]
+            if len(pending) == 0:
+                break
+
+        for name in self.datetimes:
+            if name in found:
+                found[name] = self._to_datetime(name, found[name])
+        return found
+
+    @classmethod
+    def _to_datetime(cls, name:str, value:str) -> datetime:
+        value = value.strip()
+        last_format = cls._datetime_formats.get(name)
+        if last_format is not None:
+            try:
+                return datetime.strptime(value, last_format)
+            except ValueError:
+                pass
+
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+
+        for datetime_format in DATETIME_FORMATS:
+            try:
+                parsed = datetime.strptime(value, datetime_format)
+            except ValueError:
+                continue
+            cls._datetime_formats[name] = datetime_format
+            return parsed
+        raise ValueError(f'Could not infer the datetime format of {name}: {value}, add it to DATETIME_FORMATS')
+
+
+class _TextMatches(dict):
+    """
+    The values that :class:`.Text` found in a file, by pattern name.
+    Selecting a pattern that didn't match any line raises a ``ValueError`` saying which
+    """
+
+    def __init__(self, path:Path, patterns:dict):
+        super(_TextMatches, self).__init__()
+        self.path = path
+        self.patterns = patterns
+
+    def __missing__(self, name):
+        if name not in self.patterns:
+            raise KeyError(name)
+        pattern = self.patterns[name]
+        pattern = pattern.pattern if isinstance(pattern, re.Pattern) else pattern
+        raise ValueError(f'No line of {self.path} matched the pattern for {name}: {pattern!r}')
+
+
+def _text_blocks(path:Path, encoding:str) -> typing.Iterator[str]:
+    """
+    Decoded blocks of about :data:`.TEXT_BLOCK` bytes of a file, each ending at the end of a line
+    """
+    if detect_compression(path) is not None:
+        # stream it through the decompressor a block at a time instead
+        with open_decompressed(path, 'rb') as f:
+            rest = b''
+            while True:
+                block = f.read(TEXT_BLOCK)
+                if not block:
+                    break
+                block = rest + block
+                end = block.rfind(b'\n') + 1
+                if end == 0:
+                    rest = block
+                    continue
+                yield _decode(block[:end], encoding)
+                rest = block[end:]
+            if rest:
+                yield _decode(rest, encoding)
+        return
+
+    with open(path, 'rb') as f:
+        if path.stat().st_size >= MMAP_THRESHOLD:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buffer = f.read()
+
+        try:
+            start = 0
+            while start < len(buffer):
+                end = buffer.find(b'\n', start + TEXT_BLOCK)
+                end = len(buffer) if end == -1 else end + 1
+                yield _decode(buffer[start:end], encoding)
+                start = end
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+
+def _decode(block:bytes, encoding:str) -> str:
+    text = block.decode(encoding, errors='replace')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n')
+    return text
+
+
+class _LineMatcher(object):
+    """
+    Find the first line in some text that matches a :class:`.Text` pattern, and get its value
+    """
+
+    def __init__(self, pattern:typing.Union[str, typing.Pattern]):
+        if isinstance(pattern, str):
+            self._parser = parse.compile(pattern)
+            # the longest literal text between fields, to find candidate lines without the parser
+            self._literal = max((literal.strip() for literal, _, _, _ in string.Formatter().parse(pattern)), key=len)
+            self._candidates = None
+        elif isinstance(pattern, re.Pattern):
+            self._regex = pattern
+            self._parser = None
+            self._candidates = re.compile(pattern.pattern, pattern.flags | re.MULTILINE)
+        else:
+            raise TypeError(f'Patterns should be parse format strings or compiled regexes, got {pattern}')
+
+    def first(self, text:str) -> typing.Any:
+        """The value of the first line in ``text`` that matches, or None"""
+        position = 0
+        while position < len(text):
+            if self._parser is not None:
+                start = text.find(self._literal, position)
+                if start == -1:
+                    return None
+            else:
+                candidate = self._candidates.search(text, position)
+                if candidate is None:
+                    return None
+                start = candidate.start()
+
+            line_start = text.rfind('\n', 0, start) + 1
+            line_end = text.find('\n', start)
+            line_end = len(text) if line_end == -1 else line_end
+            value = self.match(text[line_start:line_end])
+            if value is not None:
+                return value
+            # candidates can match across lines, or not match the whole line for parse formats
+            position = line_end + 1
+        return None
+
+    def match(self, line:str) -> typing.Any:
+        """The value of the pattern in a single line, or None"""
+        if self._parser is not None:
+            result = self._parser.parse(line.strip())
+            if result is None:
+                return None
+            if len(result.named) > 1 or (len(result.named) == 1 and len(result.fixed) > 0):
+                return dict(result.named)
+            elif len(result.named) == 1:
+                return next(iter(result.named.values()))
+            elif len(result.fixed) == 1:
+                return result.fixed[0]
+            elif len(result.fixed) > 1:
+                return result.fixed
+            return line.strip()
+
+        result = self._regex.search(line)
+        if result is None:
+            return None
+        named = result.groupdict()
+        if len(named) > 1:
+            return named
+        elif len(named) == 1:
+            return next(iter(named.values()))
+        elif len(result.groups()) >= 1:
+            return result.group(1)
+        return result.group(0)
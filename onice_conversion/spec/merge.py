@@ -0,0 +1,173 @@
+"""
+Merge the metadata parsed by many specs in one pass.
+
+Folding each spec's output into the accumulated metadata with ``dict_deep_update``
+re-walks everything merged so far, and the last spec to set a key silently wins.
+:func:`.merge` instead walks each output once (linear in the total number of keys),
+and returns a :class:`.MergedMetadata` -- a plain dict of the merged metadata that
+also records which spec set each value (:attr:`.MergedMetadata.sources` ) and every
+conflict between specs (:attr:`.MergedMetadata.conflicts` )::
+
+    >>> merged = merge([(subject_spec, {'Subject': {'subject_id': 'jonny'}}),
+    ...                 (notes_spec, {'Subject': {'subject_id': 'jony', 'age': 'P30D'}})],
+    ...                policy='first')
+    >>> merged
+    {'Subject': {'subject_id': 'jonny', 'age': 'P30D'}}
+    >>> merged.sources[('Subject', 'age')]
+    notes_spec
+    >>> merged.conflicts
+    [Conflict(path=('Subject', 'subject_id'), value='jonny', spec=subject_spec, dropped='jony', dropped_spec=notes_spec)]
+
+Specs conflict when they set the same key to unequal values, or when one sets a value
+where another set a dict. What happens then depends on the ``policy`` :
+
+* ``'last'`` (default) -- the later spec's value is kept, like ``dict_deep_update``
+* ``'first'`` -- the earlier spec's value is kept
+* ``'error'`` -- raise a :class:`~.utils.MergeConflictError`
+* ``'replace'`` -- like ``'last'`` , but lists are replaced too (see below)
+
+Like ``dict_deep_update(append_list=True)`` , two specs setting the same key to lists don't conflict:
+the later list's items that aren't already in the earlier one are appended to it, and
+:attr:`.MergedMetadata.sources` records the last spec to add to it. With ``'replace'`` , lists
+are values like any other, and the later spec's list is kept whole.
+"""
+import typing
+
+import numpy as np
+
+from onice_conversion.utils import MergeConflictError, _hash_key
+
+POLICIES = ('last', 'first', 'error', 'replace')
+
+
+class Conflict(typing.NamedTuple):
+    """Two specs that set the same metadata key to different values"""
+    path: tuple
+    value: typing.Any
+    """the value that was kept"""
+    spec: typing.Any
+    """the spec that set it"""
+    dropped: typing.Any
+    """the value that was dropped"""
+    dropped_spec: typing.Any
+    """the spec that set it"""
+
+    def __str__(self) -> str:
+        return (f"{'.'.join(str(key) for key in self.path)}: kept {self.value!r} from {self.spec!r}, "
+                f"dropped {self.dropped!r} from {self.dropped_spec!r}")
+
+
+class MergedMetadata(dict):
+    """
+    Merged metadata, see :func:`.merge`
+
+    Attributes
+    ----------
+    sources : dict
+        ``{path: spec}`` , which spec set each value, where a path is a tuple of keys
+    conflicts : list
+        :class:`.Conflict` s resolved while merging
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MergedMetadata, self).__init__(*args, **kwargs)
+        self.sources = {}  # type: typing.Dict[tuple, typing.Any]
+        self.conflicts = []  # type: typing.List[Conflict]
+
+
+def merge(outputs: typing.Iterable[typing.Tuple[typing.Any, dict]], policy: str = 'last') -> MergedMetadata:
+    """
+    Merge the outputs of specs, in order
+
+    Parameters
+    ----------
+    outputs : iterable
+        of ``(spec, parsed metadata)`` tuples. The parsed metadata isn't modified,
+        values are shared with the merged metadata rather than copied
+    policy : str
+        ``'last'`` , ``'first'`` , ``'error'`` , or ``'replace'`` , see module docs
+
+    Returns
+    -------
+    :class:`.MergedMetadata`
+
+    Raises
+    ------
+    :class:`~.utils.MergeConflictError`
+        if ``policy == 'error'`` and specs conflict
+    """
+    if policy not in POLICIES:
+        raise ValueError(f'policy must be one of {POLICIES}, got {policy}')
+    merged = MergedMetadata()
+    for spec, output in outputs:
+        _merge_into(merged, output, (), spec, merged, policy)
+    return merged
+
+
+def _merge_into(target: dict, output: dict, path: tuple, spec, merged: MergedMetadata, policy: str):
+    for key, value in output.items():
+        key_path = path + (key,)
+        if isinstance(value, dict) and (len(value) > 0 or isinstance(target.get(key), dict)):
+            if key not in target:
+                target[key] = {}
+            elif not isinstance(target[key], dict):
+                if not _resolve(merged, key_path, target[key], value, spec, policy):
+                    continue
+                merged.sources.pop(key_path, None)
+                target[key] = {}
+            _merge_into(target[key], value, key_path, spec, merged, policy)
+            continue
+
+        if key in target:
+            if _equal(target[key], value):
+                continue
+            if policy != 'replace' and isinstance(target[key], list) and isinstance(value, list):
+                # don't modify the spec's own list
+                target[key] = target[key] + _new_items(target[key], value)
+                merged.sources[key_path] = spec
+                continue
+            if not _resolve(merged, key_path, target[key], value, spec, policy):
+                continue
+            if isinstance(target[key], dict):
+                # replacing a whole dict, forget the sources of its values
+                _drop_sources(merged, target[key], key_path)
+        target[key] = value
+        merged.sources[key_path] = spec
+
+
+def _new_items(old: list, new: list) -> list:
+    """Items of ``new`` that aren't in ``old`` , in order, hashing rather than comparing every pair"""
+    seen = {_hash_key(item) for item in old}
+    return [item for item in new if _hash_key(item) not in seen]
+
+
+def _drop_sources(merged: MergedMetadata, value, path: tuple):
+    """Forget the sources of a merged value and everything in it, walking only that value"""
+    merged.sources.pop(path, None)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _drop_sources(merged, item, path + (key,))
+
+
+def _resolve(merged: MergedMetadata, path: tuple, old, new, spec, policy: str) -> bool:
+    """Record a conflict, returning whether to take the new value"""
+    old_spec = merged.sources.get(path)
+    if policy == 'error':
+        raise MergeConflictError(f"{'.'.join(str(key) for key in path)} is {old!r} from {old_spec!r}, "
+                                 f"but {new!r} from {spec!r}")
+    if policy in ('last', 'replace'):
+        merged.conflicts.append(Conflict(path, new, spec, old, old_spec))
+        return True
+    merged.conflicts.append(Conflict(path, old, old_spec, new, spec))
+    return False
+
+
+def _equal(a, b) -> bool:
+    if a is b:
+        return True
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return bool(np.array_equal(a, b))
+    try:
+        return bool(a == b)
+    except (ValueError, TypeError):
+        return False
@@ -1,9 +1,14 @@
 import typing
+import string
 import sys
 from pathlib import Path as plPath
 import glob
+import itertools
+import os
 import re
+from fnmatch import fnmatchcase
 
+import numpy as np
 import parse
 
 from onice_conversion.spec import BaseSpec
@@ -45,20 +50,25 @@ class Path(BaseSpec):
 
     @property
     def _specifies(self) -> typing.Tuple[str, ...]:
-        return tuple(self.parser.named_fields)
+        # parser.named_fields mangles nested names like Subject[subject_id], so get them from the format
+        fields = [field for _, field, _, _ in string.Formatter().parse(self.format) if field]
+        return tuple(dict.fromkeys(fields))
 
-    def _parse_dir(self, base_path:typing.Union[str, plPath]) -> list:
+    def _match_dir(self, base_path:typing.Union[str, plPath]) -> typing.List[typing.Tuple[plPath, dict]]:
         """
-        First part of :meth:`.Path._parse` , given a base directory and parser,
-        return a list of dicts of matching keys found.
+        Given a base directory, find matching paths and parse them.
+
+        Returns
+        -------
+        list of tuples of (path relative to ``base_path``, dict of parsed named fields)
         """
         # make absolute
         base_path = plPath(base_path).absolute()
         # globify format string to find all matching files
         format_glob = re.sub(r'\{.*?\}', '*', self.format)
 
-        # find matching files relative to the base_path
-        matching_files = base_path.glob(format_glob)
+        # find matching files relative to the base_path, sorted so rows come out in a stable order
+        matching_files = sorted(base_path.glob(format_glob))
 
         # parse results
         results = []
@@ -68,13 +78,20 @@ class Path(BaseSpec):
             parsed = self.parser.parse(str(match))
             # parser returns None if no matches
             if parsed is not None:
-                results.append(parsed.named)
+                results.append((match, parsed.named))
 
         if len(results) == 0:
             raise ValueError(f'No matches were found between \n(relative) format:\n{self.format}\nglob string:{format_glob}\nin\n{base_path}')
 
         return results
 
+    def _parse_dir(self, base_path:typing.Union[str, plPath]) -> list:
+        """
+        First part of :meth:`.Path._parse` , given a base directory and parser,
+        return a list of dicts of matching keys found.
+        """
+        return [named for _, named in self._match_dir(base_path)]
+
 
     def _parse(self, base_path:typing.Union[str, plPath],
                metadata:typing.Optional[dict]=None) -> dict:
@@ -114,22 +131,375 @@ class Path(BaseSpec):
 class Paths(Path):
     """
     Like :class:`.spec.Path` but allows multiple values for a single key
+
+    :meth:`.Paths._parse` returns every unique value for each key, which loses track of which
+    values came from the same file -- to keep them together, use :meth:`.Paths.table` to get
+    one row per matched path instead.
     """
 
-    def _parse(self, base_path: typing.Union[str, plPath]) -> dict:
+    def _parse(self, base_path: typing.Union[str, plPath],
+               metadata:typing.Optional[dict]=None) -> dict:
         results = self._parse_dir(base_path)
 
-        gathered = _gather_list_of_dicts(a_list)
-        return _recursive_dedupe_dicts(results, raise_on_dupes=False)
+        gathered = _gather_list_of_dicts(results)
+        return _recursive_dedupe_dicts(gathered, raise_on_dupes=False)
+
+    def table(self, base_path: typing.Union[str, plPath],
+              as_dataframe: bool = True) -> typing.Union['pandas.DataFrame', np.ndarray]:
+        """
+        Get every match as a table with one row per matched path, a column for each
+        named field (named as they are in :attr:`.format` , eg. ``'Subject[subject_id]'`` ),
+        and a ``'path'`` column with the path relative to ``base_path`` .
+
+        eg. for ``Paths('{subject_id}/{session_id}/trial_{trial:d}.mat')`` ::
+
+            >>> Paths('{subject_id}/{session_id}/trial_{trial:d}.mat').table(base_dir)
+               subject_id  session_id  trial                     path
+            0       jonny         001      1   jonny/001/trial_1.mat
+            1       jonny         001      2   jonny/001/trial_2.mat
+            ...
+
+        Parameters
+        ----------
+        base_path : :class:`pathlib.Path`
+            Directory to search
+        as_dataframe : bool
+            If True (default) return a :class:`pandas.DataFrame` ,
+            otherwise return a numpy structured array
+
+        Returns
+        -------
+        :class:`pandas.DataFrame` or structured :class:`numpy.ndarray`
+        """
+        matches = self._match_dir(base_path)
+        fields = self._specifies
+        if 'path' in fields:
+            raise ValueError("Can't make a table from a format with a field named 'path', that's the column for the matched path!")
+
+        columns = {field: [_get_named_field(named, field) for _, named in matches] for field in fields}
+        columns['path'] = [str(path) for path, _ in matches]
+
+        if as_dataframe:
+            import pandas as pd
+            return pd.DataFrame(columns)
+
+        arrays = {name: np.asarray(column) for name, column in columns.items()}
+        table = np.empty(len(matches), dtype=[(name, array.dtype) for name, array in arrays.items()])
+        for name, array in arrays.items():
+            table[name] = array
+        return table
+
+def _get_named_field(named:dict, field:str) -> typing.Any:
+    """
+    Get a value from a (possibly nested) dict of parse results by its field name,
+    eg. ``'Subject[subject_id]'`` -> ``named['Subject']['subject_id']``
+    """
+    basename, subkeys = re.match(r'([^\[]+)(.*)', field).groups()
+    value = named[basename]
+    for subkey in re.findall(r'\[[^\]]+\]', subkeys):
+        value = value[subkey[1:-1]]
+    return value
+
+class GlobTemplate(object):
+    """
+    A :class:`.Glob` format compiled once, so that a directory can be indexed in a single pass
+    by the values of its ``{fields}`` and then looked up for any metadata.
+
+    eg. for ``'parentdir_{subject_id}/some_file_*_{session_id:03d}.bin'`` , :meth:`.index` globs
+    ``'parentdir_*/some_file_*_*.bin'`` and parses each match to build a dict like::
+
+        {('jonny', '001'): ['/base/parentdir_jonny/some_file_1234_001.bin'], ...}
+
+    and :meth:`.key` formats metadata values the same way ``str.format`` would (respecting
+    format specs and conversions like ``:03d`` and ``!s`` ) so they can be looked up in the index.
+
+    A path can be split between the fields in more than one way when field values could
+    contain the text around them, eg. ``a_b_c.bin`` for ``'{subject_id}_{session_id}.bin'`` .
+    It's indexed under every split, so it's found for whichever metadata would have globbed it.
+
+    Args:
+        format (str): the :attr:`.Glob.format` string
+    """
+
+    def __init__(self, format:str):
+        self.format = format
+        self.fields = [] # type: typing.List[str]
+        self._field_formats = {} # type: typing.Dict[str, typing.List[typing.Tuple[str, typing.Optional[str]]]]
+        # each path component as a list of parts that are either
+        # (compiled regex of a literal, None) or (None, regex group of a field)
+        self._components = [[]] # type: typing.List[typing.List[typing.Tuple[typing.Optional[typing.Pattern], typing.Optional[str]]]]
+
+        glob_parts = []
+        regex_parts = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(format):
+            glob_parts.append(literal)
+            regex_parts.append(_glob_to_regex(literal))
+            for i, piece in enumerate(literal.split('/')):
+                if i > 0:
+                    self._components.append([])
+                if piece:
+                    self._components[-1].append((re.compile(_glob_to_regex(piece)), None))
+            if field is None:
+                continue
+            if field == '':
+                raise ValueError('format string must use named fields, not anonymous fields like {}')
+
+            glob_parts.append('*')
+            formats = self._field_formats.setdefault(field, [])
+            if field not in self.fields:
+                self.fields.append(field)
+            if (format_spec, conversion) in formats:
+                # same field formatted the same way again, must match the same text
+                regex_parts.append(f'(?P={self._group(field, format_spec, conversion)})')
+            else:
+                formats.append((format_spec, conversion))
+                regex_parts.append(f'(?P<{self._group(field, format_spec, conversion)}>[^/]*)')
+            self._components[-1].append((None, self._group(field, format_spec, conversion)))
+
+        self.glob = ''.join(glob_parts)
+        self.regex = re.compile(''.join(regex_parts))
+        self._groups = [self._group(field, *field_format)
+                        for field in self.fields
+                        for field_format in self._field_formats[field]]
+
+    def _group(self, field:str, format_spec:str, conversion:typing.Optional[str]) -> str:
+        # one regex group per distinct way a field is formatted
+        return f'g{self.fields.index(field)}_{self._field_formats[field].index((format_spec, conversion))}'
+
+    def key(self, metadata:dict) -> tuple:
+        """
+        Format each field's value from ``metadata`` as it would appear in a path
+
+        Raises:
+            ``KeyError`` if a field isn't in ``metadata``
+        """
+        formatter = string.Formatter()
+        key = []
+        for field in self.fields:
+            value, _ = formatter.get_field(field, (), metadata)
+            for format_spec, conversion in self._field_formats[field]:
+                key.append(formatter.format_field(formatter.convert_field(value, conversion), format_spec))
+        return tuple(key)
+
+    def keys(self, path:str) -> typing.Set[tuple]:
+        """
+        Every key (see :meth:`.key` ) that a path relative to the indexed directory could have been formatted from,
+        empty if it doesn't match the template
+        """
+        if self.regex.fullmatch(path) is None:
+            return set()
+        components = path.split('/')
+        if len(components) != len(self._components):
+            return set()
+
+        splits = [{}] # type: typing.List[typing.Dict[str, str]]
+        for parts, component in zip(self._components, components):
+            splits = [split for previous in splits for split in _splits(parts, component, 0, previous)]
+        return {tuple(split[group] for group in self._groups) for split in splits}
+
+    def index(self, base_path:plPath, only_dirs:bool=False) -> typing.Dict[tuple, typing.List[str]]:
+        """
+        Glob once for every path matching the template beneath ``base_path`` and
+        group them by the values of their fields.
+
+        Args:
+            base_path (:class:`pathlib.Path`): absolute directory to index
+            only_dirs (bool): only index directories
+
+        Returns:
+            dict of ``{(field values...): [matching paths...]}`` , in the same order as :meth:`.key`
+        """
+        base_str = str(base_path).rstrip('/') + '/'
+        index = {}
+        for path in glob.glob(base_str + self.glob):
+            if only_dirs and not plPath(path).is_dir():
+                continue
+            for key in self.keys(path[len(base_str):]):
+                index.setdefault(key, []).append(path)
+        return index
+
+    def directories(self, base_path:plPath) -> typing.List[str]:
+        """
+        The directories that :meth:`.index` globs through: ``base_path`` and every directory
+        matching the template's leading path components. Paths can only be added to or removed
+        from the index by changing one of them.
+        """
+        base_str = str(base_path).rstrip('/') + '/'
+        components = self.glob.split('/')
+        directories = [str(base_path)]
+        for depth in range(1, len(components)):
+            directories.extend(path for path in glob.glob(base_str + '/'.join(components[:depth]))
+                               if os.path.isdir(path))
+        return directories
+
+def _splits(parts:list, text:str, position:int, values:typing.Dict[str, str]) -> typing.Iterator[typing.Dict[str, str]]:
+    """
+    Every way the ``parts`` of a :class:`.GlobTemplate` component can match ``text[position:]`` ,
+    as dicts of regex group: value, consistent with the ``values`` already matched
+    """
+    if len(parts) == 0:
+        if position == len(text):
+            yield values
+        return
+
+    (literal, group), rest = parts[0], parts[1:]
+    for end in range(position, len(text) + 1):
+        if literal is not None:
+            if literal.fullmatch(text, position, end) is not None:
+                yield from _splits(rest, text, end, values)
+        elif group in values:
+            # a field that appears more than once has to match the same text each time
+            if text[position:end] == values[group]:
+                yield from _splits(rest, text, end, values)
+        else:
+            yield from _splits(rest, text, end, {**values, group: text[position:end]})
+
+def _glob_to_regex(pattern:str) -> str:
+    """
+    Translate the wildcards in a (non-recursive) glob pattern to a regex
+    that matches within a single path component like :func:`glob.glob` does
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[':
+            # a ']' right after the '[' or '[!' is part of the set, not the end of it
+            start = i + 2 if pattern[i+1:i+2] == '!' else i + 1
+            end = pattern.find(']', start + 1)
+            if end == -1:
+                regex.append(re.escape(char))
+            else:
+                contents = pattern[i+1:end]
+                if contents.startswith('!'):
+                    contents = '^' + contents[1:]
+                regex.append('[' + contents.replace('\\', '\\\\') + ']')
+                i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return ''.join(regex)
+
+def bounded_glob(base_path:typing.Union[str, plPath],
+                 pattern:str,
+                 max_depth:typing.Optional[int]=None,
+                 exclude:typing.Optional[typing.Iterable[str]]=None) -> typing.Iterator[plPath]:
+    """
+    Lazily glob for paths within a directory, like :meth:`pathlib.Path.glob` , but without
+    walking more of the tree than needed, eg. to check if a pattern matches exactly one file
+    without enumerating a whole recording directory::
+
+        paths = list(itertools.islice(bounded_glob(base_dir, '**/notebook.mat', max_depth=3,
+                                                   exclude=['*.continuous']), 2))
+
+    Paths are yielded as they're found (in no particular order). ``**`` matches any number
+    of directories, but doesn't follow symlinks to directories.
+
+    Args:
+        base_path (str, :class:`pathlib.Path`): directory to glob within
+        pattern (str): glob pattern, relative to ``base_path``
+        max_depth (int): only match paths at most this many components below ``base_path`` ,
+            eg. ``1`` for its immediate contents
+        exclude (list): glob patterns of names of files and directories to skip,
+            excluded directories aren't descended into
+
+    Returns:
+        iterator of matching :class:`pathlib.Path` s
+    """
+    parts = [part for part in plPath(pattern).parts]
+    matchers = [None if part == '**' else
+                re.compile(_glob_to_regex(part)) if glob.has_magic(part) else part
+                for part in parts]
+    exclude = tuple(exclude) if exclude is not None else ()
+    max_depth = max_depth if max_depth is not None else float('inf')
+
+    def excluded(name:str) -> bool:
+        return any(fnmatchcase(name, excluded_pattern) for excluded_pattern in exclude)
+
+    # fewest path components the parts from each one on can match ('**' can match none)
+    least = [0] * (len(matchers) + 1)
+    for i in reversed(range(len(matchers))):
+        least[i] = least[i + 1] + (matchers[i] is not None)
+
+    def walk(directory:str, depth:int, i:int) -> typing.Iterator[str]:
+        matcher = matchers[i]
+        last = i == len(matchers) - 1
+        if matcher is None:
+            # '**', match no directories, then one more
+            if last:
+                yield directory
+            else:
+                yield from walk(directory, depth, i + 1)
+            if depth + 1 + least[i + 1] > max_depth:
+                return
+            for entry in _scandir(directory):
+                if entry.is_dir(follow_symlinks=False) and not excluded(entry.name):
+                    yield from walk(entry.path, depth + 1, i)
+        elif isinstance(matcher, str):
+            path = os.path.join(directory, matcher)
+            if excluded(matcher) or depth + least[i] > max_depth:
+                return
+            if last:
+                if os.path.lexists(path):
+                    yield path
+            elif os.path.isdir(path):
+                yield from walk(path, depth + 1, i + 1)
+        else:
+            if depth + least[i] > max_depth:
+                return
+            for entry in _scandir(directory):
+                if not matcher.fullmatch(entry.name) or excluded(entry.name):
+                    continue
+                if last:
+                    yield entry.path
+                elif entry.is_dir():
+                    yield from walk(entry.path, depth + 1, i + 1)
+
+    if len(matchers) == 0:
+        return
+    seen = set()
+    for path in walk(str(base_path), 0, 0):
+        # overlapping '**'s can find a path more than once
+        if path not in seen:
+            seen.add(path)
+            yield plPath(path)
+
+def _scandir(directory:str) -> typing.Iterator[os.DirEntry]:
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+    with entries:
+        yield from entries
+
+
+def _mtimes(directories:typing.Iterable[str]) -> typing.Dict[str, typing.Optional[int]]:
+    mtimes = {}
+    for directory in directories:
+        try:
+            mtimes[directory] = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtimes[directory] = None
+    return mtimes
+
 
 class Glob(BaseSpec):
     """
     Sort of the opposite of :class:`.Path` -- specify some path given some metadata values
 
     Replaces any named format variables in `{brackets}`, and then globs any `'*'`s
+
+    When the same Glob is evaluated for many sessions in the same directory, use ``indexed=True`` --
+    the format is compiled into a :class:`.GlobTemplate` and the directory is globbed once,
+    and then each :meth:`.Glob._parse` is a dict lookup, after checking that the directories
+    it was built from haven't changed (see :meth:`.Glob.index` ).
     """
 
-    def __init__(self, key:str,format:str, only_dirs:bool=False, *args, **kwargs):
+    def __init__(self, key:str,format:str, only_dirs:bool=False, indexed:bool=False, *args, **kwargs):
         """
         Args:
             key (str): The key that will define what's returned from Parse
@@ -140,6 +510,8 @@ class Glob(BaseSpec):
                 Can also use previously defined metadata, eg to replace some part of the file with ``subject_id``, use
                 ``"parentdir_{subject_id}/"`` etc.
             only_dirs (bool): Only match directories, not files (default: False)
+            indexed (bool): Index the base directory once by the values of the format's fields,
+                and look up paths in the index rather than globbing each time (default: False)
             *args ():
             **kwargs ():
         """
@@ -147,11 +519,45 @@ class Glob(BaseSpec):
         self.only_dirs = only_dirs
         self.key = key
         self.format = str(format)
+        self.indexed = indexed
+
+        self._template = None # type: typing.Optional[GlobTemplate]
+        # base path: (mtimes of the directories indexed, index)
+        self._indices = {} # type: typing.Dict[plPath, typing.Tuple[typing.Dict[str, typing.Optional[int]], typing.Dict[tuple, typing.List[str]]]]
 
     @property
     def _specifies(self) -> typing.Tuple[str, ...]:
         return (self.key,)
 
+    @property
+    def template(self) -> GlobTemplate:
+        """The format compiled into a :class:`.GlobTemplate`"""
+        if self._template is None:
+            self._template = GlobTemplate(self.format)
+        return self._template
+
+    def index(self, base_path:typing.Union[str, plPath], refresh:bool=False) -> typing.Dict[tuple, typing.List[str]]:
+        """
+        Get (building if needed) the index of paths beneath ``base_path`` , see :meth:`.GlobTemplate.index`
+
+        The index is rebuilt if the mtime of any of the directories it was built from
+        (see :meth:`.GlobTemplate.directories` ) has changed since, ie. if entries were added,
+        removed, or renamed in them.
+
+        Args:
+            base_path (:class:`pathlib.Path`): directory to index
+            refresh (bool): re-index even if we already have an up to date one for this directory
+        """
+        base_path = plPath(base_path).absolute()
+        if not refresh and base_path in self._indices:
+            mtimes, index = self._indices[base_path]
+            if _mtimes(mtimes) == mtimes:
+                return index
+        mtimes = _mtimes(self.template.directories(base_path))
+        index = self.template.index(base_path, only_dirs=self.only_dirs)
+        self._indices[base_path] = (mtimes, index)
+        return index
+
     def _parse(self,
                base_path:typing.Union[str, plPath],
                metadata:typing.Optional[dict]=None) -> dict:
@@ -160,7 +566,9 @@ class Glob(BaseSpec):
         and then globbing over any `'*'`
 
         This class ensures a single path is returned, and raises an :class:`.AmbiguityError` otherwise.
-        To return multiple paths, use :class:`.Globs`
+        To return multiple paths, use :class:`.Globs` . Raises a ``FileNotFoundError`` if no paths match.
+
+        If :attr:`.indexed` , paths are looked up in :meth:`.Glob.index` rather than globbed.
 
         Parameters
         ----------
@@ -172,9 +580,14 @@ class Glob(BaseSpec):
 
         """
 
+        if metadata is None:
+            metadata = {}
+
         # replace format string
         try:
             format_str = self.format.format(**metadata)
+            if self.indexed and '*' in self.format:
+                paths = self.index(base_path).get(self.template.key(metadata), [])
         except KeyError as e:
             # reraise error with additional informative message about what else to use
             raise type(e)(
@@ -186,14 +599,17 @@ class Glob(BaseSpec):
 
         # glob us some matching files if it's got an asterisk
         if '*' in str(full_path):
-            paths = glob.glob(str(full_path))
-            if self.only_dirs:
-                paths = [path for path in paths if plPath(path).is_dir()]
+            if not (self.indexed and '*' in self.format):
+                # only need to know if there's more than one
+                paths = glob.iglob(str(full_path))
+                if self.only_dirs:
+                    paths = (path for path in paths if plPath(path).is_dir())
+                paths = list(itertools.islice(paths, 2))
 
 
             if len(paths)>1:
                 raise AmbiguityError(f'Multiple paths matched glob string: {str(full_path)},\nif this was intentional, use Globs instead!')
-            elif len(paths)<0:
+            elif len(paths)==0:
                 raise FileNotFoundError(f'No file was found matching query string {str(full_path)}')
 
             path = paths[0]
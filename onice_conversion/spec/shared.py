@@ -0,0 +1,276 @@
+"""
+A tier of :attr:`.BaseExternalFileSpec.loaded_files` shared between processes.
+
+When many sessions are converted in parallel (eg. with :func:`.batch.run_batch` ) and
+they reference the same large file -- a ``.mat`` animal notebook, a rig config -- each worker
+would otherwise load its own copy. With a :class:`.SharedFileCache` , the first worker to
+need a file loads it and publishes it: numeric arrays are copied into
+:mod:`multiprocessing.shared_memory` blocks, and everything else is pickled into a small
+skeleton that's kept in a :class:`multiprocessing.Manager` dict along with the block names.
+Other workers unpickle the skeleton with arrays that are read-only views of the shared
+blocks, so the arrays are in memory only once however many workers use them.
+
+It's opt-in, eg. ``run_batch(sessions, share_files=True)`` , or by hand::
+
+    with SharedFileCache() as shared:
+        with ProcessPoolExecutor(initializer=SharedFileCache.install, initargs=(shared,)) as executor:
+            ...
+
+Files are shared by path, size, and modification time, so a file that changes is loaded again.
+Each process holds a reference to the files it's attached to until it exits (or calls
+:meth:`.SharedFileCache.release` ), the last process to let go of a file unlinks its blocks,
+and closing the cache in the process that made it unlinks whatever's left, eg. from workers that crashed.
+"""
+import io
+import os
+import pickle
+import sys
+import time
+import typing
+from multiprocessing import Manager, util
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+import numpy as np
+
+MIN_SHARED_BYTES = 2**16
+"""Arrays smaller than this are pickled with the skeleton rather than given their own block"""
+
+POLL_INTERVAL = 0.05
+"""Seconds between checks while waiting for another process to publish a file"""
+
+
+class SharedFileCache(object):
+    """
+    Cache of loaded files shared between processes, see module docs.
+
+    Make it in the parent process, and give it to workers (it pickles to a handle on the
+    same cache) to :meth:`.install`
+
+    Args:
+        min_array_bytes (int): arrays at least this big are put in shared memory
+        wait (float): seconds to wait for another process that's loading a file before
+            giving up and loading it ourselves
+        manager (:class:`multiprocessing.managers.SyncManager`): manager to keep the index in,
+            by default one is started (and shut down by :meth:`.close` )
+    """
+
+    def __init__(self, min_array_bytes:int=MIN_SHARED_BYTES, wait:float=60, manager=None):
+        self.min_array_bytes = min_array_bytes
+        self.wait = wait
+        self._manager = manager if manager is not None else Manager()
+        self._owns_manager = manager is None
+        self._index = self._manager.dict()
+        self._lock = self._manager.Lock()
+        self._attached = {} # type: typing.Dict[str, typing.Tuple[typing.Any, typing.List[SharedMemory]]]
+        self._finalizer = None
+
+    @staticmethod
+    def install(shared:typing.Optional['SharedFileCache']):
+        """
+        Use a shared cache as the tier behind :attr:`.BaseExternalFileSpec.loaded_files`
+        in this process, eg. as the initializer of a process pool
+        """
+        from onice_conversion.spec.external_file import BaseExternalFileSpec
+        BaseExternalFileSpec.loaded_files.shared = shared
+
+    def get(self, key:typing.Hashable, path:Path, load:typing.Callable[[Path], typing.Any]) -> typing.Any:
+        """
+        Get a file, attaching to it if another process has published it, otherwise loading
+        and publishing it
+
+        Args:
+            key (hashable): the spec's cache key for the file
+            path (:class:`pathlib.Path`): the file
+            load (callable): loads the file, eg. :meth:`.BaseExternalFileSpec._load_file`
+
+        Returns:
+            the loaded file, with large arrays as read-only views of shared memory
+        """
+        shared_key = _shared_key(key, path)
+        if shared_key in self._attached:
+            return self._attached[shared_key][0]
+
+        deadline = time.monotonic() + self.wait
+        while True:
+            with self._lock:
+                entry = self._index.get(shared_key)
+                if entry is None:
+                    # our job to load it
+                    self._index[shared_key] = {'loading': os.getpid()}
+                    break
+                if 'skeleton' in entry:
+                    entry['refs'] += 1
+                    self._index[shared_key] = entry
+                    return self._attach(shared_key, entry)
+            if time.monotonic() > deadline:
+                # whoever's loading it is stuck or died, don't wait on them any longer
+                return load(path)
+            time.sleep(POLL_INTERVAL)
+
+        try:
+            loaded = load(path)
+            skeleton, blocks = self._publish(loaded)
+        except BaseException:
+            with self._lock:
+                self._index.pop(shared_key, None)
+            raise
+
+        entry = {'skeleton': skeleton, 'blocks': [block.name for block in blocks], 'refs': 1,
+                 'bytes': sum(block.size for block in blocks)}
+        with self._lock:
+            self._index[shared_key] = entry
+        for block in blocks:
+            block.close()
+        # use the shared copy, so our private one can be freed
+        return self._attach(shared_key, entry)
+
+    def release(self, key:typing.Optional[str]=None):
+        """
+        Let go of a shared file (by the key in :attr:`.attached` ), or all of them,
+        unlinking its blocks if we were the last process using it.
+
+        Arrays from it should not be used afterwards.
+        """
+        keys = list(self._attached) if key is None else [key]
+        for shared_key in keys:
+            _, blocks = self._attached.pop(shared_key)
+            for block in blocks:
+                try:
+                    block.close()
+                except BufferError:
+                    # something still has a view of the block, it's unmapped when we exit
+                    pass
+            try:
+                with self._lock:
+                    entry = self._index.get(shared_key)
+                    if entry is None or 'refs' not in entry:
+                        continue
+                    entry['refs'] -= 1
+                    if entry['refs'] <= 0:
+                        _unlink(entry['blocks'])
+                        del self._index[shared_key]
+                    else:
+                        self._index[shared_key] = entry
+            except (OSError, EOFError):
+                # the manager is already gone
+                pass
+
+    @property
+    def attached(self) -> typing.List[str]:
+        """Keys of the shared files this process is using"""
+        return list(self._attached)
+
+    @property
+    def total_bytes(self) -> int:
+        """Bytes of shared memory in use by all processes"""
+        return sum(entry.get('bytes', 0) for entry in self._index.values())
+
+    def close(self):
+        """
+        Release our files, and if we made the cache, unlink every block and shut down the manager
+        """
+        self.release()
+        if self._owns_manager and self._manager is not None:
+            with self._lock:
+                for entry in self._index.values():
+                    _unlink(entry.get('blocks', []))
+                self._index.clear()
+            self._manager.shutdown()
+            self._manager = None
+
+    def _publish(self, loaded:typing.Any) -> typing.Tuple[bytes, typing.List[SharedMemory]]:
+        """Copy big arrays to shared memory blocks, and pickle the rest"""
+        blocks = []
+
+        def persistent_id(obj):
+            if type(obj) is np.ndarray and obj.dtype.kind in 'biufcmM' and obj.nbytes >= self.min_array_bytes:
+                block = _open(size=obj.nbytes)
+                blocks.append(block)
+                np.ndarray(obj.shape, dtype=obj.dtype, buffer=block.buf)[...] = obj
+                return block.name, obj.shape, obj.dtype.str
+            return None
+
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        try:
+            pickler.dump(loaded)
+        except BaseException:
+            _unlink([block.name for block in blocks])
+            for block in blocks:
+                block.close()
+            raise
+        return buffer.getvalue(), blocks
+
+    def _attach(self, shared_key:str, entry:dict) -> typing.Any:
+        blocks = []
+
+        def persistent_load(pid):
+            name, shape, dtype = pid
+            block = _open(name)
+            blocks.append(block)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            array.flags.writeable = False
+            return array
+
+        unpickler = pickle.Unpickler(io.BytesIO(entry['skeleton']))
+        unpickler.persistent_load = persistent_load
+        loaded = unpickler.load()
+        self._attached[shared_key] = (loaded, blocks)
+        if self._finalizer is None:
+            # run at exit in both the main process and pool workers, unlike atexit
+            self._finalizer = util.Finalize(self, self.release, exitpriority=10)
+        return loaded
+
+    def __getstate__(self) -> dict:
+        return {'min_array_bytes': self.min_array_bytes, 'wait': self.wait,
+                '_index': self._index, '_lock': self._lock}
+
+    def __setstate__(self, state:dict):
+        self.__dict__.update(state)
+        self._manager = None
+        self._owns_manager = False
+        self._attached = {}
+        self._finalizer = None
+
+    def __enter__(self) -> 'SharedFileCache':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _shared_key(key:typing.Hashable, path:Path) -> str:
+    try:
+        stat = os.stat(path)
+        return f'{key!r}:{stat.st_size}:{stat.st_mtime_ns}'
+    except OSError:
+        return repr(key)
+
+def _open(name:typing.Optional[str]=None, size:int=0) -> SharedMemory:
+    """
+    Make (if no ``name`` ) or attach to a block, without the resource tracker, which would unlink it
+    when this process exits -- we unlink blocks ourselves when no process is using them
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, create=name is None, size=size, track=False)
+    block = SharedMemory(name=name, create=name is None, size=size)
+    from multiprocessing import resource_tracker
+    try:
+        resource_tracker.unregister(block._name, 'shared_memory')
+    except Exception:
+        pass
+    return block
+
+def _unlink(names:typing.List[str]):
+    for name in names:
+        try:
+            block = _open(name)
+        except FileNotFoundError:
+            continue
+        block.close()
+        if os.name == 'posix':
+            # not SharedMemory.unlink, which would tell the resource tracker about a block it isn't tracking
+            from multiprocessing.shared_memory import _posixshmem
+            _posixshmem.shm_unlink(block._name)
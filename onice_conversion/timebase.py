@@ -0,0 +1,450 @@
+"""
+Put streams recorded on different clocks onto one common clock.
+
+A :class:`.TimeBase` takes any number of streams, each with either explicit timestamps
+or a sampling rate, and optionally the times (on that stream's clock) of sync pulses
+that were also recorded by a reference stream. Streams with sync pulses are mapped to
+the reference clock with a piecewise-linear fit through the pulses (see :class:`.ClockMap` ),
+which corrects for both offset and drift.
+
+It then tells the writer how to store each stream's time (:meth:`.TimeBase.time_kwargs` ):
+as a ``starting_time`` and ``rate`` if its samples are regular enough on the common clock,
+otherwise as a full array of timestamps, eg. for the smear example::
+
+    timebase = TimeBase()
+    timebase.add('frames', timestamps=frame_msec, scale=1e-3)
+    timebase.add('sniff', rate=800., n_samples=len(sniff_signal))
+
+    tracking.create_spatial_series(name='nose', data=nose, reference_frame='session start',
+                                   **timebase.time_kwargs('frames'))
+    sniff = TimeSeries(name='sniff_signal', data=sniff_signal, unit='V', **timebase.time_kwargs('sniff'))
+    for start, end in zip(timebase.to_common('frames', trial_start), timebase.to_common('frames', trial_end)):
+        nwbfile.add_trial(start_time=start, stop_time=end, ...)
+
+Everything is vectorized and long streams are processed in blocks of :data:`.BLOCK` samples,
+so a stream of 10^8 samples never needs more than one block's worth of temporary arrays.
+"""
+import typing
+
+import numpy as np
+
+from onice_conversion.datasource import DataSource, SourceChunkIterator
+
+BLOCK = 2**22
+"""
+Samples per block when scanning or computing timestamps
+"""
+
+TOLERANCE = 0.1
+"""
+Default maximum deviation, as a fraction of one sample period, of a stream's
+timestamps from a regular grid for it to be stored as ``starting_time`` + ``rate``
+"""
+
+MAX_PULSE_SHIFT = 3
+"""
+How many more sync pulses than the difference in their counts may be missing from the
+start of either stream when pairing them (see :func:`.pair_pulses` )
+"""
+
+PULSE_TIE = 0.01
+"""
+When pairing sync pulses, shifts whose intervals disagree by at most this fraction of a typical
+interval more than the best shift's are treated as ties, and the one with the most pulses wins
+"""
+
+
+class ClockMap(object):
+    """
+    Piecewise-linear map from one clock to another.
+
+    Between knots, times are interpolated linearly; outside them, they're
+    extrapolated with the slope of the first or last segment.
+
+    Args:
+        local (:class:`numpy.ndarray`): increasing knot times on the stream's clock
+        common (:class:`numpy.ndarray`): the same knots on the common clock
+    """
+
+    def __init__(self, local:np.ndarray, common:np.ndarray):
+        self.local = np.asarray(local, dtype=np.float64)
+        self.common = np.asarray(common, dtype=np.float64)
+        if self.local.shape != self.common.shape or self.local.ndim != 1 or len(self.local) == 0:
+            raise ValueError('local and common knots must be 1D arrays of the same, nonzero, length')
+        if np.any(np.diff(self.local) <= 0):
+            raise ValueError('local knots must be strictly increasing')
+
+    @classmethod
+    def identity(cls) -> 'ClockMap':
+        return cls(np.array([0.0]), np.array([0.0]))
+
+    @property
+    def slopes(self) -> typing.Tuple[float, float]:
+        """Slopes of the first and last segments (1 if there's only one knot)"""
+        if len(self.local) == 1:
+            return 1.0, 1.0
+        return ((self.common[1] - self.common[0]) / (self.local[1] - self.local[0]),
+                (self.common[-1] - self.common[-2]) / (self.local[-1] - self.local[-2]))
+
+    def __call__(self, times) -> np.ndarray:
+        times = np.asarray(times, dtype=np.float64)
+        first, last = self.slopes
+        if len(self.local) == 1:
+            return times + (self.common[0] - self.local[0])
+
+        mapped = np.interp(times, self.local, self.common)
+        before = times < self.local[0]
+        if np.any(before):
+            mapped[before] = self.common[0] + (times[before] - self.local[0]) * first
+        after = times > self.local[-1]
+        if np.any(after):
+            mapped[after] = self.common[-1] + (times[after] - self.local[-1]) * last
+        return mapped
+
+    def max_deviation(self, start:float, stop:float) -> float:
+        """
+        Largest difference between this map and the straight line through its values at
+        ``start`` and ``stop`` , over ``[start, stop]`` .
+
+        The difference between a piecewise-linear function and a line is itself piecewise linear,
+        so the largest one is at a knot -- this is computed from the knots alone, whatever
+        the number of samples.
+        """
+        if stop <= start:
+            return 0.0
+        inner = self.local[(self.local > start) & (self.local < stop)]
+        if len(inner) == 0:
+            return 0.0
+        ends = self(np.array([start, stop]))
+        line = ends[0] + (inner - start) * (ends[1] - ends[0]) / (stop - start)
+        return float(np.max(np.abs(self(inner) - line)))
+
+
+def pair_pulses(local:np.ndarray, common:np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Pair up the times of the same sync pulses recorded on two clocks.
+
+    If both have the same number of pulses they're paired in order. Otherwise some pulses are
+    assumed to be missing from the start or end of one of them (eg. because one stream started
+    recording later), and we pick the shift between them (of up to :data:`.MAX_PULSE_SHIFT` more than
+    the difference in counts) whose inter-pulse intervals agree the best (see :data:`.PULSE_TIE` ).
+
+    Returns:
+        tuple of paired (local, common) pulse times
+    """
+    local = np.asarray(local, dtype=np.float64)
+    common = np.asarray(common, dtype=np.float64)
+    if len(local) < 2 or len(common) < 2:
+        raise ValueError('Need at least two sync pulses on each clock')
+    if len(local) == len(common):
+        return local, common
+
+    local_intervals, common_intervals = np.diff(local), np.diff(common)
+    reach = abs(len(local) - len(common)) + MAX_PULSE_SHIFT
+    candidates = []
+    for shift in range(-reach, reach + 1):
+        # local[i] pairs with common[i + shift]
+        lo = max(0, -shift)
+        hi = min(len(local_intervals), len(common_intervals) - shift)
+        # one interval always agrees with any other once the scale is removed,
+        # so it takes at least two to tell shifts apart
+        if hi - lo < 2:
+            continue
+        a, b = local_intervals[lo:hi], common_intervals[lo + shift:hi + shift]
+        # intervals may be scaled by drift, so compare after removing the overall scale
+        error = np.median(np.abs(a * (np.sum(b) / np.sum(a)) - b))
+        candidates.append((error, shift, lo, hi))
+
+    if len(candidates) == 0:
+        raise ValueError('Need at least three sync pulses on each clock to pair them when their counts differ')
+
+    # small overlaps agree by chance more easily, so among shifts that agree
+    # about as well as the best one, take the one that pairs the most pulses
+    least = min(candidate[0] for candidate in candidates)
+    tie = least + PULSE_TIE * np.median(np.abs(common_intervals))
+    _, shift, lo, hi = max((candidate for candidate in candidates if candidate[0] <= tie),
+                           key=lambda candidate: (candidate[3] - candidate[2], -candidate[0]))
+    return local[lo:hi + 1], common[lo + shift:hi + shift + 1]
+
+
+def fit_clock(local:np.ndarray, common:np.ndarray, drift:str='piecewise') -> ClockMap:
+    """
+    Fit a :class:`.ClockMap` from the times of sync pulses on two clocks
+
+    Args:
+        local (:class:`numpy.ndarray`): pulse times on the stream's clock
+        common (:class:`numpy.ndarray`): pulse times on the common clock
+        drift (str): ``'piecewise'`` to go through every pulse (following drift that changes over time),
+            or ``'linear'`` for a least-squares constant offset and drift (smoothing out jitter in the pulses)
+    """
+    local, common = pair_pulses(local, common)
+    if drift == 'piecewise':
+        return ClockMap(local, common)
+    elif drift == 'linear':
+        slope, intercept = np.polyfit(local, common, 1)
+        ends = np.array([local[0], local[-1]])
+        return ClockMap(ends, intercept + slope * ends)
+    else:
+        raise ValueError(f"drift must be 'piecewise' or 'linear', got {drift}")
+
+
+class Stream(object):
+    """
+    A stream of samples on some clock. See :meth:`.TimeBase.add`
+    """
+
+    def __init__(self, name:str,
+                 timestamps:typing.Optional[np.ndarray]=None,
+                 rate:typing.Optional[float]=None,
+                 starting_time:float=0.0,
+                 n_samples:typing.Optional[int]=None,
+                 sync:typing.Optional[np.ndarray]=None,
+                 scale:float=1.0):
+        if (timestamps is None) == (rate is None):
+            raise ValueError(f'Stream {name} needs either timestamps or a rate')
+        if rate is not None and n_samples is None:
+            raise ValueError(f'Stream {name} has a rate, so it needs n_samples')
+
+        self.name = name
+        self.timestamps = timestamps
+        self.rate = rate
+        self.starting_time = starting_time
+        self.n_samples = int(n_samples) if timestamps is None else len(timestamps)
+        self.sync = np.asarray(sync, dtype=np.float64) * scale if sync is not None else None
+        self.scale = scale
+        self.clock = ClockMap.identity()
+
+    def local_times(self, start:int=0, stop:typing.Optional[int]=None) -> np.ndarray:
+        """Times of samples ``start:stop`` on the stream's own clock, in seconds"""
+        stop = self.n_samples if stop is None else min(stop, self.n_samples)
+        if self.timestamps is not None:
+            return np.asarray(self.timestamps[start:stop], dtype=np.float64) * self.scale
+        # rate is always in Hz, only the starting time is in the stream's units
+        return self.starting_time * self.scale + np.arange(start, stop, dtype=np.float64) / self.rate
+
+    def times(self, start:int=0, stop:typing.Optional[int]=None) -> np.ndarray:
+        """Times of samples ``start:stop`` on the common clock"""
+        return self.clock(self.local_times(start, stop))
+
+    def blocks(self) -> typing.Iterator[typing.Tuple[int, np.ndarray]]:
+        """Iterate over ``(start, common times)`` in blocks of :data:`.BLOCK` samples"""
+        for start in range(0, self.n_samples, BLOCK):
+            yield start, self.times(start, start + BLOCK)
+
+    def __repr__(self) -> str:
+        kind = f'rate={self.rate}' if self.rate is not None else 'timestamps'
+        return f'Stream({self.name}, {kind}, n_samples={self.n_samples})'
+
+
+class TimestampSource(DataSource):
+    """
+    The common-clock timestamps of a stream as a :class:`.datasource.DataSource` ,
+    computed a block at a time as they're read, so they can be written without
+    ever holding all of them.
+    """
+
+    def __init__(self, stream:Stream):
+        super(TimestampSource, self).__init__()
+        self.stream = stream
+
+    @property
+    def shape(self) -> typing.Tuple[int, ...]:
+        return (self.stream.n_samples,)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(np.float64)
+
+    def __getitem__(self, item) -> np.ndarray:
+        if isinstance(item, slice) and item.step in (None, 1):
+            start, stop, _ = item.indices(self.stream.n_samples)
+            return self.stream.times(start, stop)
+        return self.stream.times()[item]
+
+    def read(self, start:int, stop:int) -> np.ndarray:
+        return self.stream.times(start, stop)
+
+    def column(self, index:int):
+        raise TypeError('Timestamps are 1D, they have no columns')
+
+
+class TimeBase(object):
+    """
+    A set of streams and how to map each of them to a common clock.
+    See the module docs for an overview.
+
+    Args:
+        drift (str): how to fit clocks to sync pulses, see :func:`.fit_clock`
+        tolerance (float): default tolerance for :meth:`.regular`
+    """
+
+    def __init__(self, drift:str='piecewise', tolerance:float=TOLERANCE):
+        self.drift = drift
+        self.tolerance = tolerance
+        self.streams = {} # type: typing.Dict[str, Stream]
+        self.reference = None # type: typing.Optional[str]
+        self._aligned = False
+
+    def add(self, name:str,
+            timestamps:typing.Optional[np.ndarray]=None,
+            rate:typing.Optional[float]=None,
+            starting_time:float=0.0,
+            n_samples:typing.Optional[int]=None,
+            sync:typing.Optional[np.ndarray]=None,
+            scale:float=1.0,
+            reference:bool=False) -> Stream:
+        """
+        Add a stream.
+
+        Args:
+            name (str): name of the stream
+            timestamps (:class:`numpy.ndarray`): time of each sample. Can be a memmap, and is only read in blocks.
+            rate (float): or, the sampling rate in Hz (on the stream's clock), along with...
+            starting_time (float): time of the first sample, and
+            n_samples (int): number of samples
+            sync (:class:`numpy.ndarray`): times of sync pulses on this stream's clock (in the same units as its timestamps)
+            scale (float): multiply ``timestamps`` , ``starting_time`` and ``sync`` by this to get seconds,
+                eg. ``1e-3`` for timestamps in milliseconds. ``rate`` is always in Hz and isn't scaled.
+            reference (bool): this stream's clock is the common clock. Defaults to the first
+                stream with sync pulses. Streams without sync pulses are assumed to already be on it.
+
+        Returns:
+            :class:`.Stream`
+        """
+        if name in self.streams:
+            raise ValueError(f'Already have a stream named {name}')
+        stream = Stream(name, timestamps=timestamps, rate=rate, starting_time=starting_time,
+                        n_samples=n_samples, sync=sync, scale=scale)
+        self.streams[name] = stream
+        if reference or (self.reference is None and sync is not None):
+            self.reference = name
+        self._aligned = False
+        return stream
+
+    def align(self):
+        """
+        Fit the clock of every stream that has sync pulses to the reference stream's.
+        Called automatically when times are first needed after adding streams.
+        """
+        if self.reference is not None:
+            reference_sync = self.streams[self.reference].sync
+            for name, stream in self.streams.items():
+                if name == self.reference or stream.sync is None:
+                    stream.clock = ClockMap.identity()
+                    continue
+                if reference_sync is None:
+                    raise ValueError(f'Stream {name} has sync pulses, but the reference stream {self.reference} does not')
+                stream.clock = fit_clock(stream.sync, reference_sync, self.drift)
+        self._aligned = True
+
+    def __getitem__(self, name:str) -> Stream:
+        if not self._aligned:
+            self.align()
+        return self.streams[name]
+
+    def timestamps(self, name:str, start:int=0, stop:typing.Optional[int]=None) -> np.ndarray:
+        """Timestamps of samples ``start:stop`` of a stream on the common clock"""
+        return self[name].times(start, stop)
+
+    def to_common(self, name:str, times) -> np.ndarray:
+        """
+        Map times on a stream's clock (in the stream's units, eg. trial starts and ends
+        recorded by the same system as the stream) to the common clock
+        """
+        stream = self[name]
+        return stream.clock(np.asarray(times, dtype=np.float64) * stream.scale)
+
+    def nearest(self, name:str, times) -> np.ndarray:
+        """
+        Indices of the samples of a stream nearest to ``times`` on the common clock,
+        eg. to find the sniff sample at each video frame::
+
+            sniff_at_frame = sniff_signal[timebase.nearest('sniff', timebase.timestamps('frames'))]
+
+        Timestamps must be increasing.
+        """
+        stream = self[name]
+        times = np.asarray(times, dtype=np.float64)
+        if stream.timestamps is None and len(stream.clock.local) <= 2:
+            # linear all the way, so invert the map instead of searching
+            local = _invert_linear(stream.clock, times)
+            return np.clip(np.rint((local - stream.starting_time * stream.scale) * stream.rate),
+                           0, stream.n_samples - 1).astype(np.int64)
+
+        # find which block each time falls in from the first time of each block,
+        # then search within that block, so we only ever hold one block of the stream's timestamps
+        firsts = np.array([stream.times(start, start + 1)[0] for start in range(0, stream.n_samples, BLOCK)])
+        which = np.clip(np.searchsorted(firsts, times, side='right') - 1, 0, len(firsts) - 1)
+        indices = np.empty(times.shape, dtype=np.int64)
+        for block_index in np.unique(which):
+            start = int(block_index) * BLOCK
+            in_block = which == block_index
+            # one sample past the end, for times between this block and the next
+            block = stream.times(start, start + BLOCK + 1)
+            if len(block) == 1:
+                indices[in_block] = start
+                continue
+            found = np.clip(np.searchsorted(block, times[in_block]), 1, len(block) - 1)
+            closer_left = times[in_block] - block[found - 1] <= block[found] - times[in_block]
+            indices[in_block] = start + found - closer_left
+        return indices
+
+    def regular(self, name:str, tolerance:typing.Optional[float]=None) -> typing.Optional[typing.Tuple[float, float]]:
+        """
+        Whether a stream's samples are evenly spaced on the common clock, to within
+        ``tolerance`` sample periods, and if so its starting time and rate.
+
+        Streams with a rate are checked from their clock map's knots alone; streams
+        with timestamps are scanned a block at a time, stopping at the first block that deviates.
+
+        Returns:
+            tuple of ``(starting_time, rate)`` , or None if the stream is irregular
+        """
+        tolerance = self.tolerance if tolerance is None else tolerance
+        stream = self[name]
+        if stream.n_samples < 2:
+            return None
+
+        first = stream.times(0, 1)[0]
+        last = stream.times(stream.n_samples - 1, stream.n_samples)[0]
+        if last <= first:
+            return None
+        rate = (stream.n_samples - 1) / (last - first)
+        allowed = tolerance / rate
+
+        if stream.timestamps is None:
+            local = stream.local_times(0, 1)[0], stream.local_times(stream.n_samples - 1, stream.n_samples)[0]
+            if stream.clock.max_deviation(*local) > allowed:
+                return None
+            return float(first), float(rate)
+
+        for start, block in stream.blocks():
+            grid = first + np.arange(start, start + len(block), dtype=np.float64) / rate
+            if np.max(np.abs(block - grid)) > allowed:
+                return None
+        return float(first), float(rate)
+
+    def time_kwargs(self, name:str, tolerance:typing.Optional[float]=None) -> dict:
+        """
+        How to store a stream's time in a :class:`pynwb.base.TimeSeries` :
+        ``{'starting_time': ..., 'rate': ...}`` if it's :meth:`.regular` , otherwise ``{'timestamps': ...}``
+
+        Long timestamps (more than one :data:`.BLOCK` ) are given as a :class:`.datasource.SourceChunkIterator`
+        of a :class:`.TimestampSource` , so they're computed as they're written.
+        """
+        regular = self.regular(name, tolerance)
+        if regular is not None:
+            return {'starting_time': regular[0], 'rate': regular[1]}
+
+        stream = self[name]
+        if stream.n_samples > BLOCK:
+            return {'timestamps': SourceChunkIterator(TimestampSource(stream))}
+        return {'timestamps': stream.times()}
+
+
+def _invert_linear(clock:ClockMap, times:np.ndarray) -> np.ndarray:
+    """Map common times back to a stream's clock, for maps with at most two knots"""
+    if len(clock.local) == 1:
+        return times - (clock.common[0] - clock.local[0])
+    slope = clock.slopes[0]
+    return clock.local[0] + (times - clock.common[0]) / slope
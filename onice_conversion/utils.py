@@ -2,13 +2,55 @@
 Utility functions used internally across the library
 """
 
+import hashlib
 import inspect
+import sys
 import typing
+from functools import lru_cache
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
 
 class AmbiguityError(Exception):
     """Exception type for when :mod:`onice_conversion.spec` modules give ambiguous results"""
     pass
 
+class MergeConflictError(ValueError):
+    """Exception type for when specs set the same metadata to different values, see :mod:`onice_conversion.spec.merge`"""
+    pass
+
+class VerificationError(Exception):
+    """Exception type for when a written file doesn't match its source data, see :meth:`.PipelinedWriter.verify`"""
+    pass
+
+class MemoryBudgetError(MemoryError):
+    """
+    Exception type for when a conversion can't stay within its memory budget, see :mod:`onice_conversion.memory`
+
+    Args:
+        message (str): what went over
+        report (:class:`.memory.MemoryReport`): Optional. The conversion's plan and peak RSS,
+            appended to the message
+    """
+    def __init__(self, message:str, report=None):
+        self.report = report
+        if report is not None:
+            message = f'{message}\n{report}'
+        super(MemoryBudgetError, self).__init__(message)
+
+class MetadataValidationError(ValueError):
+    """
+    Exception type for metadata that doesn't match its schema, see :mod:`onice_conversion.validation`
+
+    Args:
+        problems (list): the :class:`.validation.Problem` s
+    """
+    def __init__(self, problems:list):
+        self.problems = problems
+        super(MetadataValidationError, self).__init__(
+            f'{len(problems)} metadata validation error{"s" if len(problems) != 1 else ""}:\n'
+            + '\n'.join(f'  {problem}' for problem in problems))
+
 class IntrospectionMixin(object):
     """
     Mixin to allow objects to become aware of all the arguments they were called with on initialization
@@ -25,22 +67,7 @@ class IntrospectionMixin(object):
         -------
         list of all argument names
         """
-        parents = inspect.getmro(type(self))
-        # get signatures for each
-        # go in reverse order so top classes options come first
-        # list to keep track of parameter names to remove duplicates
-        param_names = []
-        for cls in reversed(parents):
-            sig = inspect.signature(cls)
-            for param_name, param in sig.parameters.items():
-                if param_name in ('self', 'kwargs', 'args'):
-                    continue
-                if param_name not in param_names:
-                    # check if we already have a parameter with this name,
-                    # if we don't add it.
-                    param_names.append(param_name)
-
-        return param_names
+        return list(_sig_names(type(self)))
 
     def _get_init_args(self):
         """
@@ -54,16 +81,22 @@ class IntrospectionMixin(object):
         dict of argument names and params
         """
 
-        param_names = self._full_sig_names
-
-        # iterate from back to front (top frame to low frame) getting args
-        #
-        params = {}
-        for frame_info in reversed(inspect.stack()):
-            frame = frame_info.frame
-            frame_locals = inspect.getargvalues(frame).locals
-            frame_params = {k:v for k, v in frame_locals.items() if k in param_names}
-            params.update(frame_params)
+        param_names = set(_sig_names(type(self)))
+
+        # walk up through the __init__ frames of this object (the frames that have it as ``self``),
+        # then go from back to front (top frame to low frame) getting args.
+        # walking frames directly rather than with inspect.stack, which reads the source of every frame
+        frames = []
+        frame = inspect.currentframe()
+        try:
+            while frame is not None and frame.f_locals.get('self') is self:
+                frames.append(frame)
+                frame = frame.f_back
+            params = {}
+            for init_frame in reversed(frames):
+                params.update({k: v for k, v in init_frame.f_locals.items() if k in param_names})
+        finally:
+            del frame, frames
 
         return params
 
@@ -80,6 +113,41 @@ class IntrospectionMixin(object):
 
 
 
+@lru_cache(maxsize=None)
+def _sig_names(cls) -> typing.Tuple[str, ...]:
+    """
+    Names of all the arguments in the signatures of a class and its parents,
+    top classes first, see :meth:`.IntrospectionMixin._full_sig_names`
+    """
+    # go in reverse order so top classes options come first
+    # keep track of parameter names to remove duplicates
+    param_names = []
+    for cls in reversed(inspect.getmro(cls)):
+        sig = inspect.signature(cls)
+        for param_name, param in sig.parameters.items():
+            if param_name in ('self', 'kwargs', 'args'):
+                continue
+            if param_name not in param_names:
+                param_names.append(param_name)
+
+    return tuple(param_names)
+
+def _package_version(obj) -> str:
+    """
+    Get the version of the package that some object (eg. a class) comes from,
+    eg. ``'0.9.3'`` for anything in ``nwb_conversion_tools``
+
+    Falls back to the top-level module's ``__version__`` , and then to ``'unknown'``
+    """
+    return _distribution_version(obj.__module__.split('.')[0])
+
+@lru_cache(maxsize=None)
+def _distribution_version(package:str) -> str:
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return str(getattr(sys.modules.get(package), '__version__', 'unknown'))
+
 def _recurse_subclasses(cls, leaves_only=True) -> list:
     """
     Given some class, find its subclasses recursively
@@ -151,52 +219,149 @@ def _gather_list_of_dicts(a_list:list) -> typing.Dict[str, list]:
     out_dict = {}
     for inner_dict in a_list:
         for inner_key, inner_value in inner_dict.items():
-            if inner_key not in out_dict.keys():
-                out_dict[inner_key] = [inner_value]
-            else:
-                out_dict[inner_key].append(inner_value)
+            out_dict.setdefault(inner_key, []).append(inner_value)
 
     return out_dict
 
-def _recursive_dedupe_dicts(a_dict, raise_on_dupes=True):
+def _hash_key(value) -> typing.Hashable:
     """
-    Deduplicate a list of dicts.
+    Make a hashable key for any value, such that equal values have equal keys.
 
-    Optionally raise an exception if duplicates are found, otherwise
-    call ``set`` and unwrap singletons and return
+    Hashable values are their own key. Arrays are keyed by their dtype, shape, and a
+    hash of their contents (so two arrays are only equal if all three are),
+    dicts, lists, and tuples by the keys of their contents, and other objects
+    (eg. matlab structs) by the keys of their ``__dict__`` .
 
-    .. todo::
+    Parameters
+    ----------
+    value : anything!
+
+    Returns
+    -------
+    something hashable
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            return ('ndarray', value.dtype.str, value.shape, tuple(_hash_key(item) for item in value.flat))
+        return ('ndarray', value.dtype.str, value.shape,
+                hashlib.blake2b(np.ascontiguousarray(value).reshape(-1).view(np.uint8), digest_size=16).digest())
+    elif isinstance(value, dict):
+        return ('dict', frozenset((k, _hash_key(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(_hash_key(item) for item in value))
+
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        if hasattr(value, '__dict__'):
+            return (type(value).__name__, _hash_key(vars(value)))
+        # give up and use identity
+        return ('id', id(value))
+
+def _dedupe(values:typing.Iterable) -> list:
+    """
+    Remove duplicates from some values, keeping the first of each in order.
 
-        TEST ME!!!!
+    Works for unhashable values like arrays and dicts too, see :func:`._hash_key`
 
     Parameters
     ----------
-    a_dict : of dicts
+    values : iterable
 
     Returns
     -------
-    dict: deduplicated dictionary
+    list of unique values
+    """
+    unique = {}
+    for value in values:
+        unique.setdefault(_hash_key(value), value)
+    return list(unique.values())
 
+def _recursive_dedupe_dicts(a_dict, raise_on_dupes=True):
     """
-    gathered = {}
+    Deduplicate a dict of lists, like that made by :func:`._gather_list_of_dicts`
 
+    Duplicate values are removed in order with :func:`._dedupe` , and singletons are unwrapped.
+    Lists of dicts (eg. from nested ``Subject[subject_id]`` fields) are gathered and deduplicated
+    recursively. Optionally raise an :class:`.AmbiguityError` if any key has more than one distinct value.
+
+    Parameters
+    ----------
+    a_dict : of lists (or of dicts of lists...)
+    raise_on_dupes : bool
+        if True, raise an error if multiple values are found for a key,
+        otherwise return them as a tuple
+
+    Returns
+    -------
+    dict: deduplicated dictionary
+
+    """
     dupes = {}
+    gathered = _dedupe_dict(a_dict, dupes)
+
+    if raise_on_dupes and len(dupes)>0:
+        dup_str = '\n'.join([f"{k}: {v}" for k, v in dupes.items()])
+        raise AmbiguityError('Duplicates detected for keys, with values:\n'+dup_str)
+
+    return gathered
+
+def _dedupe_dict(a_dict:dict, dupes:dict, prefix:str='') -> dict:
+    gathered = {}
     for k, v in a_dict.items():
         if isinstance(v, dict):
-            gathered[k] = _recursive_dedupe_dicts(v)
+            gathered[k] = _dedupe_dict(v, dupes, prefix+f'{k}.')
+        elif isinstance(v, (tuple, list)) and len(v) > 0 and all(isinstance(item, dict) for item in v):
+            gathered[k] = _dedupe_dict(_gather_list_of_dicts(v), dupes, prefix+f'{k}.')
         elif isinstance(v, (tuple, list)):
-            v = tuple(set(v))
+            v = tuple(_dedupe(v))
             if len(v)>1:
-                dupes[k] = v
+                dupes[prefix+str(k)] = v
                 gathered[k] = v
-            else:
+            elif len(v) == 1:
                 gathered[k] = v[0]
+            else:
+                gathered[k] = v
         else:
             gathered[k] = v
+    return gathered
 
-    if raise_on_dupes and len(dupes)>0:
-        dup_str = '\n'.join([f"{k}: {v}" for k, v in dupes.items()])
-        raise Exception('Duplicates detected for keys, with values:'+dup_str)
+def _sizeof(obj, _seen:typing.Optional[set]=None) -> int:
+    """
+    Roughly estimate the memory used by an object and everything inside it
 
-    return gathered
+    Uses ``nbytes`` for arrays, recurses into dicts, lists, tuples, sets, and
+    the ``__dict__`` of objects (eg. matlab structs), and counts each object only once.
+
+    Parameters
+    ----------
+    obj : object to size up
 
+    Returns
+    -------
+    int: number of bytes
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    if hasattr(obj, 'nbytes') and hasattr(obj, 'dtype'):
+        size = sys.getsizeof(obj, 0)
+        # arrays that own their data already count it in their sizeof
+        if not (isinstance(obj, np.ndarray) and obj.flags.owndata):
+            size += int(obj.nbytes)
+        if obj.dtype == object:
+            size += sum(_sizeof(item, _seen) for item in obj.flat)
+        return size
+
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k, _seen) + _sizeof(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_sizeof(item, _seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += _sizeof(obj.__dict__, _seen)
+    return size
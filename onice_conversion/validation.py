@@ -0,0 +1,306 @@
+"""
+Cached metadata validation.
+
+:meth:`nwb_conversion_tools.NWBConverter.validate_metadata` builds the converter's metadata
+schema from scratch and has :mod:`jsonschema` check the schema itself and build a validator
+for it on every call, which adds up in batch mode. Instead, :func:`.get_validator` caches
+the :class:`.Validator` by a key -- eg. the converter class, its interfaces, and the versions
+of the packages that define their schemas -- so every session after the first skips building
+the schema and the :mod:`jsonschema` validator for it::
+
+    validator = get_validator(('LabConverter', versions), converter.get_metadata_schema)
+    validator.validate(metadata, sources=provenance)
+
+Containers are compiled from their docval, see :func:`.get_container_validator`
+
+Errors are collected rather than raised one at a time, and a
+:class:`~.utils.MetadataValidationError` lists each of them with the path into the metadata
+and, if given a mapping of metadata paths to the specs that produced them
+(see :func:`.spec_sources` ), the spec responsible.
+
+Like nwb-conversion-tools' ``NWBMetaDataEncoder`` , datetimes are valid strings and numpy
+arrays are valid arrays.
+"""
+import hashlib
+import json
+import numbers
+import re
+import typing
+from datetime import date, datetime
+
+import jsonschema
+import numpy as np
+
+from onice_conversion.utils import MetadataValidationError, _package_version
+
+Check = typing.Callable[[typing.Any, tuple, list], None]
+"""A compiled schema: ``check(value, path, errors)`` appends ``(path, message)`` for each error"""
+
+
+class Problem(typing.NamedTuple):
+    """One validation error"""
+    path: tuple
+    """keys (and list indices) into the metadata"""
+    message: str
+    spec: typing.Optional[typing.Any] = None
+    """the spec that produced the offending value, if known"""
+
+    def __str__(self) -> str:
+        location = '.'.join(str(key) for key in self.path) if self.path else '<metadata>'
+        source = f' (from {_describe_spec(self.spec)})' if self.spec is not None else ''
+        return f'{location}: {self.message}{source}'
+
+
+class Validator(object):
+    """
+    A compiled schema, see :func:`.compile_schema`
+
+    Args:
+        check (callable): the compiled root check
+        schema (dict): the source schema, kept for reference
+    """
+
+    def __init__(self, check:Check, schema:typing.Optional[dict]=None):
+        self.check = check
+        self.schema = schema
+
+    def errors(self, value, sources:typing.Optional[typing.Dict[tuple, typing.Any]]=None) -> typing.List[Problem]:
+        """
+        Validate without raising
+
+        Args:
+            value: the metadata
+            sources (dict): ``{metadata path: spec}`` to attribute errors to specs, see :func:`.spec_sources`
+
+        Returns:
+            list of :class:`.Problem` s, empty if valid
+        """
+        errors = []
+        self.check(value, (), errors)
+        return [Problem(path, message, _find_source(path, sources)) for path, message in errors]
+
+    def validate(self, value, sources:typing.Optional[typing.Dict[tuple, typing.Any]]=None):
+        """
+        Validate, raising on any error
+
+        Raises:
+            :class:`~.utils.MetadataValidationError` listing every error
+        """
+        errors = self.errors(value, sources)
+        if len(errors) > 0:
+            raise MetadataValidationError(errors)
+
+    def __call__(self, value) -> bool:
+        errors = []
+        self.check(value, (), errors)
+        return len(errors) == 0
+
+
+_validators = {} # type: typing.Dict[typing.Hashable, Validator]
+
+
+def get_validator(key:typing.Optional[typing.Hashable], schema:typing.Union[dict, typing.Callable[[], dict]]) -> Validator:
+    """
+    Get a compiled :class:`.Validator` from the cache, compiling it the first time
+
+    Args:
+        key (hashable): what the schema is for, including anything it depends on (eg. package versions).
+            If None, the schema's own contents are the key.
+        schema (dict, callable): the schema, or a function that builds it, which is only called on a cache miss
+
+    Returns:
+        :class:`.Validator`
+    """
+    if key is None:
+        if callable(schema):
+            schema = schema()
+        key = schema_hash(schema)
+    validator = _validators.get(key)
+    if validator is None:
+        if callable(schema):
+            schema = schema()
+        validator = Validator(compile_schema(schema), schema)
+        _validators[key] = validator
+    return validator
+
+
+def clear_validators():
+    """Empty the cache of compiled validators"""
+    _validators.clear()
+
+
+def schema_hash(schema:dict) -> str:
+    """Hash of a schema's canonical JSON"""
+    return hashlib.sha1(json.dumps(schema, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def compile_schema(schema:typing.Union[dict, bool]) -> Check:
+    """
+    Check the schema and build a :mod:`jsonschema` validator for it (for its ``$schema`` ,
+    or draft 7 like nwb-conversion-tools if it doesn't say)
+
+    Args:
+        schema (dict, bool): the schema
+
+    Returns:
+        ``check(value, path, errors)``
+
+    Raises:
+        :class:`jsonschema.SchemaError` if the schema is invalid
+    """
+    validator_class = jsonschema.validators.validator_for(schema, default=jsonschema.Draft7Validator)
+    validator_class.check_schema(schema)
+    validator = validator_class(schema)
+
+    def check(value, path, errors):
+        for error in validator.iter_errors(_jsonable(value)):
+            error_path = path + tuple(error.absolute_path)
+            if error.validator == 'additionalProperties' and isinstance(error.instance, dict):
+                # at each unexpected property rather than its parent, so they can be traced to their specs
+                errors.extend((error_path + (name,), 'Additional properties are not allowed')
+                              for name in _additional_properties(error.instance, error.schema))
+            else:
+                errors.append((error_path, error.message))
+    return check
+
+
+def _additional_properties(value:dict, schema:dict) -> typing.List[str]:
+    patterns = [re.compile(pattern) for pattern in schema.get('patternProperties', {})]
+    return [name for name in value
+            if name not in schema.get('properties', {}) and not any(pattern.search(name) for pattern in patterns)]
+
+def _jsonable(value):
+    """What nwb-conversion-tools would write to JSON: datetimes as strings, arrays as lists"""
+    if isinstance(value, dict):
+        return {key: _jsonable(item) for key, item in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    elif isinstance(value, np.ndarray):
+        return _jsonable(value.tolist())
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+# ------------------------------------------------
+# containers
+# ------------------------------------------------
+
+def get_container_validator(container) -> Validator:
+    """
+    Compiled :class:`.Validator` for the kwargs of a pynwb container, from its docval:
+    required arguments must be present, no unknown arguments, and each argument must be
+    of one of its allowed types. Cached per container and pynwb version.
+
+    Args:
+        container (:class:`pynwb.NWBContainer`, str): the container, or its name
+            for :func:`.containers.get_container`
+
+    Returns:
+        :class:`.Validator`
+    """
+    if isinstance(container, str):
+        from onice_conversion.containers import get_container
+        container = get_container(container)
+
+    key = ('container', container.__module__, container.__name__, _package_version(container))
+    validator = _validators.get(key)
+    if validator is None:
+        validator = Validator(_compile_docval(container.__init__.__docval__['args']))
+        _validators[key] = validator
+    return validator
+
+def _compile_docval(args:typing.List[dict]) -> Check:
+    types = {arg['name']: _docval_types(arg['type']) for arg in args}
+    required = tuple(arg['name'] for arg in args if 'default' not in arg)
+    names = frozenset(types)
+
+    def check_container(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append((path, f'{value!r} is not of type \'object\''))
+            return
+        for name in required:
+            if name not in value:
+                errors.append((path, f'{name!r} is a required property'))
+        for name, item in value.items():
+            if name not in names:
+                errors.append((path + (name,), 'Additional properties are not allowed'))
+                continue
+            allowed = types[name]
+            if allowed is not None and item is not None and not isinstance(item, allowed):
+                errors.append((path + (name,), f'{item!r} is not of type {", ".join(t.__name__ for t in allowed)}'))
+    return check_container
+
+def _docval_types(docval_type) -> typing.Optional[tuple]:
+    """Resolve a docval type to a tuple of python types, or None if any type is allowed"""
+    if not isinstance(docval_type, (list, tuple)):
+        docval_type = (docval_type,)
+    types = []
+    for type_ in docval_type:
+        if isinstance(type_, str):
+            if type_ in ('float', 'int', 'uint', 'bool'):
+                types.append({'float': numbers.Real, 'int': numbers.Integral,
+                              'uint': numbers.Integral, 'bool': (bool, np.bool_)}[type_])
+            else:
+                # a type that's only named (eg. a not-yet-loaded extension) can't be checked
+                return None
+        elif isinstance(type_, type):
+            types.append(type_)
+            if type_ is str:
+                types.append((datetime, date))
+            elif type_ is datetime:
+                types.append(str)
+            elif type_ in (list, tuple):
+                types.append(np.ndarray)
+        else:
+            return None
+    flat = []
+    for type_ in types:
+        flat.extend(type_ if isinstance(type_, tuple) else (type_,))
+    return tuple(flat)
+
+# ------------------------------------------------
+# provenance
+# ------------------------------------------------
+
+def spec_sources(spec, metadata:dict, sources:typing.Optional[dict]=None) -> typing.Dict[tuple, typing.Any]:
+    """
+    Record which spec produced each value of some parsed metadata
+
+    Args:
+        spec (:class:`.BaseSpec`): the spec
+        metadata (dict): what it parsed
+        sources (dict): existing mapping to add to, later specs replace earlier ones
+            like they do when their metadata is merged
+
+    Returns:
+        dict of ``{metadata path: spec}``
+    """
+    if sources is None:
+        sources = {}
+    for path in _leaf_paths(metadata):
+        sources[path] = spec
+    return sources
+
+def _leaf_paths(metadata:dict, path:tuple=()) -> typing.Iterator[tuple]:
+    for key, value in metadata.items():
+        if isinstance(value, dict) and len(value) > 0:
+            yield from _leaf_paths(value, path + (key,))
+        else:
+            yield path + (key,)
+
+def _find_source(path:tuple, sources:typing.Optional[dict]):
+    """The spec that produced a path, or the dict it's in"""
+    if not sources:
+        return None
+    for end in range(len(path), 0, -1):
+        if path[:end] in sources:
+            return sources[path[:end]]
+    return None
+
+def _describe_spec(spec) -> str:
+    args = getattr(spec, '_init_args', None)
+    if not args:
+        return repr(spec)
+    return f"{type(spec).__name__}({', '.join(f'{k}={v!r}' for k, v in args.items() if v is not None)})"
@@ -0,0 +1,469 @@
+"""
+Watch an archive and queue new sessions for conversion as they land.
+
+Rather than rescanning the whole archive on a schedule, a :class:`.Watcher` watches a root
+directory for session folders whose path (relative to the root) matches a :class:`.spec.Path`
+format, eg. ``'{subject_id}/{session_id}'`` . When a new one appears, it waits until the folder is
+quiescent -- nothing in it has changed for :attr:`.Watcher.quiet` seconds -- and then adds a
+:class:`.batch.Session` for it to a :class:`.jobqueue.JobQueue` , for workers to convert::
+
+    $ onice_conversion watch /mnt/archive /mnt/lab/conversion_queue.db \\
+        --pattern '{subject_id}/{session_id}' --template session_template.json
+
+    $ onice_conversion worker /mnt/lab/conversion_queue.db --wait
+
+Where the template is a :meth:`.batch.Session.to_dict` whose strings are formatted with the
+fields parsed from the folder's path, along with ``{path}`` (the absolute path of the folder),
+``{relpath}`` , and ``{root}`` , see :class:`.SessionTemplate` .
+
+On Linux, changes are noticed with inotify (through :mod:`ctypes` , see :class:`.Inotify` ),
+watching only the directories above the session folders and the insides of folders that
+haven't been queued yet. Elsewhere, or when ``polling=True`` , the session folders are
+listed and their contents checked every :attr:`.Watcher.poll_interval` seconds.
+Either way, a folder is only queued once two snapshots of its files' sizes and mtimes
+taken ``quiet`` seconds apart agree. Folders that a session can't be made for (eg. the template
+needs a file that isn't there yet) stay watched, are listed in :attr:`.Watcher.failed` , and are
+tried again once they change.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
+import select
+import struct
+import time
+import typing
+from pathlib import Path
+
+from onice_conversion.batch import Session, CostModel
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+"""Events that count as a change to a session folder"""
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    Minimal inotify binding with :mod:`ctypes`
+
+    Raises:
+        OSError: if inotify isn't available
+    """
+
+    def __init__(self):
+        library = ctypes.util.find_library('c')
+        if library is None:
+            raise OSError('No libc to get inotify from')
+        self._libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('libc has no inotify')
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {} # type: typing.Dict[int, Path]
+        self.watches = {} # type: typing.Dict[Path, int]
+
+    def add(self, path:Path, mask:int=WATCH_MASK) -> typing.Optional[int]:
+        """Watch a directory, returning the watch descriptor, or None if it's gone"""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(path)), mask | IN_ONLYDIR)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise OSError(error, f'Could not watch {path}: {os.strerror(error)}')
+        self.paths[wd] = path
+        self.watches[path] = wd
+        return wd
+
+    def remove(self, path:Path):
+        """Stop watching a directory"""
+        wd = self.watches.pop(path, None)
+        if wd is not None:
+            self.paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout:typing.Optional[float]=None) -> typing.List[typing.Tuple[Path, int]]:
+        """
+        Wait up to ``timeout`` seconds for events
+
+        Returns:
+            list of ``(path, mask)`` , where an ``IN_Q_OVERFLOW`` event has an empty path
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+                name = buffer[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((Path(), mask))
+                    continue
+                directory = self.paths.get(wd)
+                if mask & IN_IGNORED:
+                    if directory is not None:
+                        self.paths.pop(wd, None)
+                        self.watches.pop(directory, None)
+                    continue
+                if directory is None:
+                    continue
+                events.append((directory / os.fsdecode(name) if name else directory, mask))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class SessionTemplate(object):
+    """
+    Make a :class:`.batch.Session` for a session folder from a template, a
+    :meth:`.batch.Session.to_dict` whose strings are formatted with :meth:`str.format` .
+    Besides the fields parsed from the folder's path (nested fields like ``Subject[subject_id]``
+    are used the same way, ``'{Subject[subject_id]}'`` ), strings can use:
+
+    * ``{path}`` - absolute path of the session folder
+    * ``{relpath}`` - path of the folder relative to the root
+    * ``{root}`` - the watched root
+
+    ``name`` defaults to ``relpath`` with ``/`` replaced by ``_`` , and if the template has
+    a ``spec`` (which isn't formatted, since spec formats use braces too) ``base_dir``
+    defaults to the folder.
+
+    Args:
+        template (dict): the template
+    """
+
+    def __init__(self, template:dict):
+        missing = {'converter', 'source_data', 'nwbfile_path'} - set(template)
+        if missing:
+            raise ValueError(f'Session template is missing {missing}')
+        self.template = template
+
+    def __call__(self, root:Path, path:Path, fields:dict) -> Session:
+        relpath = path.relative_to(root)
+        values = dict(fields, path=str(path), relpath=str(relpath), root=str(root))
+        session = {key: (value if key == 'spec' else _format(value, values)) for key, value in self.template.items()}
+        session.setdefault('name', str(relpath).replace(os.sep, '_'))
+        if session.get('spec') is not None:
+            session.setdefault('base_dir', str(path))
+        return Session.from_dict(session)
+
+def _format(value, values:dict):
+    if isinstance(value, str):
+        return value.format(**values)
+    elif isinstance(value, dict):
+        return {key: _format(item, values) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [_format(item, values) for item in value]
+    return value
+
+
+class _Candidate(object):
+    """A session folder we're waiting on"""
+
+    def __init__(self, path:Path, fields:dict, now:float):
+        self.path = path
+        self.fields = fields
+        self.signature = None # type: typing.Optional[tuple]
+        self.changed = now
+        # why we couldn't make a session for it, and when
+        self.error = None # type: typing.Optional[str]
+        self.failed = None # type: typing.Optional[float]
+
+    @property
+    def retry(self) -> bool:
+        """Whether to (re)try making a session for it: it hasn't failed, or it's changed since"""
+        return self.error is None or self.changed > self.failed
+
+
+class Watcher(object):
+    """
+    Watch a directory for new session folders and queue them once they're quiescent.
+    See module docs.
+
+    Args:
+        root (str, :class:`pathlib.Path`): directory to watch
+        pattern (str, :class:`.spec.Path`): format of the session folders relative to ``root`` ,
+            eg. ``'{subject_id}/{session_id}'``
+        queue (:class:`.jobqueue.JobQueue`): queue to add sessions to
+        session (callable, dict): makes the :class:`.batch.Session` for a folder, called with
+            ``(root, path, fields)`` , or a template dict for a :class:`.SessionTemplate`
+        quiet (float): seconds a folder must go without changes before it's queued
+        poll_interval (float): seconds between checks when polling, and the longest we wait for events otherwise
+        polling (bool): poll even if inotify is available
+        cost_model (str, :class:`.batch.CostModel`): passed to :meth:`.JobQueue.add`
+    """
+
+    def __init__(self, root:typing.Union[str, Path],
+                 pattern,
+                 queue,
+                 session:typing.Union[typing.Callable[[Path, Path, dict], Session], dict],
+                 quiet:float=60,
+                 poll_interval:float=10,
+                 polling:bool=False,
+                 cost_model:typing.Optional[typing.Union[str, Path, CostModel]]=None):
+        from onice_conversion.spec import Path as PathSpec
+
+        self.root = Path(root).absolute()
+        self.pattern = pattern if isinstance(pattern, PathSpec) else PathSpec(pattern)
+        self.depth = len(Path(self.pattern.format).parts)
+        self.queue = queue
+        self.session = session if callable(session) else SessionTemplate(session)
+        self.quiet = quiet
+        self.poll_interval = poll_interval
+        self.cost_model = cost_model if isinstance(cost_model, CostModel) else CostModel(cost_model)
+
+        self.candidates = {} # type: typing.Dict[Path, _Candidate]
+        self.queued = set() # type: typing.Set[Path]
+        self._glob = re.sub(r'\{.*?\}', '*', self.pattern.format)
+
+        self.inotify = None # type: typing.Optional[Inotify]
+        if not polling:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                self.inotify = None
+
+    @property
+    def polling(self) -> bool:
+        return self.inotify is None
+
+    @property
+    def failed(self) -> typing.Dict[Path, str]:
+        """
+        Session folders we couldn't make a session for, and why. They stay watched, and are
+        tried again once they change and go quiet again.
+        """
+        return {path: candidate.error for path, candidate in self.candidates.items() if candidate.error is not None}
+
+    def scan(self):
+        """
+        Find session folders we haven't seen yet -- the whole of a poll, but only needed at
+        startup (and if the event queue overflows) with inotify
+        """
+        now = time.time()
+        queued = {session['name'] for session in self.queue.jobs()} if self.queue is not None else set()
+        if self.inotify is not None:
+            self._watch_ancestors(self.root, 0)
+        for path in self.root.glob(self._glob):
+            if path.is_dir() and path not in self.candidates and path not in self.queued:
+                self._add(path, now, queued)
+
+    def _add(self, path:Path, now:float, queued:typing.Optional[set]=None):
+        parsed = self.pattern.parser.parse(str(path.relative_to(self.root)))
+        if parsed is None:
+            return
+        if queued is not None:
+            try:
+                name = self.session(self.root, path, parsed.named).name
+            except Exception:
+                # can't tell, so it's a candidate, and check says why it can't be queued
+                name = None
+            if name in queued:
+                self.queued.add(path)
+                return
+        self.candidates[path] = _Candidate(path, parsed.named, now)
+        if self.inotify is not None:
+            self._watch_tree(path)
+
+    def _watch_ancestors(self, directory:Path, depth:int):
+        """Watch the directories above where session folders go, for new folders"""
+        if depth >= self.depth or directory in self.inotify.watches:
+            return
+        self.inotify.add(directory, IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF)
+        try:
+            children = [child for child in directory.iterdir() if child.is_dir()]
+        except OSError:
+            return
+        if depth + 1 < self.depth:
+            for child in children:
+                self._watch_ancestors(child, depth + 1)
+
+    def _watch_tree(self, directory:Path):
+        for dirpath, _, _ in os.walk(directory):
+            self.inotify.add(Path(dirpath))
+
+    def _unwatch_tree(self, directory:Path):
+        for path in [path for path in self.inotify.watches if path == directory or directory in path.parents]:
+            self.inotify.remove(path)
+
+    def _handle(self, events:typing.List[typing.Tuple[Path, int]]):
+        now = time.time()
+        for path, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                # missed events, check everything the slow way
+                self.scan()
+                for candidate in self.candidates.values():
+                    candidate.changed = now
+                continue
+            try:
+                parts = path.relative_to(self.root).parts
+            except ValueError:
+                continue
+            if len(parts) < self.depth:
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_ancestors(path, len(parts))
+                    # folders may have been made inside it before we were watching
+                    for candidate_path in path.glob('/'.join(Path(self._glob).parts[len(parts):])):
+                        if candidate_path.is_dir() and candidate_path not in self.candidates and candidate_path not in self.queued:
+                            self._add(candidate_path, now)
+                continue
+            session_path = self.root.joinpath(*parts[:self.depth])
+            if session_path in self.queued:
+                continue
+            if session_path not in self.candidates:
+                if session_path.is_dir():
+                    self._add(session_path, now)
+                continue
+            self.candidates[session_path].changed = now
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path)
+
+    def check(self) -> typing.List[Session]:
+        """
+        Queue the candidate folders that have been quiet long enough.
+        Folders we can't make a session for are kept in :attr:`.failed`
+
+        Returns:
+            the :class:`.batch.Session` s that were queued
+        """
+        now = time.time()
+        ready = []
+        for path, candidate in list(self.candidates.items()):
+            if not path.exists():
+                del self.candidates[path]
+                continue
+            if self.inotify is not None and candidate.signature is not None and (
+                    now - candidate.changed < self.quiet or not candidate.retry):
+                # we'd have heard about changes, no need to look
+                continue
+            signature = _signature(path)
+            if signature != candidate.signature:
+                candidate.signature = signature
+                candidate.changed = now
+            elif now - candidate.changed >= self.quiet and candidate.retry:
+                ready.append(candidate)
+
+        sessions = []
+        made = []
+        for candidate in ready:
+            try:
+                sessions.append(self.session(self.root, candidate.path, candidate.fields))
+            except Exception as e:
+                # keep watching it, it's tried again if it changes
+                candidate.error = f'{type(e).__name__}: {e}'
+                candidate.failed = now
+                print(f'Could not make a session for {candidate.path}, will retry when it changes: {candidate.error}')
+                continue
+            made.append(candidate)
+        if len(sessions) > 0:
+            self.queue.add(sessions, cost_model=self.cost_model)
+        for candidate in made:
+            del self.candidates[candidate.path]
+            self.queued.add(candidate.path)
+            if self.inotify is not None:
+                self._unwatch_tree(candidate.path)
+        return sessions
+
+    def run(self, duration:typing.Optional[float]=None) -> int:
+        """
+        Watch until interrupted (or for ``duration`` seconds)
+
+        Returns:
+            int: number of sessions queued
+        """
+        start_time = time.time()
+        self.scan()
+        print(f"watching {self.root} for {self.pattern.format} ({'polling' if self.polling else 'inotify'}), "
+              f"{len(self.candidates)} unqueued sessions found")
+        n_queued = 0
+        try:
+            while duration is None or time.time() - start_time < duration:
+                # wake up in time to queue the next candidate that will have been quiet long enough
+                wait = self.poll_interval
+                # (failed ones wait for a change, which we'll hear about)
+                waiting = [candidate.changed for candidate in self.candidates.values() if candidate.retry]
+                if self.inotify is not None and waiting:
+                    wait = min(wait, max(0.0, min(waiting) + self.quiet - time.time()) + 0.01)
+                if duration is not None:
+                    wait = min(wait, max(0.0, start_time + duration - time.time()))
+
+                if self.inotify is not None:
+                    self._handle(self.inotify.read(timeout=wait))
+                else:
+                    time.sleep(wait)
+                    self.scan()
+
+                for session in self.check():
+                    n_queued += 1
+                    print(f'queued {session.name}')
+        except KeyboardInterrupt:
+            pass
+        if self.failed:
+            print(f'{len(self.failed)} session folders could not be queued:\n' +
+                  '\n'.join(f'  {path}: {error}' for path, error in self.failed.items()))
+        return n_queued
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def __enter__(self) -> 'Watcher':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _signature(directory:Path) -> typing.Tuple[int, int, int]:
+    """``(number of entries, total size, latest mtime)`` of everything in a directory"""
+    count = 0
+    size = 0
+    latest = os.stat(directory).st_mtime_ns
+    stack = [str(directory)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                count += 1
+                latest = max(latest, stat.st_mtime_ns)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    size += stat.st_size
+    return count, size, latest
@@ -0,0 +1,77 @@
+import pytest
+
+from onice_conversion.batch import CostModel, Plan, Session, SessionEstimate, plan, run_batch
+
+
+class Recording(object):
+    @classmethod
+    def get_source_schema(cls) -> dict:
+        return {'properties': {'file': {'type': 'string', 'format': 'file'}}}
+
+
+class Notes(object):
+    @classmethod
+    def get_source_schema(cls) -> dict:
+        return {'properties': {'notes_path': {'type': 'string'}}}
+
+
+class Converter(object):
+    data_interface_classes = {'Recording': Recording, 'Notes': Notes}
+
+
+def _session(tmp_path, name:str, n_bytes:int) -> Session:
+    (tmp_path / f'{name}.bin').write_bytes(bytes(n_bytes))
+    return Session(name, Converter, {'Recording': {'file': str(tmp_path / f'{name}.bin')},
+                                     'Notes': {'notes_path': str(tmp_path / 'missing.txt')}},
+                   nwbfile_path=tmp_path / f'{name}.nwb')
+
+
+def test_estimate(tmp_path):
+    model = CostModel()
+    estimate = model.estimate(_session(tmp_path, 'a', 1000))
+    # missing files count as empty, but still have their overhead
+    assert estimate.interfaces['Recording'] == (1000, pytest.approx(model.DEFAULT_OVERHEAD + 1000 / model.DEFAULT_RATE))
+    assert estimate.interfaces['Notes'] == (0, model.DEFAULT_OVERHEAD)
+    assert estimate.bytes == 1000
+    assert estimate.seconds == pytest.approx(2 * model.DEFAULT_OVERHEAD + 1000 / model.DEFAULT_RATE)
+
+
+def test_update(tmp_path):
+    """Sessions that take longer than predicted make their interfaces slower, and it's saved"""
+    model = CostModel(tmp_path / 'timings.json')
+    session = _session(tmp_path, 'a', 10_000_000)
+    estimate = model.estimate(session)
+    model.update(estimate, estimate.seconds * 2)
+    assert model.estimate(session).seconds > estimate.seconds
+    params = model.interfaces[CostModel._name(Recording)]
+    assert params['rate'] < model.DEFAULT_RATE and params['overhead'] > model.DEFAULT_OVERHEAD
+
+    # nothing to calibrate against
+    model.update(SessionEstimate(session, {}), 10)
+
+    model.save()
+    assert CostModel(tmp_path / 'timings.json').interfaces == model.interfaces
+    assert CostModel().interfaces == {}
+
+
+def test_plan(tmp_path):
+    """Largest first, each to whichever worker frees up first"""
+    session = _session(tmp_path, 'a', 0)
+    estimates = [SessionEstimate(session, {'Recording': (0, seconds)}) for seconds in (3, 10, 2, 7, 5)]
+    batch_plan = Plan(estimates, 2)
+    assert [estimate.seconds for estimate in batch_plan.estimates] == [10, 7, 5, 3, 2]
+    assert [[estimate.seconds for estimate in worker] for worker in batch_plan.workers] == [[10, 3], [7, 5, 2]]
+    assert batch_plan.makespan == 14
+    assert 'predicted makespan: 0h00m14s' in str(batch_plan)
+
+    assert Plan([], 2).makespan == 0
+
+
+def test_dry_run(tmp_path, capsys):
+    sessions = [_session(tmp_path, name, n_bytes) for name, n_bytes in (('small', 10), ('big', 100_000_000))]
+    assert [estimate.session.name for estimate in plan(sessions, 1).estimates] == ['big', 'small']
+
+    assert run_batch(sessions, n_workers=2, dry_run=True) == {}
+    out = capsys.readouterr().out
+    assert '2 sessions' in out and 'worker 1: 1 sessions' in out
+    assert not (tmp_path / 'big.nwb').exists()
@@ -0,0 +1,42 @@
+import json
+from pathlib import Path
+
+from onice_conversion.__main__ import main
+from onice_conversion.batch import Session
+from onice_conversion.jobqueue import JobQueue
+
+
+def test_queue_commands(tmp_path, monkeypatch, capsys):
+    """add, worker, status, and retry, on one queue"""
+    def run(session):
+        if session.name == 'session1':
+            raise ValueError('oops')
+        Path(session.nwbfile_path).write_text(session.name)
+        return 0.
+
+    monkeypatch.setattr(Session, 'run', run)
+    sessions = [Session(f'session{i}', 'onice_conversion.nwbconverter:NWBConverter', {},
+                        nwbfile_path=tmp_path / f'session{i}.nwb').to_dict() for i in range(2)]
+    (tmp_path / 'sessions.json').write_text(json.dumps(sessions))
+    queue = str(tmp_path / 'queue.db')
+
+    main(['add', queue, str(tmp_path / 'sessions.json')])
+    main(['add', queue, str(tmp_path / 'sessions.json')])
+    out = capsys.readouterr().out
+    assert 'added 2 of 2 sessions' in out
+    assert 'added 0 of 2 sessions' in out
+
+    main(['worker', queue, '--name', 'a', '--max-attempts', '1'])
+    assert 'converted 1 sessions, 1 failed' in capsys.readouterr().out
+    assert (tmp_path / 'session0.nwb').read_text() == 'session0'
+
+    main(['status', queue, '-v'])
+    out = capsys.readouterr().out
+    assert 'done: 1' in out and 'failed: 1' in out
+    assert 'session0: done (a), attempt 1' in out
+    assert 'ValueError: oops' in out
+
+    main(['retry', queue, 'session1'])
+    assert 'requeued 1 failed sessions' in capsys.readouterr().out
+    with JobQueue(queue) as opened:
+        assert opened.status()['pending'] == 1
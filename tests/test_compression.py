@@ -0,0 +1,95 @@
+import bz2
+import gzip
+import lzma
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from onice_conversion.compression import DecompressedFile, detect_compression, open_decompressed
+from onice_conversion.datasource import RawBinarySource
+
+
+@pytest.fixture
+def data() -> bytes:
+    rng = np.random.default_rng(0)
+    # compressible, but not trivially
+    return np.repeat(rng.integers(0, 255, 100000, dtype=np.uint8), 30).tobytes()
+
+
+@pytest.mark.parametrize('compress,suffix', [
+    (lambda b: gzip.compress(b[:1000000]) + gzip.compress(b[1000000:]), '.gz'),
+    (lambda b: bz2.compress(b[:1000000]) + bz2.compress(b[1000000:]), '.bz2'),
+    (lambda b: lzma.compress(b[:1000000]) + b'\x00' * 4 + lzma.compress(b[1000000:]), '.xz'),
+])
+def test_random_access(tmp_path, data, compress, suffix):
+    path = tmp_path / ('data' + suffix)
+    path.write_bytes(compress(data))
+    f = DecompressedFile(path, span=2**18)
+    assert f.size == len(data)
+
+    rng = np.random.default_rng(1)
+    for start, n in zip(rng.integers(0, len(data) + 10, 40), rng.integers(0, 300000, 40)):
+        f.seek(int(start))
+        assert f.read(int(n)) == data[start:start + n]
+
+    with open_decompressed(path) as whole:
+        assert whole.read() == data
+
+
+def test_detect_compression(tmp_path, data):
+    (tmp_path / 'data.gz').write_bytes(gzip.compress(data))
+    # compressed, but no extension
+    (tmp_path / 'data').write_bytes(bz2.compress(data))
+    # raw int16s that happen to start with the gzip magic bytes
+    (tmp_path / 'raw.bin').write_bytes(np.array([0x8b1f, 8, 0, 0], dtype='<u2').tobytes() + data[:2000])
+    (tmp_path / 'notes.txt').write_bytes(b'BZh9 is not a bz2 file')
+
+    assert detect_compression(tmp_path / 'data.gz') == 'gzip'
+    assert detect_compression(tmp_path / 'data') == 'bz2'
+    assert detect_compression(tmp_path / 'raw.bin') is None
+    assert detect_compression(tmp_path / 'notes.txt') is None
+
+
+def test_raw_binary_source(tmp_path):
+    array = np.random.default_rng(0).standard_normal((20000, 4))
+    (tmp_path / 'x.bin.gz').write_bytes(gzip.compress(b'header__' + array.tobytes(), 1))
+
+    source = RawBinarySource(tmp_path / 'x.bin.gz', offset=8, shape=(-1, 4))
+    assert source.shape == array.shape
+    for item in (5, -1, slice(10, 20), slice(None, None, -7), (slice(3, 9), 2), [1, 5, -2]):
+        assert np.array_equal(source[item], array[item])
+    assert np.array_equal(source.column(2).read(100, 200), array[100:200, 2])
+
+
+@pytest.mark.parametrize('n_readers', [1, 4])
+def test_pipeline_readers(tmp_path, n_readers):
+    """Compressed sources can be read by many pipeline readers at once"""
+    pynwb = pytest.importorskip('pynwb')
+    from onice_conversion.pipeline import PipelinedWriter
+
+    array = np.random.default_rng(0).standard_normal((200000, 4))
+    (tmp_path / 'x.bin.gz').write_bytes(gzip.compress(array.tobytes(), 1))
+    source = RawBinarySource(tmp_path / 'x.bin.gz', shape=array.shape)
+
+    pipeline = PipelinedWriter(n_readers=n_readers)
+    nwbfile = pynwb.NWBFile(session_description='test', identifier='test',
+                            session_start_time=datetime.now(timezone.utc))
+    nwbfile.add_acquisition(pynwb.TimeSeries(name='x', data=pipeline.add_stream('x', source, chunks=(10000, 4)),
+                                             unit='V', rate=1.))
+    pipeline.write(nwbfile, tmp_path / 'x.nwb')
+
+    with pynwb.NWBHDF5IO(str(tmp_path / 'x.nwb'), 'r') as io:
+        assert np.array_equal(io.read().acquisition['x'].data[:], array)
+
+
+def test_mat_gz(tmp_path):
+    """Simplified .mat loading reads through the decompressed stream too"""
+    from scipy.io import savemat
+    from onice_conversion.spec.external_file import Mat
+
+    savemat(tmp_path / 'info.mat', {'info': {'rate': 800., 'name': 'sniff'}})
+    (tmp_path / 'info.mat.gz').write_bytes(gzip.compress((tmp_path / 'info.mat').read_bytes()))
+
+    spec = Mat(path='info.mat.gz', key='rate', field=('info', 'rate'))
+    assert spec.parse(tmp_path) == {'rate': 800.}
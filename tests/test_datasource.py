@@ -0,0 +1,87 @@
+import gzip
+
+import numpy as np
+import pytest
+from scipy.io import savemat
+
+from onice_conversion.datasource import (ArraySource, MatSource, RawBinarySource, SourceChunkIterator,
+                                         find_mat_variable, track_copies)
+
+
+@pytest.fixture
+def array() -> np.ndarray:
+    return np.random.default_rng(0).standard_normal((5000, 4))
+
+
+def test_track_copies(tmp_path, array):
+    """Only reads that can't be views are counted"""
+    array.tofile(tmp_path / 'x.bin')
+    np.asfortranarray(array).T.tofile(tmp_path / 'x_f.bin')
+
+    with track_copies() as copies:
+        rows = RawBinarySource(tmp_path / 'x.bin', shape=(-1, 4))
+        assert np.array_equal(rows.read(10, 20), array[10:20])
+        assert copies.copies == 0
+
+        column = rows.column(1).read(0, 100)
+        assert np.array_equal(column, array[:100, 1])
+        assert copies.copies == 1 and copies.bytes == column.nbytes
+
+        # nested tracking counts separately
+        with track_copies() as inner:
+            columns = RawBinarySource(tmp_path / 'x_f.bin', shape=(-1, 4), order='F')
+            assert np.array_equal(columns.column(1).read(0, 100), array[:100, 1])
+            assert inner.copies == 0
+            ArraySource(array, order='F')
+            ArraySource(array, copy=True)
+            assert inner.copies == 2
+        assert copies.copies == 1
+    assert 'copies' in str(copies)
+
+    # not tracking
+    rows.column(1).read(0, 100)
+    assert copies.copies == 1
+
+
+def test_mat_source(tmp_path, array):
+    """Uncompressed variables are mapped in place, and anything else is loaded"""
+    trace = np.arange(1000, dtype=np.int16)
+    savemat(tmp_path / 'x.mat', {'other': np.ones(3), 'frames': array, 'trace': trace})
+    savemat(tmp_path / 'x_z.mat', {'frames': array}, do_compression=True)
+    (tmp_path / 'x.mat.gz').write_bytes(gzip.compress((tmp_path / 'x.mat').read_bytes()))
+
+    offset, dtype, shape = find_mat_variable(tmp_path / 'x.mat', 'frames')
+    assert dtype == np.float64 and shape == array.shape
+    assert find_mat_variable(tmp_path / 'x.mat', 'nope') is None
+    assert find_mat_variable(tmp_path / 'x_z.mat', 'frames') is None
+
+    with track_copies() as copies:
+        frames = MatSource(tmp_path / 'x.mat', 'frames')
+        assert frames.mapped
+        assert np.array_equal(frames[:], array)
+        # matlab's column-major, so columns don't need copying
+        assert np.array_equal(frames.column(2).read(0, 1000), array[:1000, 2])
+        # squeezed from (1, n)
+        assert MatSource(tmp_path / 'x.mat', 'trace').shape == trace.shape
+        assert MatSource(tmp_path / 'x.mat', 'trace', squeeze=False).shape == (1, 1000)
+        assert copies.copies == 0
+
+        for path in ('x_z.mat', 'x.mat.gz'):
+            loaded = MatSource(tmp_path / path, 'frames')
+            assert not loaded.mapped
+            assert np.array_equal(loaded[:], array)
+        assert copies.copies == 2
+
+
+def test_chunk_iterator(tmp_path, array):
+    array.tofile(tmp_path / 'x.bin')
+    iterator = SourceChunkIterator(RawBinarySource(tmp_path / 'x.bin', shape=(-1, 4)), buffer_rows=1024)
+    assert iterator.recommended_chunk_shape() == (1024, 4)
+    assert iterator.maxshape == array.shape
+
+    written = np.zeros_like(array)
+    chunks = list(iterator)
+    for chunk in chunks:
+        written[chunk.selection] = chunk.data
+    assert len(chunks) == 5
+    assert np.array_equal(written, array)
@@ -0,0 +1,271 @@
+import gc
+import os
+import weakref
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tqdm')
+
+from onice_conversion.discovery import (DiscoveryCache, DiscoveryResult, Hit, close_instance, cluster_paths, discover,
+                                        path_pattern, score_attempt)
+
+
+class Interface(object):
+    """Opens its file every way an extractor might"""
+    instantiated = 0
+
+    def __init__(self, file_path:str):
+        Interface.instantiated += 1
+        self.file = open(file_path, 'rb')
+        self.memmap = np.memmap(file_path, dtype=np.int16, mode='r')
+        self.memmaps = [np.memmap(file_path, dtype=np.int16, mode='r', offset=2)]
+        self.n_channels = 4
+
+
+def test_close_instance(tmp_path):
+    """Files are closed, and memmaps let go of"""
+    np.arange(100, dtype=np.int16).tofile(tmp_path / 'x.dat')
+    instance = Interface(str(tmp_path / 'x.dat'))
+    file = instance.file
+    memmap = weakref.ref(instance.memmap)
+    in_list = weakref.ref(instance.memmaps[0])
+
+    close_instance(instance)
+    gc.collect()
+    assert file.closed
+    assert memmap() is None
+    assert in_list() is None
+    assert instance.memmap is None and instance.memmaps is None
+    assert instance.n_channels == 4
+
+
+def test_hit_iter(tmp_path):
+    """Unpacking a hit gives the instance it has, without making one"""
+    np.arange(100, dtype=np.int16).tofile(tmp_path / 'x.dat')
+    Interface.instantiated = 0
+
+    hit = Hit(Interface, 'x.dat', 'file_path', base_dir=tmp_path, cached=True)
+    interface, path, param, instance = hit
+    assert instance is None
+    assert Interface.instantiated == 0
+
+    made = hit.instance
+    assert tuple(hit)[3] is made
+    assert tuple(hit)[3] is made
+    assert Interface.instantiated == 1
+
+    file = made.file
+    hit.close()
+    assert file.closed
+    assert tuple(hit)[3] is None
+
+
+class DatInterface(object):
+    """Opens .dat files, counting how often it's tried"""
+    tried = 0
+
+    def __init__(self, file_path:str):
+        DatInterface.tried += 1
+        if not file_path.endswith('.dat'):
+            raise ValueError(f'not a .dat file: {file_path}')
+        self.file_path = file_path
+
+    @classmethod
+    def get_source_schema(cls) -> dict:
+        return {'required': ['file_path']}
+
+
+def test_cache_reused(tmp_path):
+    """Unchanged paths are answered by the cache in later runs, changed ones are tried again"""
+    data = tmp_path / 'data'
+    data.mkdir()
+    for i in range(3):
+        np.arange(10, dtype=np.int16).tofile(data / f'{i}.dat')
+    (data / 'notes.txt').write_text('nothing')
+    cache_path = tmp_path / 'cache.sqlite'
+
+    DatInterface.tried = 0
+    with DiscoveryCache(cache_path) as cache:
+        result = discover([DatInterface], data, cache=cache, progress=False)
+    assert sorted(str(hit.path) for hit in result) == ['0.dat', '1.dat', '2.dat']
+    assert result.cached == 0
+    assert DatInterface.tried == 5
+
+    # a new run, with one file grown and one touched
+    np.arange(20, dtype=np.int16).tofile(data / '1.dat')
+    stat = (data / '2.dat').stat()
+    os.utime(data / '2.dat', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    DatInterface.tried = 0
+    with DiscoveryCache(cache_path) as cache:
+        result = discover([DatInterface], data, cache=cache, progress=False)
+        assert cache.hit_stats(DatInterface, '.dat') == (3, 3)
+    assert sorted(str(hit.path) for hit in result) == ['0.dat', '1.dat', '2.dat']
+    assert result.cached == 3
+    assert DatInterface.tried == 2
+    assert all(hit.cached == (str(hit.path) == '0.dat') for hit in result)
+
+
+def test_cache_missing_paths(tmp_path):
+    """Paths that can't be stat'd are skipped, and forgotten by the cache"""
+    data = tmp_path / 'data'
+    data.mkdir()
+    np.arange(10, dtype=np.int16).tofile(data / 'gone.dat')
+    cache_path = tmp_path / 'cache.sqlite'
+    with DiscoveryCache(cache_path) as cache:
+        assert len(discover([DatInterface], data, cache=cache, progress=False)) == 1
+
+    (data / 'gone.dat').unlink()
+    (data / 'broken.dat').symlink_to(data / 'nowhere.dat')
+    with DiscoveryCache(cache_path) as cache:
+        assert len(discover([DatInterface], data, cache=cache, progress=False)) == 0
+        assert cache.lookup(DatInterface, data / 'broken.dat', 'file_path') is None
+        cache.invalidate(data / 'gone.dat')
+    with DiscoveryCache(cache_path) as cache:
+        assert cache.hit_stats(DatInterface, '.dat') == (0, 0)
+
+
+def _opener(name:str, interface_type:str='RecordingInterface') -> type:
+    """An interface class that opens any file"""
+    def __init__(self, file_path:str):
+        if not os.path.isfile(file_path):
+            raise ValueError(f'not a file: {file_path}')
+        self.file_path = file_path
+
+    return type(name, (object,), {'__init__': __init__, 'interface_type': interface_type, 'device_name': name,
+                                  'get_source_schema': classmethod(lambda cls: {'required': ['file_path']})})
+
+
+@pytest.fixture
+def recordings(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    for name in ('session.rhd', 'session_g0.bin', 'notes.txt'):
+        (data / name).write_bytes(b'\x00' * 16)
+    return data
+
+
+def test_score_attempt(recordings):
+    intan = _opener('IntanRecordingInterface')
+    assert score_attempt(intan, recordings / 'session.rhd', 'file_path', False) > \
+        score_attempt(intan, recordings / 'notes.txt', 'file_path', False) > \
+        score_attempt(intan, recordings, 'file_path', True)
+    assert score_attempt(intan, recordings, 'folder_path', True) > \
+        score_attempt(intan, recordings / 'notes.txt', 'folder_path', False)
+
+
+def test_ranked(recordings):
+    """The likeliest interface for each path is tried first, and the others skipped once it hits"""
+    intan, spikeglx = _opener('IntanRecordingInterface'), _opener('SpikeGLXRecordingInterface')
+
+    result = discover([spikeglx, intan], recordings, progress=False)
+    assert len(result) == 6 and result.complete
+
+    result = discover([spikeglx, intan], recordings, progress=False, ranked=True, max_hits_per_path=1)
+    assert {str(hit.path): hit.interface for hit in result} == \
+        {'session.rhd': intan, 'session_g0.bin': spikeglx, 'notes.txt': spikeglx}
+    # sorted by score, with the hinted extensions first
+    assert [str(hit.path) for hit in result][-1] == 'notes.txt'
+    assert result.attempts < 8
+
+    result = discover([spikeglx, intan], recordings, progress=False, ranked=True, max_hits_per_type=1)
+    assert len(result) == 1
+
+    result = discover([spikeglx, intan], recordings, progress=False, time_budget=-1)
+    assert len(result) == 0 and not result.complete
+
+
+def test_hail_mary(recordings, monkeypatch):
+    """hail_mary gives a DiscoveryResult of hits that still unpack like tuples"""
+    pytest.importorskip('nwb_conversion_tools')
+    from onice_conversion import nwbconverter
+
+    intan = _opener('IntanRecordingInterface')
+    monkeypatch.setattr(nwbconverter, 'list_interfaces', lambda interface_type=None: [intan])
+    monkeypatch.setattr(nwbconverter, '_monkeypatch_spikeextractors', lambda: None)
+
+    class Converter(nwbconverter.NWBConverter):
+        data_interface_classes = {}
+
+    result = Converter({}).hail_mary(recordings, cache=recordings.parent / 'cache.sqlite', probe=True)
+    assert isinstance(result, DiscoveryResult)
+    assert result.complete and result.attempts == 4 and result.cached == 0
+    interface, path, param, instance = sorted(result, key=lambda hit: str(hit.path))[0]
+    assert (interface, str(path), param, instance) == (intan, 'notes.txt', 'file_path', None)
+
+    result = Converter({}).hail_mary(recordings, cache=recordings.parent / 'cache.sqlite', probe=True)
+    assert result.cached == result.attempts
+
+
+def test_path_pattern(tmp_path):
+    """Digit runs are collapsed, except in extensions"""
+    (tmp_path / 'sub-01' / 'ses-2').mkdir(parents=True)
+    paths = [tmp_path / 'sub-01' / 'ses-2' / name for name in ('trial_0001.mat', 'trial_0002.mat', 'video.mp4')]
+    for path in paths:
+        path.write_bytes(b'')
+
+    assert path_pattern(paths[0], tmp_path) == 'sub-#/ses-#/trial_#.mat'
+    assert path_pattern(paths[2], tmp_path) == 'sub-#/ses-#/video.mp4'
+    assert path_pattern(tmp_path / 'sub-01', tmp_path) == 'sub-#/'
+    assert path_pattern(tmp_path, tmp_path) == '/'
+    assert cluster_paths(reversed(paths), tmp_path) == {'sub-#/ses-#/trial_#.mat': paths[:2],
+                                                        'sub-#/ses-#/video.mp4': paths[2:]}
+
+
+class SizedInterface(object):
+    """Opens 20-byte files, counting how often it's tried"""
+    tried = 0
+
+    def __init__(self, file_path:str):
+        SizedInterface.tried += 1
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) != 20:
+            raise ValueError(f'not 20 bytes: {file_path}')
+
+    @classmethod
+    def get_source_schema(cls) -> dict:
+        return {'required': ['file_path']}
+
+
+@pytest.fixture
+def trials(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    for i in range(20):
+        (data / f'trial_{i:02d}.bin').write_bytes(bytes(20))
+    (data / 'notes.txt').write_text('nothing')
+    return data
+
+
+def test_sample(trials):
+    """Only the representatives of each pattern are tried, and their hits spread to the rest"""
+    SizedInterface.tried = 0
+    result = discover([SizedInterface], trials, progress=False, sample=2)
+    assert result.clusters == 3
+    # base_dir, 2 trials, and the notes
+    assert SizedInterface.tried == result.attempts == 4
+    assert len(result) == 20 and result.extrapolated == 18
+    assert sorted(str(hit.path) for hit in result if not hit.extrapolated) == ['trial_00.bin', 'trial_10.bin']
+
+    # verifying every other member finds them all
+    SizedInterface.tried = 0
+    result = discover([SizedInterface], trials, progress=False, sample=2, verify=100)
+    assert SizedInterface.tried == 22
+    assert len(result) == 20 and result.extrapolated == 0
+
+
+@pytest.mark.parametrize('odd', ['trial_10.bin', 'trial_13.bin'])
+def test_sample_disagree(trials, odd):
+    """If the representatives disagree, or a verified member does, the whole pattern is tried"""
+    (trials / odd).write_bytes(bytes(10))
+    verify = 100 if odd == 'trial_13.bin' else 0
+
+    result = discover([SizedInterface], trials, progress=False, sample=2, verify=verify)
+    expected = [path.name for path in sorted(trials.glob('trial_*.bin')) if path.name != odd]
+    assert sorted(str(hit.path) for hit in result) == expected
+    assert result.extrapolated == 0
+
+    # without verifying, the odd one out isn't noticed
+    if verify:
+        result = discover([SizedInterface], trials, progress=False, sample=2)
+        assert len(result) == 20 and result.extrapolated == 18
@@ -0,0 +1,78 @@
+import time
+from pathlib import Path
+
+import pytest
+
+from onice_conversion.batch import Session
+from onice_conversion.jobqueue import JobQueue
+
+
+def _sessions(tmp_path, n):
+    return [Session(f'session{i}', 'onice_conversion.nwbconverter:NWBConverter', {},
+                    nwbfile_path=tmp_path / f'session{i}.nwb') for i in range(n)]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    with JobQueue(tmp_path / 'queue.db', stale_after=60, max_attempts=2) as queue:
+        yield queue
+
+
+def test_claim(tmp_path, queue):
+    assert queue.add(_sessions(tmp_path, 3)) == 3
+    # already there, skipped
+    assert queue.add(_sessions(tmp_path, 3)) == 0
+
+    # another connection, as another worker would have
+    with JobQueue(queue.path) as other:
+        claimed = {queue.claim('a').name, other.claim('b').name, queue.claim('a').name}
+        assert other.claim('b') is None
+    assert claimed == {'session0', 'session1', 'session2'}
+    assert queue.status() == {'pending': 0, 'running': 3, 'done': 0, 'failed': 0}
+
+
+def test_requeue(tmp_path, queue):
+    queue.add(_sessions(tmp_path, 1))
+    assert queue.claim('a').name == 'session0'
+    assert queue.heartbeat('session0', 'a')
+
+    # a's heartbeat goes stale, so b takes over, and a finds out it lost its claim
+    queue.stale_after = -1
+    assert queue.claim('b').name == 'session0'
+    assert not queue.heartbeat('session0', 'a')
+    queue.finish('session0', 'a', 1.)
+    assert queue.jobs()[0]['worker'] == 'b'
+
+    # out of attempts
+    assert queue.claim('c') is None
+    assert queue.jobs()[0]['status'] == 'failed'
+    assert queue.retry() == 1
+    queue.stale_after = 60
+    assert queue.claim('c').name == 'session0'
+
+    # failures are requeued while there are attempts left
+    queue.finish('session0', 'c', 1., error='oops')
+    assert queue.jobs()[0]['status'] == 'pending'
+
+
+def test_work(tmp_path, queue, monkeypatch):
+    """Files are only moved into place by workers that still hold their session's claim"""
+    def run(session):
+        Path(session.nwbfile_path).write_text(session.name)
+        if session.name == 'session1':
+            # requeued out from under us
+            with JobQueue(queue.path) as other:
+                other.stale_after = -1
+                assert other.claim('other').name == 'session1'
+        return 0.
+
+    monkeypatch.setattr(Session, 'run', run)
+    queue.add(_sessions(tmp_path, 2))
+    results = queue.work('a')
+
+    assert results['session0'][1] is None
+    assert (tmp_path / 'session0.nwb').read_text() == 'session0'
+    assert 'lost our claim' in results['session1'][1]
+    assert not (tmp_path / 'session1.nwb').exists()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['queue.db', 'session0.nwb']
+    assert {job['name']: job['worker'] for job in queue.jobs(status='running')} == {'session1': 'other'}
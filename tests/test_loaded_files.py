@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from onice_conversion.spec.external_file import LoadedFileCache
+from onice_conversion.spec.shared import SharedFileCache
+
+
+def _load(path):
+    return {'path': str(path), 'array': np.arange(100000, dtype=np.float64)}
+
+
+def test_bounds():
+    cache = LoadedFileCache(max_items=2)
+    for i in range(3):
+        cache[i] = _load(i)
+    assert list(cache) == [1, 2]
+    # using one makes it the most recent
+    cache[1]
+    cache.max_bytes = cache.total_bytes // 2 + 1
+    assert list(cache) == [1]
+    # too big to cache at all
+    cache[3] = {'array': np.zeros(300000)}
+    assert 3 not in cache
+
+
+def test_shared(tmp_path):
+    paths = [tmp_path / f'{i}.mat' for i in range(3)]
+    for path in paths:
+        path.write_bytes(b'x')
+
+    with SharedFileCache() as shared:
+        cache = LoadedFileCache(max_items=2)
+        cache.shared = shared
+
+        loaded = cache.load_shared('0', paths[0], _load)
+        assert not loaded['array'].flags.writeable
+        assert np.array_equal(loaded['array'], np.arange(100000))
+        # held by the shared cache, not ours
+        assert cache.total_bytes == 0
+        assert shared.total_bytes == loaded['array'].nbytes
+
+        cache.load_shared('1', paths[1], _load)
+        cache.load_shared('2', paths[2], _load)
+        # evicting the first one lets go of it, and it was the only user so it's unlinked
+        assert list(cache) == ['1', '2']
+        assert len(shared.attached) == 2
+        assert shared.total_bytes == 2 * loaded['array'].nbytes
+
+        del cache['1']
+        assert len(shared.attached) == 1
+
+        # replacing a shared file with a private one lets go of it too
+        cache['2'] = _load(paths[2])
+        assert len(shared.attached) == 0
+        assert shared.total_bytes == 0
+        assert cache.total_bytes > 0
@@ -0,0 +1,62 @@
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from onice_conversion.memory import RSSMonitor, parse_size
+from onice_conversion.utils import MemoryBudgetError
+
+
+def test_parse_size():
+    assert parse_size('4 GB') == 4 * 1000**3
+    assert parse_size('512MiB') == 512 * 1024**2
+    assert parse_size(100) == 100
+    with pytest.raises(ValueError):
+        parse_size('four gigs')
+
+
+def test_monitor_check():
+    """Going over the budget is raised by check, in the calling thread, and not before"""
+    with RSSMonitor(budget=1, interval=0.01) as monitor:
+        time.sleep(0.1)
+        with pytest.raises(MemoryBudgetError):
+            monitor.check()
+    assert monitor.exceeded
+
+    with RSSMonitor(budget=parse_size('1 TB'), interval=0.01) as monitor:
+        time.sleep(0.1)
+        monitor.check()
+    assert monitor.peak > 0
+
+
+def test_pipeline_check(tmp_path):
+    """A pipeline stops between blocks when its check raises"""
+    pynwb = pytest.importorskip('pynwb')
+    from onice_conversion.pipeline import PipelinedWriter
+
+    pipeline = PipelinedWriter(n_readers=2)
+    nwbfile = pynwb.NWBFile(session_description='test', identifier='test',
+                            session_start_time=datetime.now(timezone.utc))
+    nwbfile.add_acquisition(pynwb.TimeSeries(
+        name='x', data=pipeline.add_stream('x', np.zeros((100000, 4)), chunks=(1000, 4)), unit='V', rate=1.))
+
+    with RSSMonitor(budget=1, interval=0.01) as monitor:
+        time.sleep(0.1)
+        with pytest.raises(MemoryBudgetError):
+            pipeline.write(nwbfile, tmp_path / 'x.nwb', check=monitor.check)
+
+
+def test_budget_error_report():
+    """The memory report goes along with the error, and in its message"""
+    from onice_conversion.memory import MemoryReport
+
+    report = MemoryReport(budget=parse_size('1 GB'), baseline=parse_size('100 MB'))
+    report.peak = parse_size('2 GB')
+    report.problems.append('x needs ~2 GB and cannot write in chunks')
+
+    error = MemoryBudgetError('Conversion exceeded the memory budget:', report=report)
+    assert isinstance(error, MemoryError)
+    assert error.report is report
+    assert str(error).splitlines()[1:] == str(report).splitlines()
+    assert MemoryBudgetError('over').report is None
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from onice_conversion.spec.merge import merge
+from onice_conversion.utils import MergeConflictError
+
+FIRST = {'Subject': {'subject_id': 'jonny', 'sex': 'M'},
+         'NWBFile': {'keywords': ['smell', 'sniff'], 'data': np.arange(3)}}
+SECOND = {'Subject': {'subject_id': 'jony', 'age': 'P30D'},
+          'NWBFile': {'keywords': ['sniff', 'nose'], 'data': np.arange(3)}}
+
+
+@pytest.mark.parametrize('policy,subject_id', [('last', 'jony'), ('first', 'jonny')])
+def test_policies(policy, subject_id):
+    merged = merge([('a', FIRST), ('b', SECOND)], policy=policy)
+    assert merged['Subject'] == {'subject_id': subject_id, 'sex': 'M', 'age': 'P30D'}
+    # lists are appended, without repeats, and the specs' own lists are left alone
+    assert merged['NWBFile']['keywords'] == ['smell', 'sniff', 'nose']
+    assert FIRST['NWBFile']['keywords'] == ['smell', 'sniff']
+
+    assert merged.sources[('Subject', 'sex')] == 'a'
+    assert merged.sources[('Subject', 'age')] == 'b'
+    assert merged.sources[('NWBFile', 'keywords')] == 'b'
+    assert [conflict.path for conflict in merged.conflicts] == [('Subject', 'subject_id')]
+    assert merged.conflicts[0].value == subject_id
+
+
+def test_replace():
+    merged = merge([('a', FIRST), ('b', SECOND)], policy='replace')
+    assert merged['Subject']['subject_id'] == 'jony'
+    assert merged['NWBFile']['keywords'] == ['sniff', 'nose']
+    assert len(merged.conflicts) == 2
+
+
+def test_error():
+    with pytest.raises(MergeConflictError):
+        merge([('a', FIRST), ('b', SECOND)], policy='error')
+    # equal values and lists don't conflict
+    merged = merge([('a', FIRST), ('b', {'Subject': {'sex': 'M'}, 'NWBFile': {'keywords': ['nose']}})],
+                   policy='error')
+    assert merged['NWBFile']['keywords'] == ['smell', 'sniff', 'nose']
+
+
+def test_dict_replaces_value():
+    merged = merge([('a', {'x': 1}), ('b', {'x': {'y': 2}})])
+    assert merged == {'x': {'y': 2}}
+    assert merged.sources == {('x', 'y'): 'b'}
+
+
+def test_list_items_hashed():
+    """Lists of unhashable items (dicts, arrays) are appended to without repeats"""
+    first = {'electrodes': [{'id': 0, 'location': 'OB'}, np.arange(3)]}
+    second = {'electrodes': [{'id': 0, 'location': 'OB'}, {'id': 1, 'location': 'OB'}, np.arange(3), np.arange(4)]}
+    merged = merge([('a', first), ('b', second)], policy='error')
+    assert len(merged['electrodes']) == 4
+    assert merged['electrodes'][2] == {'id': 1, 'location': 'OB'}
+    assert np.array_equal(merged['electrodes'][3], np.arange(4))
+
+
+def test_value_replaces_dict():
+    """Replacing a dict drops only the sources beneath it"""
+    merged = merge([('a', {'x': {'y': {'z': 1}, 'w': 2}, 'xy': 3}), ('b', {'x': 4})])
+    assert merged == {'x': 4, 'xy': 3}
+    assert merged.sources == {('x',): 'b', ('xy',): 'a'}
@@ -0,0 +1,140 @@
+import os
+from fnmatch import fnmatchcase
+
+import pytest
+
+from onice_conversion.spec.path import Glob, GlobTemplate, Paths, bounded_glob
+
+
+def test_template_keys():
+    template = GlobTemplate('sub-{subject_id}/{subject_id}_{session_id:03d}_*.bin')
+    assert template.glob == 'sub-*/*_*_*.bin'
+    assert template.key({'subject_id': 'a_b', 'session_id': 1}) == ('a_b', '001')
+    assert template.keys('sub-a_b/a_b_001_x.bin') == {('a_b', '001')}
+    # underscores could be in either field, or the wildcard
+    assert GlobTemplate('{subject_id}_{session_id}_*.bin').keys('a_b_c_1.bin') == \
+        {('a', 'b'), ('a', 'b_c'), ('a_b', 'c')}
+    assert template.keys('sub-a/b_001_x.bin') == set()
+    assert template.keys('sub-a_b/a_b_001.bin') == set()
+
+
+@pytest.mark.parametrize('subject_id,session_id', [('a_b', 'c'), ('a', 'b_c'), ('a', 'b')])
+def test_indexed_agrees(tmp_path, subject_id, session_id):
+    """Indexed and unindexed globs find the same files when field values contain the separators"""
+    (tmp_path / 'a_b_c_1.bin').touch()
+    (tmp_path / 'a_b_d_1.bin').touch()
+    metadata = {'subject_id': subject_id, 'session_id': session_id}
+
+    results = []
+    for indexed in (False, True):
+        spec = Glob('data', '{subject_id}_{session_id}_*.bin', indexed=indexed)
+        try:
+            results.append(spec._parse(tmp_path, metadata))
+        except Exception as e:
+            results.append(type(e))
+    assert results[0] == results[1]
+    if session_id == 'b':
+        # both files
+        assert results[0].__name__ == 'AmbiguityError'
+    else:
+        assert results[0] == {'data': str(tmp_path / 'a_b_c_1.bin')}
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for path in ('notebook.mat', 'a/notebook.mat', 'a/b/notebook.mat', 'a/b/c/notebook.mat',
+                 'a/x.txt', 'a/b/y.txt', 'b/x.txt', 'b/.hidden.txt', 'raw/data.continuous/notebook.mat',
+                 'raw/sub/x.json'):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).touch()
+    return tmp_path
+
+
+@pytest.mark.parametrize('pattern', ['*.mat', '**/notebook.mat', '**/*.txt', 'a/*/notebook.mat', '*/x.txt',
+                                     '[ab]/*.txt', 'a/**', '**', 'raw/**/x.*', '**/b/**/*.mat', 'nope/*', 'a/b'])
+def test_bounded_glob(tree, pattern):
+    """Finds the same paths as pathlib, limited to max_depth and skipping exclude"""
+    assert sorted(bounded_glob(tree, pattern)) == sorted(tree.glob(pattern))
+
+    for max_depth in (1, 2, 3):
+        assert sorted(bounded_glob(tree, pattern, max_depth=max_depth)) == \
+            sorted(path for path in tree.glob(pattern) if len(path.relative_to(tree).parts) <= max_depth)
+
+    exclude = ['b', '*.continuous']
+    assert sorted(bounded_glob(tree, pattern, exclude=exclude)) == \
+        sorted(path for path in tree.glob(pattern)
+               if not any(fnmatchcase(part, excluded) for part in path.relative_to(tree).parts for excluded in exclude))
+
+
+def test_index_invalidated(tmp_path):
+    """An index is reused until a directory it was built from changes"""
+    (tmp_path / 'sub-a').mkdir()
+    (tmp_path / 'sub-a' / 'a_001_x.bin').touch()
+    spec = Glob('data', 'sub-{subject_id}/{subject_id}_{session_id}_*.bin', indexed=True)
+    index = spec.index(tmp_path)
+    assert spec.index(tmp_path) is index
+
+    def touched(directory):
+        # don't rely on the filesystem's mtime resolution
+        stat = directory.stat()
+        os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    # a new session in an existing subject's folder
+    (tmp_path / 'sub-a' / 'a_002_x.bin').touch()
+    touched(tmp_path / 'sub-a')
+    assert spec._parse(tmp_path, {'subject_id': 'a', 'session_id': '002'}) == \
+        {'data': str(tmp_path / 'sub-a' / 'a_002_x.bin')}
+
+    # a new subject
+    (tmp_path / 'sub-b').mkdir()
+    (tmp_path / 'sub-b' / 'b_001_x.bin').touch()
+    touched(tmp_path)
+    assert spec._parse(tmp_path, {'subject_id': 'b', 'session_id': '001'}) == \
+        {'data': str(tmp_path / 'sub-b' / 'b_001_x.bin')}
+
+    (tmp_path / 'sub-a' / 'a_001_x.bin').unlink()
+    touched(tmp_path / 'sub-a')
+    with pytest.raises(FileNotFoundError):
+        spec._parse(tmp_path, {'subject_id': 'a', 'session_id': '001'})
+
+
+@pytest.fixture
+def trials(tmp_path):
+    for subject, session, trial in (('jonny', '001', 1), ('jonny', '001', 2), ('jonny', '002', 1), ('tina', '001', 10)):
+        (tmp_path / subject / session).mkdir(parents=True, exist_ok=True)
+        (tmp_path / subject / session / f'trial_{trial}.mat').touch()
+    (tmp_path / 'jonny' / '001' / 'notes.txt').touch()
+    return tmp_path
+
+
+@pytest.mark.parametrize('as_dataframe', [True, False])
+def test_paths_table(trials, as_dataframe):
+    """One row per matched path, keeping each path's values together"""
+    table = Paths('{Subject[subject_id]}/{session_id}/trial_{trial:d}.mat').table(trials, as_dataframe=as_dataframe)
+    if as_dataframe:
+        assert list(table.columns) == ['Subject[subject_id]', 'session_id', 'trial', 'path']
+        rows = [tuple(row) for row in table.itertuples(index=False)]
+    else:
+        assert table.dtype.names == ('Subject[subject_id]', 'session_id', 'trial', 'path')
+        assert table['trial'].dtype.kind == 'i'
+        rows = table.tolist()
+    assert rows == [('jonny', '001', 1, 'jonny/001/trial_1.mat'),
+                    ('jonny', '001', 2, 'jonny/001/trial_2.mat'),
+                    ('jonny', '002', 1, 'jonny/002/trial_1.mat'),
+                    ('tina', '001', 10, 'tina/001/trial_10.mat')]
+
+    with pytest.raises(ValueError, match='path'):
+        Paths('{subject_id}/{path}').table(trials)
+
+
+def test_template_index(trials):
+    """Paths are grouped by their fields' values, formatted the way the metadata would be"""
+    template = GlobTemplate('{subject_id}/{session_id:03d}/trial_*.mat')
+    index = template.index(trials)
+    assert sorted(index) == [('jonny', '001'), ('jonny', '002'), ('tina', '001')]
+    assert sorted(index[template.key({'subject_id': 'jonny', 'session_id': 1})]) == \
+        [str(trials / 'jonny' / '001' / f'trial_{trial}.mat') for trial in (1, 2)]
+
+    dirs = GlobTemplate('{subject_id}/{session_id}').index(trials, only_dirs=True)
+    assert dirs[('jonny', '002')] == [str(trials / 'jonny' / '002')]
+    assert GlobTemplate('{subject_id}/{session_id}/*').index(trials, only_dirs=True) == {}
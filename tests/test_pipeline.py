@@ -0,0 +1,43 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+pynwb = pytest.importorskip('pynwb')
+
+from onice_conversion.pipeline import PipelinedWriter
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'lzf', None])
+def test_compression(tmp_path, compression):
+    array = np.arange(400000, dtype=np.int16).reshape(-1, 4)
+    pipeline = PipelinedWriter(n_readers=2, checksums=True)
+    nwbfile = pynwb.NWBFile(session_description='test', identifier='test',
+                            session_start_time=datetime.now(timezone.utc))
+    nwbfile.add_acquisition(pynwb.TimeSeries(
+        name='x', data=pipeline.add_stream('x', array, chunks=(10000, 4), compression=compression),
+        unit='V', rate=1.))
+    pipeline.write(nwbfile, tmp_path / 'x.nwb')
+
+    with pynwb.NWBHDF5IO(str(tmp_path / 'x.nwb'), 'r') as io:
+        data = io.read().acquisition['x'].data
+        assert data.compression == compression
+        assert np.array_equal(data[:], array)
+    assert pipeline.verify(tmp_path / 'x.nwb').ok
+
+
+def test_write_twice(tmp_path):
+    """A pipeline fills only the streams added since its last write"""
+    pipeline = PipelinedWriter(n_readers=2, checksums=True)
+    for i in range(2):
+        array = np.arange(40000, dtype=np.int16).reshape(-1, 4) * (i + 1)
+        nwbfile = pynwb.NWBFile(session_description='test', identifier=str(i),
+                                session_start_time=datetime.now(timezone.utc))
+        nwbfile.add_acquisition(pynwb.TimeSeries(
+            name='x', data=pipeline.add_stream('x', array, chunks=(1000, 4)), unit='V', rate=1.))
+        pipeline.write(nwbfile, tmp_path / f'{i}.nwb')
+        assert pipeline.streams == []
+        assert pipeline.verify(tmp_path / f'{i}.nwb').ok
+
+        with pynwb.NWBHDF5IO(str(tmp_path / f'{i}.nwb'), 'r') as io:
+            assert np.array_equal(io.read().acquisition['x'].data[:], array)
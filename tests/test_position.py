@@ -0,0 +1,88 @@
+from datetime import datetime, timezone
+
+import h5py
+import numpy as np
+import pytest
+
+pynwb = pytest.importorskip('pynwb')
+pytest.importorskip('nwb_conversion_tools')
+
+from onice_conversion.interfaces.position import PositionInterface, add_keypoints
+
+KEYPOINTS = ['nose', 'head', 'body']
+
+
+def _nwbfile() -> pynwb.NWBFile:
+    return pynwb.NWBFile(session_description='test', identifier='test',
+                         session_start_time=datetime.now(timezone.utc))
+
+
+@pytest.fixture
+def tracking():
+    rng = np.random.default_rng(0)
+    data = rng.uniform(0, 640, (500, len(KEYPOINTS), 2))
+    # dropped frames, so not regular
+    timestamps = np.cumsum(rng.choice([1 / 30, 2 / 30], 500))
+    return data, timestamps
+
+
+def test_linked(tmp_path, tracking):
+    """The first series stores the timestamps, and the rest link to them"""
+    data, timestamps = tracking
+    nwbfile = _nwbfile()
+    add_keypoints(nwbfile, data, timestamps, KEYPOINTS)
+    with pynwb.NWBHDF5IO(str(tmp_path / 'x.nwb'), 'w') as io:
+        io.write(nwbfile)
+
+    with pynwb.NWBHDF5IO(str(tmp_path / 'x.nwb'), 'r') as io:
+        position = io.read().processing['behavior']['Position']
+        for i, keypoint in enumerate(KEYPOINTS):
+            assert np.array_equal(position[keypoint].data[:], data[:, i, :])
+            assert np.array_equal(position[keypoint].timestamps[:], timestamps)
+
+    with h5py.File(tmp_path / 'x.nwb', 'r') as f:
+        group = f['processing/behavior/Position']
+        assert all(group[f'{keypoint}/timestamps'] == group['nose/timestamps'] for keypoint in KEYPOINTS[1:])
+
+
+def test_single(tracking):
+    """One series, with an x and y column for each keypoint"""
+    data, timestamps = tracking
+    nwbfile = _nwbfile()
+    container = add_keypoints(nwbfile, data, timestamps, KEYPOINTS, layout='single', reference_frame='top left')
+    series = container.time_series['keypoints']
+    assert series.data.shape == (500, 6)
+    assert np.array_equal(series.data[:, 2:4], data[:, 1, :])
+    assert series.description == 'reference frame: top left. columns: nose_x, nose_y, head_x, head_y, body_x, body_y'
+    assert np.array_equal(series.timestamps, timestamps)
+
+
+@pytest.mark.parametrize('layout', ['linked', 'single'])
+def test_regular(tracking, layout):
+    """Regular frames are written as a starting time and rate, without timestamps"""
+    data, _ = tracking
+    container = add_keypoints(_nwbfile(), data, 10 + np.arange(500) / 30, KEYPOINTS, layout=layout)
+    series = list(container.spatial_series.values() if layout == 'linked' else container.time_series.values())
+    assert len(series) == (3 if layout == 'linked' else 1)
+    for one in series:
+        assert one.timestamps is None
+        assert one.rate == pytest.approx(30)
+        assert one.starting_time == pytest.approx(10)
+
+
+def test_interface(tmp_path, tracking):
+    data, timestamps = tracking
+    table = np.column_stack([data.reshape(500, -1), timestamps * 1000])
+    np.savetxt(tmp_path / 'frames.txt', table, delimiter=',')
+
+    interface = PositionInterface(str(tmp_path / 'frames.txt'), KEYPOINTS, timestamps_scale=1e-3)
+    assert np.allclose(interface.data, data)
+    assert np.allclose(interface.timestamps, timestamps)
+
+    # not enough columns for the keypoints, or the timestamps
+    with pytest.raises(ValueError, match='columns'):
+        PositionInterface(str(tmp_path / 'frames.txt'), KEYPOINTS + ['tail', 'paw'])
+    with pytest.raises(ValueError, match='columns'):
+        PositionInterface(str(tmp_path / 'frames.txt'), KEYPOINTS, timestamps_column=7)
+    with pytest.raises(ValueError, match='keypoint column'):
+        PositionInterface(str(tmp_path / 'frames.txt'), KEYPOINTS, keypoint_columns=[0, 2])
@@ -0,0 +1,71 @@
+import json
+import subprocess
+import sys
+import time
+
+import pytest
+
+from onice_conversion.__main__ import main
+from onice_conversion.service import Service, request, submit
+
+
+@pytest.fixture
+def service(tmp_path):
+    """A service with two workers, run the way the CLI would"""
+    socket_path = tmp_path / 'onice.sock'
+    process = subprocess.Popen([sys.executable, '-m', 'onice_conversion', 'serve', str(socket_path),
+                                '--workers', '2', '--max-requests', '2'],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while not socket_path.exists():
+        if process.poll() is not None or time.time() > deadline:
+            process.kill()
+            pytest.fail('service did not start:\n' + process.stdout.read().decode())
+        time.sleep(0.1)
+    yield socket_path, process
+    if process.poll() is None:
+        process.terminate()
+    process.wait(10)
+
+
+def test_handle():
+    service = Service('unused.sock')
+    assert service.handle({'command': 'ping'}) == {'ok': True}
+    assert not service.handle({'command': 'nope'})['ok']
+
+    response = service.handle({'command': 'convert', 'session': {
+        'name': 'broken', 'converter': 'onice_conversion.nope:Converter',
+        'source_data': {}, 'nwbfile_path': 'broken.nwb'}})
+    assert not response['ok']
+    assert response['name'] == 'broken'
+    assert 'ModuleNotFoundError' in response['error']
+
+
+def test_serve(service, tmp_path, capsys):
+    """Requests are answered by the workers, which are replaced after max_requests, until we stop it"""
+    socket_path, process = service
+    workers = {request(socket_path, {'command': 'ping'}, timeout=10)['worker'] for _ in range(6)}
+    # 6 requests can't all be handled by the first 2 workers
+    assert len(workers) > 2
+
+    session = {'name': 'broken', 'converter': 'onice_conversion.nope:Converter',
+               'source_data': {}, 'nwbfile_path': str(tmp_path / 'broken.nwb')}
+    responses = submit(socket_path, [session, dict(session, name='broken2')], n_jobs=2, timeout=30)
+    assert [response['name'] for response in responses] == ['broken', 'broken2']
+    assert not any(response['ok'] for response in responses)
+
+    (tmp_path / 'session.json').write_text(json.dumps(session))
+    assert main(['submit', str(socket_path), str(tmp_path / 'session.json')]) == 1
+    assert 'broken failed' in capsys.readouterr().out
+
+    assert main(['submit', str(socket_path), '--stop', '--timeout', '10']) is None
+    assert process.wait(30) == 0
+    assert not socket_path.exists()
+
+
+def test_submit_args(tmp_path):
+    """submit needs either sessions or --stop, not both"""
+    with pytest.raises(SystemExit):
+        main(['submit', str(tmp_path / 'onice.sock')])
+    with pytest.raises(SystemExit):
+        main(['submit', str(tmp_path / 'onice.sock'), 'session.json', '--stop'])
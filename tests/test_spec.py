@@ -0,0 +1,124 @@
+import gzip
+import json
+import re
+from datetime import datetime
+
+import numpy as np
+import pytest
+from scipy.io import savemat
+
+from onice_conversion.spec import JSON, Mat, Path, SpecSet, Text, from_dict
+from onice_conversion.spec.external_file import TEXT_BLOCK
+
+
+def test_chain_flat(tmp_path):
+    """Chained specs, and the chains added to them, end up in one flat SpecSet in order"""
+    (tmp_path / 'jonny' / '001').mkdir(parents=True)
+    (tmp_path / 'notes.json').write_text(json.dumps({'weight': 20, 'sex': 'M', 'age': 'P30D'}))
+    weight = JSON(path='notes.json', key='weight', field='weight')
+    sex = JSON(path='notes.json', key='sex', field='sex')
+    age = JSON(path='notes.json', key='age', field='age')
+    subject = Path('{subject_id}/{session_id}')
+
+    chain = weight + (sex + age) + subject
+    assert list(chain.children()) == [sex, age, subject]
+    assert all(spec.parent is weight for spec in chain.children())
+    assert chain.specifies == ('weight', 'sex', 'age', 'subject_id', 'session_id')
+
+    specs = SpecSet([chain])
+    assert list(specs) == [weight, sex, age, subject]
+    assert specs.by_field('sex') == (sex,)
+    assert specs.by_field('nope') == ()
+
+    other = SpecSet([JSON(path='notes.json', key='weight', field='sex')])
+    specs += other
+    assert len(specs) == 5
+    assert specs.by_field('weight') == (weight, other[0])
+
+    # chains survive a round trip
+    assert [type(spec) for spec in from_dict(chain.to_dict()).children()] == [JSON, JSON, Path]
+    rebuilt = from_dict(specs.to_dict())
+    assert isinstance(rebuilt, SpecSet)
+    assert rebuilt.specifies == specs.specifies
+    assert rebuilt.parse(tmp_path, policy='first') == \
+        {'weight': 20, 'sex': 'M', 'age': 'P30D', 'subject_id': 'jonny', 'session_id': '001'}
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_text_block_boundary(tmp_path, compressed):
+    """A line that straddles the end of a block is found whole, compressed or not"""
+    line = b'weight: 20.5 g, and a long enough line to straddle the block\n'
+    filler = b'nothing to see here\n' * ((TEXT_BLOCK - len(line) // 2) // 20)
+    filler += b'.' * (TEXT_BLOCK - len(line) // 2 - len(filler) - 1) + b'\n'
+    data = filler + line + b'date: 2021-04-01 12:00:00\n' + b'more nothing\n' * 1000
+    assert len(filler) < TEXT_BLOCK < len(filler) + len(line)
+
+    name = 'notes.txt'
+    if compressed:
+        name += '.gz'
+        data = gzip.compress(data, 1)
+    (tmp_path / name).write_bytes(data)
+
+    patterns = {'weight': re.compile(r'weight: ([\d.]+) g'), 'date': 'date: {}'}
+    spec = Text(path=name, fields={'Subject[weight]': 'weight', 'session_start_time': 'date'},
+                patterns=patterns, datetimes=['date'], cache=False)
+    assert spec.parse(tmp_path) == {'Subject': {'weight': '20.5'},
+                                    'session_start_time': datetime(2021, 4, 1, 12)}
+
+
+def test_text_missing(tmp_path):
+    """A pattern that matches no line is an error that says which, and where"""
+    (tmp_path / 'notes.txt').write_text('weight: 20.5 g\n')
+    spec = Text(path='notes.txt', key='age', field='age', patterns={'age': 'age: {}'}, cache=False)
+    with pytest.raises(ValueError, match=r"notes\.txt.*age: \{\}"):
+        spec.parse(tmp_path)
+
+
+class CountingDict(dict):
+    """Counts how often its items are selected"""
+    lookups = 0
+
+    def __getitem__(self, item):
+        CountingDict.lookups += 1
+        return super(CountingDict, self).__getitem__(item)
+
+
+def test_fields(tmp_path):
+    """Many fields from one file, walking their shared prefixes once"""
+    notes = {'sessionInfo': {'animal': {'weight': 20, 'sex': 'M'}, 'description': 'running'}}
+    (tmp_path / 'notes.json').write_text(json.dumps(notes))
+    fields = {
+        'Subject[weight]': ('sessionInfo', 'animal', 'weight'),
+        'Subject[sex]': ('sessionInfo', 'animal', 'sex'),
+        'NWBFile[session_description]': ('sessionInfo', 'description')
+    }
+    expected = {'Subject': {'weight': 20, 'sex': 'M'}, 'NWBFile': {'session_description': 'running'}}
+
+    CountingDict.lookups = 0
+    spec = JSON(path='notes.json', fields=fields, hook=CountingDict, cache=False)
+    assert spec.specifies == tuple(fields)
+    assert spec.parse(tmp_path) == expected
+    # sessionInfo, animal, weight, sex, description
+    assert CountingDict.lookups == 5
+
+    savemat(tmp_path / 'notes.mat', notes)
+    spec = Mat(path='notes.mat', fields=fields, cache=False)
+    assert spec.parse(tmp_path) == expected
+
+    with pytest.raises(ValueError, match='not both'):
+        JSON(path='notes.json', key='weight', field='weight', fields=fields)
+    with pytest.raises(ValueError, match='Need either'):
+        JSON(path='notes.json', key='weight')
+
+
+def test_init_args(tmp_path):
+    """Args from every layer of __init__ are kept, so specs survive a round trip"""
+    savemat(tmp_path / 'notes.mat', {'weight': np.array([[20]])})
+    spec = Mat(path='notes.mat', fields={'Subject[weight]': 'weight'}, simplified=False, cache=False)
+    assert spec.to_dict()['kwargs'] == {'retype': None, 'path': 'notes.mat', 'key': None, 'field': None,
+                                        'cache': False, 'fields': {'Subject[weight]': 'weight'},
+                                        'max_depth': None, 'exclude': None, 'simplified': False}
+
+    rebuilt = from_dict(spec.to_dict())
+    assert type(rebuilt) is Mat and not rebuilt.simplified
+    assert rebuilt.parse(tmp_path) == {'Subject': {'weight': 20}}
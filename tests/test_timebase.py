@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from onice_conversion.timebase import TimeBase, pair_pulses
+
+
+def test_pair_pulses_missing():
+    """Pulses missing from both ends of one clock are paired with the right ones on the other"""
+    common = np.array([0., 1., 2.5, 3.1, 4.8])
+    # drifting and offset clock that only caught the middle three
+    local = 10 + common[1:4] * 1.001
+
+    paired_local, paired_common = pair_pulses(local, common)
+    assert np.array_equal(paired_local, local)
+    assert np.array_equal(paired_common, common[1:4])
+
+
+def test_pair_pulses_too_few():
+    with pytest.raises(ValueError):
+        pair_pulses(np.array([1., 2.]), np.array([0., 1., 2.5, 3.1, 4.8]))
+
+
+def test_scale_rate():
+    """scale applies to starting_time, but the rate is always in Hz"""
+    timebase = TimeBase()
+    timebase.add('sniff', rate=800., starting_time=500., n_samples=800, scale=1e-3)
+    kwargs = timebase.time_kwargs('sniff')
+    assert kwargs['starting_time'] == pytest.approx(0.5)
+    assert kwargs['rate'] == pytest.approx(800.)
+    assert np.array_equal(timebase.nearest('sniff', [0.5, 0.5 + 100 / 800.]), [0, 100])
+
+
+def test_sync():
+    timebase = TimeBase()
+    # irregular, or every shift would match
+    pulses = np.cumsum(np.random.default_rng(0).uniform(5, 9, 15))
+    timebase.add('frames', timestamps=np.arange(0, 100000, 10.), sync=pulses * 1000, scale=1e-3)
+    timebase.add('sniff', rate=800., n_samples=80000, sync=pulses[2:-1] * 1.01 + 3)
+
+    assert timebase.reference == 'frames'
+    assert np.allclose(timebase.timestamps('sniff', 0, 2), [-3 / 1.01, (1 / 800. - 3) / 1.01])
+    assert timebase.time_kwargs('sniff')['rate'] == pytest.approx(800 * 1.01)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from onice_conversion.utils import AmbiguityError, IntrospectionMixin, _dedupe, _gather_list_of_dicts, _recursive_dedupe_dicts, _sizeof
+
+
+def test_gather():
+    assert _gather_list_of_dicts([{'a': 1, 'b': 2}, {'a': 3}]) == {'a': [1, 3], 'b': [2]}
+
+
+def test_dedupe_order():
+    """The first of each value is kept, in order, whether or not it's hashable"""
+    assert _dedupe([3, 1, 3, 2, 1]) == [3, 1, 2]
+    assert _dedupe([{'x': [1, 2]}, {'x': [1, 2]}, {'x': [2, 1]}]) == [{'x': [1, 2]}, {'x': [2, 1]}]
+    # lists and tuples with the same items aren't the same
+    assert _dedupe([[1], (1,), [1]]) == [[1], (1,)]
+
+
+def test_dedupe_arrays():
+    """Arrays are equal by contents, dtype, and shape, not by identity"""
+    a = np.arange(6)
+    deduped = _dedupe([a, a.copy(), a.astype(np.float64), a.reshape(2, 3), a[::-1].copy()[::-1], a + 1])
+    assert len(deduped) == 4
+    assert deduped[0] is a
+    assert [d.dtype for d in deduped] == [a.dtype, np.float64, a.dtype, a.dtype]
+    assert deduped[2].shape == (2, 3)
+
+    objects = np.empty(2, dtype=object)
+    objects[:] = [{'a': 1}, 'b']
+    copy = np.empty(2, dtype=object)
+    copy[:] = [{'a': 1}, 'b']
+    assert len(_dedupe([objects, copy])) == 1
+
+
+def test_recursive_dedupe():
+    results = [
+        {'session_id': '001', 'trial': '1', 'Subject': {'subject_id': 'jonny', 'species': 'mouse'}, 'cal': np.ones(3)},
+        {'session_id': '001', 'trial': '2', 'Subject': {'subject_id': 'jonny', 'species': 'mouse'}, 'cal': np.ones(3)},
+        {'session_id': '001', 'trial': '3', 'Subject': {'subject_id': 'jonny', 'species': 'mouse'}, 'cal': np.ones(3)},
+    ]
+    deduped = _recursive_dedupe_dicts(_gather_list_of_dicts(results), raise_on_dupes=False)
+    assert deduped['session_id'] == '001'
+    assert deduped['trial'] == ('1', '2', '3')
+    # nested dicts are gathered and deduplicated too
+    assert deduped['Subject'] == {'subject_id': 'jonny', 'species': 'mouse'}
+    assert np.array_equal(deduped['cal'], np.ones(3))
+
+    with pytest.raises(AmbiguityError, match='trial'):
+        _recursive_dedupe_dicts(_gather_list_of_dicts(results))
+
+    results[2]['Subject']['subject_id'] = 'jony'
+    with pytest.raises(AmbiguityError, match='Subject.subject_id'):
+        _recursive_dedupe_dicts(_gather_list_of_dicts([{k: v for k, v in r.items() if k != 'trial'} for r in results]))
+
+
+def test_sizeof():
+    array = np.zeros(100000)
+    assert array.nbytes <= _sizeof(array) < array.nbytes + 1000
+    # views count the data they hold on to
+    assert array.nbytes <= _sizeof(array[:]) < array.nbytes + 1000
+    # the same array twice is only counted once
+    assert _sizeof({'a': array, 'b': [array]}) < array.nbytes + 1000
+
+
+class Base(IntrospectionMixin):
+    def __init__(self, a=1, *args, **kwargs):
+        self.init_args = self._get_init_args()
+
+
+class Child(Base):
+    def __init__(self, b=2, c=None, **kwargs):
+        # constructing another object mid-__init__ doesn't leak its args into ours
+        self.other = Base(a=10)
+        super(Child, self).__init__(**kwargs)
+
+
+def test_get_init_args():
+    """Args come from every __init__ of the object being made, and only that object"""
+    child = Child(b=3, a=4)
+    assert child._full_sig_names == ['a', 'b', 'c']
+    assert child.init_args == {'a': 4, 'b': 3, 'c': None}
+    assert child.other.init_args == {'a': 10}
@@ -0,0 +1,95 @@
+import json
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from onice_conversion.spec import JSON
+from onice_conversion.utils import MetadataValidationError
+from onice_conversion.validation import clear_validators, get_validator
+
+SCHEMA = {
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'object',
+    'required': ['NWBFile'],
+    'properties': {
+        'NWBFile': {
+            'type': 'object',
+            'required': ['session_start_time'],
+            'properties': {
+                'session_start_time': {'type': 'string', 'format': 'date-time'},
+                'keywords': {'type': 'array', 'items': {'type': 'string'}},
+            },
+        },
+        'Subject': {
+            'type': 'object',
+            'additionalProperties': False,
+            'properties': {
+                'weight': {'type': 'number', 'minimum': 0},
+                'sex': {'enum': ['M', 'F', 'U', 'O']},
+                'depths': {'type': 'array', 'items': {'type': 'number'}},
+            },
+        },
+    },
+}
+
+
+def test_validate():
+    """Datetimes are strings and arrays are arrays, and every error is collected"""
+    clear_validators()
+    validator = get_validator(None, SCHEMA)
+    metadata = {'NWBFile': {'session_start_time': datetime.now(timezone.utc), 'keywords': np.array(['sniff'])},
+                'Subject': {'weight': np.float64(20.), 'depths': np.arange(4)}}
+    assert validator(metadata)
+
+    metadata['Subject'].update(weight=-1, sex='jonny', species='mouse')
+    del metadata['NWBFile']['session_start_time']
+    problems = validator.errors(metadata)
+    assert sorted(problem.path for problem in problems) == \
+           [('NWBFile',), ('Subject', 'sex'), ('Subject', 'species'), ('Subject', 'weight')]
+    with pytest.raises(MetadataValidationError):
+        validator.validate(metadata)
+
+
+def test_cached():
+    """The schema is only built the first time a key is used"""
+    clear_validators()
+    built = []
+
+    def build():
+        built.append(True)
+        return SCHEMA
+
+    assert get_validator(('converter', '1.0'), build) is get_validator(('converter', '1.0'), build)
+    assert len(built) == 1
+    assert get_validator(None, SCHEMA) is get_validator(None, json.loads(json.dumps(SCHEMA)))
+
+
+def test_sources(tmp_path):
+    """Errors point to the spec that set the offending value"""
+    (tmp_path / 'notes.json').write_text(json.dumps({'weight': 'heavy', 'sex': 'M'}))
+    weight = JSON(path='notes.json', key='Subject[weight]', field='weight')
+    sex = JSON(path='notes.json', key='Subject[sex]', field='sex')
+    metadata = (weight + sex).parse(tmp_path)
+    metadata['NWBFile'] = {'session_start_time': '2021-04-01'}
+
+    problems = get_validator(None, SCHEMA).errors(metadata, sources=metadata.sources)
+    assert len(problems) == 1
+    assert problems[0].path == ('Subject', 'weight')
+    assert problems[0].spec is weight
+    assert 'notes.json' in str(problems[0])
+
+
+def test_parse_spec(tmp_path):
+    """Parsing specs with the converter records where their values came from"""
+    pytest.importorskip('nwb_conversion_tools')
+    from onice_conversion.nwbconverter import NWBConverter
+
+    class Converter(NWBConverter):
+        data_interface_classes = {}
+
+    (tmp_path / 'notes.json').write_text(json.dumps({'weight': 20}))
+    weight = JSON(path='notes.json', key='Subject[weight]', field='weight')
+    converter = Converter({})
+    assert converter.parse_spec(weight, tmp_path) == {'Subject': {'weight': 20}}
+    assert converter.metadata_sources == {('Subject', 'weight'): weight}
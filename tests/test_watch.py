@@ -0,0 +1,37 @@
+import time
+
+from onice_conversion.batch import Session
+from onice_conversion.jobqueue import JobQueue
+from onice_conversion.watch import Watcher
+
+
+def test_failed_retried(tmp_path):
+    """Folders we can't make a session for yet stay watched, and are retried when they change"""
+    root = tmp_path / 'archive'
+    (root / 'jonny' / '001').mkdir(parents=True)
+
+    def session(root, path, fields):
+        if not (path / 'notes.json').exists():
+            raise FileNotFoundError('no notes yet')
+        return Session(f"{fields['subject_id']}_{fields['session_id']}", 'module:Converter', {},
+                       nwbfile_path=path / 'out.nwb')
+
+    with JobQueue(tmp_path / 'queue.db') as queue, \
+            Watcher(root, '{subject_id}/{session_id}', queue, session, quiet=0, polling=True) as watcher:
+        watcher.scan()
+        assert watcher.check() == []
+        assert watcher.check() == []
+        assert list(watcher.failed) == [root / 'jonny' / '001']
+        assert 'no notes yet' in watcher.failed[root / 'jonny' / '001']
+
+        # not retried until it changes
+        watcher.scan()
+        assert watcher.check() == []
+        assert root / 'jonny' / '001' in watcher.failed
+
+        time.sleep(0.01)
+        (root / 'jonny' / '001' / 'notes.json').write_text('{}')
+        assert watcher.check() == []
+        assert [session.name for session in watcher.check()] == ['jonny_001']
+        assert watcher.failed == {}
+        assert [job['name'] for job in queue.jobs()] == ['jonny_001']